@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Alert Dispatch Queue - tách đánh giá cảnh báo khỏi việc gửi
+- Hàng đợi bền (SQLite, WAL): cảnh báo chưa gửi còn nguyên sau khi khởi động lại
+- Giới hạn MAX_PENDING cảnh báo chờ; cảnh báo cùng node + mức đang chờ được gộp
+  (giữ dữ liệu mới nhất), mức nặng hơn được gửi trước
+- SENDERS thread gửi song song; giới hạn tốc độ nằm ở provider, tính theo request
+  thật sự gửi đi (fcm_dispatch: 1 lượt / batch 500 token), không theo cảnh báo
+- Gửi lỗi => thử lại với exponential backoff (chỉ phần chưa gửi được), tối đa MAX_ATTEMPTS lần;
+  cảnh báo mới gộp vào cảnh báo đang chờ thử lại vẫn chỉ gửi cho các token còn lỗi
+"""
+
+import os
+import json
+import random
+import sqlite3
+import threading
+import time
+import logging
+
+from subscriber_store import LEVEL_RANK
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH ============
+MAX_PENDING = int(os.getenv('ALERT_QUEUE_MAX', 10000))
+SENDERS = int(os.getenv('ALERT_SENDERS', 4))
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 2.0       # giây: 2, 4, 8, 16, 32 (+ jitter)
+BACKOFF_MAX = 300.0
+POLL_INTERVAL = 1.0      # Sender kiểm tra cảnh báo đến hạn thử lại mỗi 1 giây
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    node_id TEXT NOT NULL,
+    level TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    provider TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_alerts_pending ON alerts (node_id, level) WHERE state = 'pending';
+CREATE INDEX IF NOT EXISTS idx_alerts_due ON alerts (state, rank, next_attempt);
+"""
+
+
+class AlertQueue:
+    """
+    deliver(payload) -> None nếu xong, hoặc payload cần thử lại (vd. chỉ các token lỗi)
+    on_drop(node_id, level): gọi khi bỏ cảnh báo sau MAX_ATTEMPTS lần (vd. xóa cooldown)
+    """
+    def __init__(self, path, deliver, on_drop=None, senders=SENDERS, max_pending=MAX_PENDING):
+        self.path = path
+        self.deliver = deliver
+        self.on_drop = on_drop
+        self.senders = senders
+        self.max_pending = max_pending
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._claim_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._stats = {'enqueued': 0, 'coalesced': 0, 'rejected': 0, 'sent': 0,
+                       'retries': 0, 'dropped': 0}
+
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            # Cảnh báo đang gửi dở khi process dừng => gửi lại
+            conn.execute("DELETE FROM alerts WHERE state = 'sending' AND EXISTS ("
+                         "SELECT 1 FROM alerts p WHERE p.state = 'pending' "
+                         "AND p.node_id = alerts.node_id AND p.level = alerts.level)")
+            conn.execute("UPDATE alerts SET state = 'pending' WHERE state = 'sending'")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    # ---------- Đánh giá -> hàng đợi ----------
+    def put(self, node_id, level, payload, provider='fcm'):
+        """Thêm cảnh báo (gộp với cảnh báo cùng node + mức đang chờ); False nếu hàng đợi đầy"""
+        now = time.time()
+        data = json.dumps(payload)
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM alerts WHERE node_id = ? AND level = ? AND state = 'pending'",
+                (node_id, level)).fetchone()
+            if row is not None:
+                alert_id, old, attempts = row
+                merged = data
+                if attempts:
+                    # Đang chờ thử lại: dữ liệu mới, nhưng chỉ gửi lại cho các token còn lỗi
+                    merged = json.dumps({**payload, 'tokens': json.loads(old).get('tokens')})
+                updated = conn.execute(
+                    "UPDATE alerts SET payload = ? WHERE id = ? AND state = 'pending'",
+                    (merged, alert_id)).rowcount
+                if updated:
+                    self._count('coalesced')
+                    return True
+            pending = conn.execute('SELECT COUNT(*) FROM alerts').fetchone()[0]
+            if pending >= self.max_pending:
+                self._count('rejected')
+                logger.warning(f"Alert queue full ({pending}), dropping {node_id}/{level}")
+                return False
+            conn.execute(
+                'INSERT INTO alerts (node_id, level, rank, provider, payload, next_attempt, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (node_id, level, LEVEL_RANK.get(level, 0), provider, data, now, now))
+        self._count('enqueued')
+        with self._cond:
+            self._cond.notify()
+        return True
+
+    # ---------- Sender ----------
+    def _claim(self):
+        """Lấy 1 cảnh báo đến hạn (mức nặng nhất trước) và đánh dấu đang gửi"""
+        with self._claim_lock, self._conn() as conn:
+            row = conn.execute(
+                "SELECT id, node_id, level, provider, payload, attempts FROM alerts "
+                "WHERE state = 'pending' AND next_attempt <= ? "
+                "ORDER BY rank DESC, next_attempt LIMIT 1", (time.time(),)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE alerts SET state = 'sending' WHERE id = ?", (row[0],))
+            return row
+
+    def _finish(self, alert_id):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM alerts WHERE id = ?', (alert_id,))
+
+    def _retry(self, alert_id, node_id, level, payload, attempts):
+        if attempts >= MAX_ATTEMPTS:
+            self._finish(alert_id)
+            self._count('dropped')
+            logger.error(f"Alert {node_id}/{level} dropped after {attempts} attempts")
+            if self.on_drop is not None:
+                self.on_drop(node_id, level)
+            return
+
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "UPDATE alerts SET state = 'pending', payload = ?, attempts = ?, next_attempt = ? "
+                    "WHERE id = ?", (json.dumps(payload), attempts, time.time() + delay, alert_id))
+            self._count('retries')
+            logger.warning(f"Alert {node_id}/{level} retry {attempts} in {delay:.0f}s")
+        except sqlite3.IntegrityError:
+            # Đã có cảnh báo mới hơn cùng node + mức đang chờ => cảnh báo đó thay thế
+            self._finish(alert_id)
+            self._count('coalesced')
+
+    def _run(self):
+        while not self._stop.is_set():
+            row = self._claim()
+            if row is None:
+                with self._cond:
+                    self._cond.wait(POLL_INTERVAL)
+                continue
+
+            alert_id, node_id, level, provider, payload, attempts = row
+            try:
+                retry = self.deliver(json.loads(payload))
+            except Exception as e:
+                logger.error(f"Alert {node_id}/{level} delivery error: {e}")
+                retry = json.loads(payload)
+
+            if retry is None:
+                self._finish(alert_id)
+                self._count('sent')
+            else:
+                self._retry(alert_id, node_id, level, retry, attempts + 1)
+
+    def start(self):
+        for i in range(self.senders):
+            thread = threading.Thread(target=self._run, name=f'alert-sender-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"✓ Alert queue started ({self.senders} senders, {self.pending()} pending)")
+
+    def close(self, timeout=10):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def pending(self):
+        return self._conn().execute('SELECT COUNT(*) FROM alerts').fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        return {**stats, 'pending': self.pending()}
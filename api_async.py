@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Air Quality API Server - chế độ bất đồng bộ (ASGI)
+- Starlette + uvicorn; InfluxDB qua aiohttp (AsyncInfluxClient): request chờ I/O không giữ thread
+- Route async: /api/current, /api/current/batch, /api/history, /api/compare, /api/stream, /health
+  (cùng response với api_server, dùng chung các hàm dựng response + history_cache + live_hub)
+- /api/compare: mỗi node 1 query chạy song song (asyncio.gather) và 1 key cache riêng
+- Các route còn lại (predict, anomaly, suggestions, standards, index) chạy Flask app qua WSGIMiddleware
+- Việc chặn thread (đọc latest store, nạp model node từ đĩa, model store) chạy trong executor,
+  không chạy trên event loop
+
+Chạy (nhiều worker process, mỗi worker có cache / pool / live hub riêng,
+model dùng chung qua model store):
+  uvicorn api_async:app --host 0.0.0.0 --port 5000 --workers 4
+  hoặc: API_WORKERS=4 python api_async.py
+  hoặc: GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py api_async:app
+
+Mục tiêu hiệu năng (1 worker, 1 vCPU, InfluxDB cùng máy):
+  - /api/current, /api/current/batch (latest store): >= 1500 req/s, p99 < 20 ms
+  - /api/history 48h khi cache hit (chỉ query bucket đuôi): >= 300 req/s, p95 < 50 ms
+  - /api/stream: >= 2000 kết nối SSE đồng thời / worker với LIVE_MAX_CLIENTS=2000
+    (không thread nào bị giữ theo client)
+  - InfluxDB: tối đa INFLUX_POOL_SIZE query đồng thời / worker, phần còn lại chờ trong event loop
+  Kiểm tra: wrk -t4 -c400 -d30s "http://host:5000/api/history?node_id=node1&hours=48"
+"""
+
+import asyncio
+import os
+import time
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import partial
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from api_server import (
+    app as flask_app, history_cache, live_hub, check_format, parse_since, parse_node_ids,
+    history_start, interval_seconds, aggregated_queries, aggregated_where, parse_aggregated,
+    latest_point_query, latest_store_points, latest_points_query, parse_latest_points,
+    current_payload, current_batch_payload, history_etag, history_payload, compare_payload, model_trainer, model_registry,
+    HISTORY_FIELDS, COMPARE_FIELDS, BATCH_MAX_NODES, CURRENT_MAX_AGE, RAW_TAIL_MAX,
+    INFLUXDB_HOST, INFLUXDB_PORT, INFLUXDB_DB, INFLUX_POOL_SIZE, INFLUX_QUERY_TIMEOUT, VN_TZ
+)
+from influx_pool import AsyncInfluxClient
+from latest_store import shared_reader
+from live_stream import format_sse, KEEPALIVE_INTERVAL, RETRY_MS, POLL_INTERVAL
+from result_arrays import from_buckets
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # check_format() từ chối format=msgpack
+
+# ============ CẤU HÌNH ============
+API_HOST = os.getenv('API_HOST', '0.0.0.0')
+API_PORT = int(os.getenv('API_PORT', 5000))
+API_WORKERS = int(os.getenv('API_WORKERS', os.cpu_count() or 1))
+NODE_LIST_TTL = 300  # Danh sách node (SHOW TAG VALUES) cache 5 phút
+
+logger = logging.getLogger(__name__)
+
+influx = AsyncInfluxClient(
+    INFLUXDB_HOST, INFLUXDB_PORT, INFLUXDB_DB,
+    size=INFLUX_POOL_SIZE, timeout=INFLUX_QUERY_TIMEOUT
+)
+_node_list = {'nodes': [], 'expires': 0.0}
+
+
+# ============ HÀM TIỆN ÍCH ============
+def error(message, status=500):
+    return JSONResponse({'status': 'error', 'message': message}, status_code=status)
+
+
+def send_payload(payload, fmt, headers=None):
+    """JSON, hoặc MessagePack (float32) khi format=msgpack"""
+    if fmt == 'msgpack':
+        return Response(msgpack.packb(payload, use_single_float=True),
+                        media_type='application/x-msgpack', headers=headers)
+    return JSONResponse(payload, headers=headers)
+
+
+def etag_matches(request, etag):
+    return f'"{etag}"' in request.headers.get('if-none-match', '')
+
+
+async def blocking(func, *args, **kwargs):
+    """Chạy hàm chặn (mmap, pickle, model store) trong thread pool mặc định của event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+def store_point(node_id):
+    """Giá trị mới nhất của node trong latest store (None nếu chưa có / quá cũ)"""
+    store = shared_reader()
+    return store.get(node_id, max_age=CURRENT_MAX_AGE) if store is not None else None
+
+
+def models_stats():
+    return {**model_trainer.stats(), 'registry': model_registry.stats()}
+
+
+async def query_aggregated(fields, interval, where, group_by='', raw=False):
+    """Như api_server.query_aggregated: rollup trước, rỗng thì raw"""
+    for query in aggregated_queries(fields, interval, where, group_by, raw):
+        result = await influx.query(query, epoch='s')
+        if len(result) > 0:
+            return result
+    return result
+
+
+async def cached_aggregated(fields, interval, hours, node_id=None, group_by=''):
+    """Như api_server.cached_aggregated nhưng query bất đồng bộ (history_cache.aget)"""
+    bucket = interval_seconds(interval)
+    now = time.time()
+    start = history_start(hours, bucket, now)
+
+    async def fetch(since):
+        result = await query_aggregated(fields, interval, aggregated_where(node_id, since),
+                                        group_by=group_by, raw=now - since <= RAW_TAIL_MAX)
+        return parse_aggregated(result, fields, group_by)
+
+    key = ('aggregated', tuple(fields), interval, node_id, group_by)
+    return await history_cache.aget(key, bucket, start, fetch, now)
+
+
+async def list_nodes():
+    """Tất cả node_id (SHOW TAG VALUES, cache NODE_LIST_TTL giây)"""
+    if time.monotonic() < _node_list['expires']:
+        return _node_list['nodes']
+    result = await influx.query('SHOW TAG VALUES FROM air_quality WITH KEY = "node_id"')
+    _node_list['nodes'] = sorted(p['value'] for p in result.get_points())
+    _node_list['expires'] = time.monotonic() + NODE_LIST_TTL
+    return _node_list['nodes']
+
+
+# ============ API ENDPOINTS ============
+async def get_current(request):
+    """Lấy dữ liệu hiện tại"""
+    node_id = request.query_params.get('node_id', 'node1')
+
+    try:
+        point = await blocking(store_point, node_id)
+        if point is None:
+            points = list((await influx.query(latest_point_query(node_id))).get_points())
+            point = points[0] if points else None
+
+        if not point:
+            return error('No data available', 404)
+
+        # Detector của node có thể phải nạp model từ đĩa
+        return JSONResponse(await blocking(current_payload, node_id, point))
+
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return error(str(e))
+
+
+async def get_current_batch(request):
+    """Dữ liệu hiện tại của nhiều node trong 1 request (?node_ids=node1,node2; bỏ trống = tất cả)"""
+    node_ids = parse_node_ids(request.query_params.get('node_ids'), BATCH_MAX_NODES)
+
+    try:
+        points, missing = await blocking(latest_store_points, node_ids)
+        if missing != []:
+            result = await influx.query(latest_points_query(missing), epoch='s')
+            points.update(parse_latest_points(result))
+
+        return JSONResponse(await blocking(current_batch_payload, points, node_ids))
+
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return error(str(e))
+
+
+async def stream(request):
+    """
+    Server-Sent Events (như api_server.stream) nhưng không giữ thread cho mỗi client:
+    coroutine lấy sự kiện đã gộp của client mỗi POLL_INTERVAL giây
+    """
+    params = request.query_params
+    node_ids = parse_node_ids(params.get('node_ids'))
+    last_id = request.headers.get('last-event-id') or params.get('last_event_id')
+    since = int(last_id) if last_id and last_id.isdigit() else None
+
+    try:
+        # subscribe đọc latest store + enrich (model node từ đĩa) => thread pool
+        sub = await blocking(live_hub.subscribe, node_ids, since_generation=since)
+    except RuntimeError as e:
+        return error(str(e), 503)
+
+    async def generate():
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            idle = 0.0
+            while not await request.is_disconnected():
+                events = sub.get(timeout=0)
+                if events is None:
+                    break
+                for event in events:
+                    yield format_sse('level' if event['level_changed'] else 'reading',
+                                     event, event['generation'])
+                idle = 0.0 if events else idle + POLL_INTERVAL
+                if idle >= KEEPALIVE_INTERVAL:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+                await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            await blocking(live_hub.unsubscribe, sub)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+async def get_history(request):
+    """Lấy lịch sử dữ liệu (?since=, ?format=, ETag như api_server.get_history)"""
+    params = request.query_params
+    node_id = params.get('node_id', 'node1')
+
+    try:
+        hours = int(params.get('hours', 24))
+        since = parse_since(params.get('since'))
+        fmt = check_format(params.get('format', 'rows'))
+    except ValueError as e:
+        return error(f"Invalid parameter: {e}", 400)
+
+    try:
+        pairs = (await cached_aggregated(HISTORY_FIELDS, '5m', hours, node_id=node_id)).get(None, [])
+        series = from_buckets(pairs, HISTORY_FIELDS).present('pm2_5')
+
+        etag = history_etag(series, node_id, hours, since, fmt)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={'ETag': f'"{etag}"'})
+
+        return send_payload(history_payload(series, node_id, hours, since, fmt, params.get('since')),
+                            fmt, headers={'ETag': f'"{etag}"'})
+
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return error(str(e))
+
+
+async def compare_nodes(request):
+    """So sánh dữ liệu giữa các nodes: query từng node song song"""
+    params = request.query_params
+
+    try:
+        hours = int(params.get('hours', 24))
+        fmt = check_format(params.get('format', 'rows'))
+    except ValueError as e:
+        return error(f"Invalid parameter: {e}", 400)
+
+    try:
+        nodes = await list_nodes()
+        results = await asyncio.gather(*(
+            cached_aggregated(COMPARE_FIELDS, '30m', hours, node_id=node_id) for node_id in nodes
+        ))
+        series = {node_id: r[None] for node_id, r in zip(nodes, results) if r.get(None)}
+        return send_payload(compare_payload(series, hours, fmt), fmt)
+
+    except Exception as e:
+        return error(str(e))
+
+
+async def health(request):
+    """Health check"""
+    return JSONResponse({
+        'status': 'healthy',
+        'service': 'Air Quality API v5 (async)',
+        'features': ['PM Only', 'LSTM Prediction', 'Anomaly Detection'],
+        'standards': 'QCVN 05:2023/BTNMT',
+        'history_cache': history_cache.stats(),
+        'live_stream': live_hub.stats(),
+        'models': await blocking(models_stats),
+        'timestamp': datetime.now(VN_TZ).isoformat()
+    })
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await influx.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/current', get_current),
+        Route('/api/current/batch', get_current_batch),
+        Route('/api/stream', stream),
+        Route('/api/history', get_history),
+        Route('/api/compare', compare_nodes),
+        Route('/health', health),
+        # Route còn lại: Flask (chạy trong threadpool của WSGIMiddleware)
+        Mount('/', app=WSGIMiddleware(flask_app))
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'],
+                   allow_headers=['*'], expose_headers=['ETag'])
+    ],
+    lifespan=lifespan
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    logger.info("=" * 50)
+    logger.info("🌬️ Air Quality API Server v5 (async)")
+    logger.info(f"   Workers: {API_WORKERS}, InfluxDB pool: {INFLUX_POOL_SIZE}/worker")
+    logger.info("=" * 50)
+    uvicorn.run('api_async:app', host=API_HOST, port=API_PORT, workers=API_WORKERS)
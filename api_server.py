@@ -7,31 +7,75 @@ Air Quality API Server v5
 - QCVN 05:2023/BTNMT
 """
 
-from flask import Flask, jsonify, request, render_template, send_from_directory
+from flask import Flask, jsonify, request, render_template, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
-from influxdb import InfluxDBClient
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 import pytz
 import os
+import re
+import time
+import zlib
 import logging
 import numpy as np
-import pickle
 import warnings
 warnings.filterwarnings('ignore')
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from influx_pool import InfluxQueryPool
+from latest_store import shared_reader
+from live_stream import LiveHub, format_sse, KEEPALIVE_INTERVAL, RETRY_MS
+from bucket_cache import BucketCache
+from result_arrays import from_buckets, from_resultset, round1, stats, to_list, iso_times, hour_labels
+from aqi import calculate_aqi, get_level, level_codes
+from model_store import ModelStore, FORECAST_PATH
+from model_registry import ModelRegistry
+from model_trainer import ModelTrainer
+
 app = Flask(__name__, static_folder='static')
-CORS(app)
+CORS(app, expose_headers=['ETag'])  # dashboard đọc ETag của /api/history
 
 # ============ CẤU HÌNH ============
 INFLUXDB_HOST = os.getenv('INFLUXDB_HOST', 'localhost')
 INFLUXDB_PORT = int(os.getenv('INFLUXDB_PORT', 8086))
 INFLUXDB_DB = os.getenv('INFLUXDB_DB', 'airquality')
 
+# Pool kết nối InfluxDB dùng chung cho mọi route (keep-alive, timeout, retry)
+INFLUX_POOL_SIZE = int(os.getenv('INFLUX_POOL_SIZE', 8))
+INFLUX_QUERY_TIMEOUT = float(os.getenv('INFLUX_QUERY_TIMEOUT', 10))
+
 VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+VN_UTC_OFFSET = datetime.now(VN_TZ).utcoffset().total_seconds()  # +7h, không có DST
+
+# Rollup do mqtt_subscriber ghi sẵn (air_quality_1m / 5m / 1h)
+USE_ROLLUPS = os.getenv('USE_ROLLUPS', 'true').lower() == 'true'
+ROLLUP_TIERS = [('1h', 3600), ('5m', 300), ('1m', 60)]  # Thô nhất trước
+
+# Giá trị hiện tại: đọc từ latest store (shared memory do mqtt_subscriber cập nhật)
+CURRENT_MAX_AGE = 600  # 10 phút, như WHERE time > now() - 10m
+BATCH_MAX_NODES = 200
+
+# Cache theo bucket cho history / compare: bucket đã đóng không query lại
+RAW_TAIL_MAX = 3600  # Phần đuôi ngắn hơn 1 giờ đọc raw (rollup của bucket đang mở chưa được ghi)
+
+# ?format= cho các endpoint chuỗi thời gian: rows (mặc định), columnar (mảng song song, epoch giây),
+# msgpack (columnar, float32, cần package msgpack); time_label / tên mức do client tự tạo
+RESPONSE_FORMATS = ('rows', 'columnar', 'msgpack')
+HISTORY_FIELDS = ['pm1_0', 'pm2_5', 'pm10', 'aqi']
+COMPARE_FIELDS = ['pm2_5', 'pm10', 'aqi']
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+influx = InfluxQueryPool(
+    INFLUXDB_HOST, INFLUXDB_PORT, INFLUXDB_DB,
+    size=INFLUX_POOL_SIZE, timeout=INFLUX_QUERY_TIMEOUT
+)
+history_cache = BucketCache()
+
 # ============ TIÊU CHUẨN QCVN 05:2023 ============
 STANDARDS = {
     'pm2_5': {
@@ -55,133 +99,425 @@ STANDARDS = {
 }
 
 # ============ ML MODELS ============
-# LSTM Model (Simple implementation - có thể thay bằng TensorFlow model)
-class SimpleLSTMPredictor:
+# Model riêng từng node (nạp khi cần, LRU) + detector chung, trainer publish qua model store
+model_store = ModelStore()
+model_registry = ModelRegistry(model_store)
+forecast_store = ModelStore(FORECAST_PATH)   # Dự báo tính sẵn mỗi giờ (model_trainer)
+
+
+def cached_forecast(node_id, hours, now=None):
+    """
+    Dự báo tính sẵn của node từ giờ kế tiếp: (times, pm2_5, aqi), tối đa hours giờ
+    Bỏ các giờ đã qua nếu trainer chưa kịp tính lại; None nếu node không có dự báo
+    """
+    state = forecast_store.load()
+    forecast = state['nodes'].get(node_id) if state else None
+    if forecast is None:
+        return None
+    now = int(now or time.time())
+    skip = max(0, (now - now % 3600 - state['start']) // 3600)
+    end = skip + max(hours, 0)
+    times = [state['start'] + (i + 1) * 3600 for i in range(skip, min(end, len(forecast['pm2_5'])))]
+    return times, forecast['pm2_5'][skip:end], forecast['aqi'][skip:end]
+
+
+# ============ HÀM TIỆN ÍCH ============
+def rolling_averages(point):
+    """
+    Trung bình trượt của node (rolling_aqi qua latest store): PM2.5 1h / 24h, PM10 24h,
+    NowCast + AQI ngày (TB 24h) / AQI giờ (NowCast); None nếu điểm lấy từ InfluxDB
+    """
+    if 'aqi_24h' not in point:
+        return None
+    averages = {}
+    for name in ('pm2_5_1h', 'pm2_5_24h', 'pm10_24h', 'pm2_5_nowcast'):
+        value = point.get(name)
+        averages[name] = None if value is None else round(value, 1)
+    for name in ('aqi_24h', 'aqi_nowcast'):
+        aqi = point.get(name)
+        averages[name] = aqi
+        averages[name.replace('aqi', 'level')] = None if aqi is None else get_level(aqi)[0]
+    return averages
+
+
+def live_event(item):
+    """Bản ghi latest store -> sự kiện live stream (cùng dạng với /api/current/batch)"""
+    level, _ = get_level(item['aqi'])
+    is_anomaly, score = model_registry.detector(item['node_id']).detect(item['pm2_5'])
+    return {
+        'node_id': item['node_id'],
+        'time': int(item['timestamp']),
+        'pm1_0': round(item['pm1_0'], 1),
+        'pm2_5': round(item['pm2_5'], 1),
+        'pm10': round(item['pm10'], 1),
+        'aqi': int(item['aqi']),
+        'level': level,
+        'anomaly': bool(is_anomaly),
+        'anomaly_score': score,
+        'averages': rolling_averages(item),
+        'generation': item['generation']
+    }
+
+
+# Live stream (SSE): thread theo dõi latest store chỉ chạy khi có client
+live_hub = LiveHub(live_event)
+
+
+def interval_seconds(interval):
+    """'30m' -> 1800, '1h' -> 3600"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    return int(interval[:-1]) * units[interval[-1]]
+
+
+def rollup_measurement(interval):
+    """Tầng rollup thô nhất mà kích thước chia hết interval (None nếu không có)"""
+    seconds = interval_seconds(interval)
+    for tier, size in ROLLUP_TIERS:
+        if size <= seconds and seconds % size == 0:
+            return f"air_quality_{tier}"
+    return None
+
+
+def aggregated_queries(fields, interval, where, group_by='', raw=False):
     """
-    Dự báo PM2.5 đơn giản dựa trên moving average và trend
-    Có thể thay bằng TensorFlow LSTM model thực sự
+    Query trung bình theo time(interval), theo thứ tự ưu tiên: rollup (nếu có) rồi raw
+    Rollup lưu sum + count => mean = sum(x_sum) / sum(count), chính xác khi gộp nhiều cửa sổ
     """
-    def __init__(self):
-        self.history = []
-        self.lookback = 24  # 24 giờ
+    group = f"time({interval}), {group_by}" if group_by else f"time({interval})"
+    queries = []
     
-    def fit(self, data):
-        """Cập nhật lịch sử"""
-        self.history = list(data)[-168:]  # Giữ 7 ngày
+    measurement = rollup_measurement(interval) if USE_ROLLUPS and not raw else None
+    if measurement:
+        select = ', '.join(f'sum("{f}_sum") / sum("count") AS {f}' for f in fields)
+        queries.append(f'''
+            SELECT {select} FROM {measurement}
+            WHERE {where}
+            GROUP BY {group} fill(null)
+        ''')
     
-    def predict(self, hours=24):
-        """Dự báo PM2.5 cho n giờ tới"""
-        if len(self.history) < 24:
-            return []
-        
-        predictions = []
-        recent = self.history[-24:]
-        
-        # Tính trend
-        if len(self.history) >= 48:
-            trend = (np.mean(self.history[-24:]) - np.mean(self.history[-48:-24])) / 24
-        else:
-            trend = 0
-        
-        # Moving average với trend
-        base = np.mean(recent)
-        
-        for h in range(hours):
-            # Thêm pattern theo giờ trong ngày (giả lập)
-            hour_of_day = (datetime.now().hour + h) % 24
-            
-            # Rush hour factor (7-9h và 17-19h cao hơn)
-            if 7 <= hour_of_day <= 9 or 17 <= hour_of_day <= 19:
-                hour_factor = 1.15
-            elif 0 <= hour_of_day <= 5:
-                hour_factor = 0.85
-            else:
-                hour_factor = 1.0
-            
-            pred = (base + trend * h) * hour_factor
-            pred = max(5, min(300, pred))  # Giới hạn hợp lý
-            predictions.append(round(pred, 1))
-        
-        return predictions
+    # Chưa có rollup cho khoảng này => tính trên dữ liệu raw
+    select = ', '.join(f"mean({f}) as {f}" for f in fields)
+    queries.append(f'''
+        SELECT {select} FROM air_quality 
+        WHERE {where}
+        GROUP BY {group} fill(null)
+    ''')
+    return queries
+
 
+def query_aggregated(client, fields, interval, where, group_by='', raw=False, **kwargs):
+    """Trung bình theo time(interval): đọc từ rollup nếu có, không thì GROUP BY trên raw"""
+    for query in aggregated_queries(fields, interval, where, group_by, raw):
+        result = client.query(query, **kwargs)
+        if len(result) > 0:
+            return result
+    return result
 
-class IsolationForestDetector:
+
+def history_start(hours, bucket, now=None):
+    """Đầu bucket chứa now - hours (epoch giây)"""
+    start = int((now or time.time()) - hours * 3600)
+    return start - start % bucket
+
+
+def parse_since(value):
+    """Cursor ?since=: epoch giây hoặc ISO 8601; None nếu không có, ValueError nếu sai"""
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+
+def cached_aggregated(fields, interval, hours, node_id=None, group_by=''):
     """
-    Phát hiện điểm bất thường trong dữ liệu PM2.5
-    Sử dụng statistical approach thay vì sklearn để đơn giản
+    query_aggregated qua history_cache: {group: [(epoch, row), ...]}, group = giá trị tag group_by (None nếu không group)
+    Khoảng bắt đầu từ đầu bucket chứa now - hours; chỉ phần đuôi chưa cache được query
     """
-    def __init__(self):
-        self.mean = 0
-        self.std = 0
-        self.threshold = 2.5  # Z-score threshold
+    bucket = interval_seconds(interval)
+    now = time.time()
+    start = history_start(hours, bucket, now)
     
-    def fit(self, data):
-        """Huấn luyện với dữ liệu lịch sử"""
-        if len(data) > 10:
-            self.mean = np.mean(data)
-            self.std = np.std(data)
-            if self.std == 0:
-                self.std = 1
+    def fetch(since):
+        result = query_aggregated(influx, fields, interval, aggregated_where(node_id, since),
+                                  group_by=group_by, raw=now - since <= RAW_TAIL_MAX, epoch='s')
+        return parse_aggregated(result, fields, group_by)
     
-    def detect(self, value):
-        """Kiểm tra xem giá trị có bất thường không"""
-        if self.std == 0:
-            return False, 0
-        
-        z_score = abs(value - self.mean) / self.std
-        is_anomaly = z_score > self.threshold
-        
-        return is_anomaly, round(z_score, 2)
+    key = ('aggregated', tuple(fields), interval, node_id, group_by)
+    return history_cache.get(key, bucket, start, fetch, now)
+
+
+def aggregated_where(node_id, since):
+    where = f"time >= {since}s"
+    if node_id:
+        where = f"node_id = '{node_id}' AND {where}"
+    return where
+
+
+def parse_aggregated(result, fields, group_by=''):
+    """ResultSet (epoch='s') -> {group: {epoch: row}} cho history_cache"""
+    series = {}
+    for (_, tags), points in result.items():
+        group = (tags or {}).get(group_by) if group_by else None
+        series[group] = {p['time']: {f: p.get(f) for f in fields} for p in points}
+    return series
+
+
+def iso_time(ts):
+    """Epoch giây -> '2024-01-01T00:00:00Z' (như InfluxDB trả về)"""
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def response_format():
+    """?format= của request; ValueError nếu không hỗ trợ"""
+    return check_format(request.args.get('format', 'rows'))
+
+
+def check_format(fmt):
+    if fmt not in RESPONSE_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(RESPONSE_FORMATS)}")
+    if fmt == 'msgpack' and msgpack is None:
+        raise ValueError("msgpack is not installed on the server")
+    return fmt
+
+
+def to_columns(series, fields):
+    """SeriesArrays -> {'time': [epoch...], field: [giá trị làm tròn 0.1, null = None ...]}"""
+    columns = {'time': series.times.tolist()}
+    for f in fields:
+        columns[f] = to_list(round1(series[f]))
+    return columns
+
+
+def to_rows(series, fields):
+    """SeriesArrays -> [{'time', 'time_label', field...}, ...]: làm tròn 0.1, aqi int, null = 0"""
+    columns = {'time': iso_times(series.times), 'time_label': hour_labels(series.times, VN_UTC_OFFSET)}
+    for f in fields:
+        values = np.nan_to_num(series[f])
+        columns[f] = values.astype(np.int64).tolist() if f == 'aqi' else round1(values).tolist()
+    keys = list(columns)
+    return [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+
+def send_payload(payload, fmt):
+    """jsonify, hoặc MessagePack (float32) khi format=msgpack"""
+    if fmt == 'msgpack':
+        return Response(msgpack.packb(payload, use_single_float=True), mimetype='application/x-msgpack')
+    return jsonify(payload)
+
+
+LATEST_SELECT = '''
+    SELECT last(pm1_0) as pm1_0, last(pm2_5) as pm2_5, last(pm10) as pm10, last(aqi) as aqi
+    FROM air_quality 
+'''
+
+
+def get_latest_point(node_id):
+    """
+    Giá trị mới nhất của node trong 10 phút gần đây
+    Ưu tiên latest store (không chạm InfluxDB), fallback query last(...) nếu subscriber chưa chạy
+    """
+    store = shared_reader()
+    if store is not None:
+        item = store.get(node_id, max_age=CURRENT_MAX_AGE)
+        if item is not None:
+            return item
+    
+    result = influx.query(latest_point_query(node_id))
+    points = list(result.get_points())
     
-    def detect_batch(self, values):
-        """Kiểm tra nhiều giá trị"""
-        results = []
-        for v in values:
-            is_anomaly, score = self.detect(v)
-            results.append({
-                'value': v,
-                'is_anomaly': is_anomaly,
-                'anomaly_score': score
-            })
-        return results
+    return points[0] if points else None
 
 
-# Khởi tạo models
-lstm_predictor = SimpleLSTMPredictor()
-anomaly_detector = IsolationForestDetector()
+def latest_point_query(node_id):
+    return f"{LATEST_SELECT} WHERE node_id = '{node_id}' AND time > now() - 10m"
 
 
-# ============ HÀM TIỆN ÍCH ============
-def calculate_aqi(pm25):
-    """Tính AQI theo QCVN 05:2023/BTNMT"""
-    breakpoints = [
-        (0, 25, 0, 50),
-        (25, 50, 50, 100),
-        (50, 80, 100, 150),
-        (80, 150, 150, 200),
-        (150, 250, 200, 300),
-        (250, 500, 300, 500)
-    ]
+def get_latest_points(node_ids=None):
+    """
+    Giá trị mới nhất của nhiều node: {node_id: point}
+    Latest store trước, các node còn thiếu lấy bằng 1 query last(...) GROUP BY node_id
+    """
+    points, missing = latest_store_points(node_ids)
+    if missing == []:
+        return points
+    
+    result = influx.query(latest_points_query(missing), epoch='s')
+    points.update(parse_latest_points(result))
+    return points
+
+
+def latest_store_points(node_ids=None):
+    """
+    Phần lấy được từ latest store: (points, missing)
+    missing: node cần query InfluxDB ([] = đủ, None = tất cả node do chưa có store)
+    """
+    points = {}
+    store = shared_reader()
+    if store is None:
+        return points, node_ids
+    
+    for node_id, item in store.all(max_age=CURRENT_MAX_AGE).items():
+        if node_ids is None or node_id in node_ids:
+            points[node_id] = {**item, 'time': int(item['timestamp'])}
+    if node_ids is None:
+        return points, []
+    return points, [n for n in node_ids if n not in points]
+
+
+def latest_points_query(missing):
+    where = "time > now() - 10m"
+    if missing:
+        pattern = '|'.join(re.escape(n).replace('/', '\\/') for n in missing)
+        where += f" AND node_id =~ /^({pattern})$/"
+    return f"{LATEST_SELECT} WHERE {where} GROUP BY node_id"
+
+
+def parse_latest_points(result):
+    points = {}
+    for key, series in result.items():
+        node_id = key[1].get('node_id', 'unknown')
+        for p in series:
+            points[node_id] = p
+    return points
+
+
+def parse_node_ids(value, limit=None):
+    """'node1,node2' -> ['node1', 'node2'] (None nếu trống)"""
+    if not value:
+        return None
+    return [n for n in value.split(',') if n][:limit]
+
+
+# ============ DỰNG RESPONSE (dùng chung Flask / api_async) ============
+def current_payload(node_id, point):
+    """Response /api/current từ giá trị mới nhất của node"""
+    pm1_0 = point.get('pm1_0', 0) or 0
+    pm2_5 = point.get('pm2_5', 0) or 0
+    pm10 = point.get('pm10', 0) or 0
+    aqi = point.get('aqi') or calculate_aqi(pm2_5)
+    
+    level, level_info = get_level(aqi)
+    
+    # Anomaly detection
+    is_anomaly, anomaly_score = model_registry.detector(node_id).detect(pm2_5)
+    
+    return {
+        'status': 'success',
+        'node_id': node_id,
+        'timestamp': datetime.now(VN_TZ).isoformat(),
+        'pm1_0': round(pm1_0, 1),
+        'pm2_5': round(pm2_5, 1),
+        'pm10': round(pm10, 1),
+        'aqi': aqi,
+        'level': level,
+        'level_info': {
+            **level_info,
+            'suggestions': get_suggestions(level)
+        },
+        'anomaly': {
+            'is_anomaly': bool(is_anomaly),
+            'score': float(anomaly_score),
+            'message': '⚠️ Giá trị bất thường!' if is_anomaly else 'Bình thường'
+        },
+        'averages': rolling_averages(point),
+        'standards': STANDARDS
+    }
+
+
+def current_batch_payload(points, node_ids=None):
+    """Response /api/current/batch từ {node_id: point}"""
+    nodes = {}
+    for node_id, point in points.items():
+        pm1_0 = point.get('pm1_0', 0) or 0
+        pm2_5 = point.get('pm2_5', 0) or 0
+        pm10 = point.get('pm10', 0) or 0
+        aqi = point.get('aqi') or calculate_aqi(pm2_5)
+        level, _ = get_level(aqi)
+        is_anomaly, _ = model_registry.detector(node_id).detect(pm2_5)
+        
+        nodes[node_id] = {
+            'time': point.get('time'),
+            'pm1_0': round(pm1_0, 1),
+            'pm2_5': round(pm2_5, 1),
+            'pm10': round(pm10, 1),
+            'aqi': int(aqi),
+            'level': level,
+            'anomaly': bool(is_anomaly),
+            'averages': rolling_averages(point)
+        }
+    
+    return {
+        'status': 'success',
+        'timestamp': datetime.now(VN_TZ).isoformat(),
+        'count': len(nodes),
+        'nodes': nodes,
+        'missing': [n for n in node_ids if n not in nodes] if node_ids else []
+    }
+
+
+def history_etag(series, node_id, hours, since, fmt):
+    """ETag từ bucket đầu + số bucket + vài bucket cuối (các bucket trước đó đã đóng, không đổi)"""
+    tail = np.stack([series.times[-3:]] + [series[f][-3:] for f in HISTORY_FIELDS])
+    signature = (node_id, hours, since, fmt, len(series),
+                 int(series.times[0]) if len(series) else None, tail.tobytes())
+    return f"{zlib.crc32(repr(signature).encode()):08x}"
+
+
+def history_payload(series, node_id, hours, since, fmt, since_raw=None):
+    """Response /api/history (delta từ since nếu có)"""
+    # Statistics (trên cả khoảng, kể cả khi chỉ trả delta)
+    pm25_stats = stats(series['pm2_5'])
+    stats_out = {}
+    if pm25_stats:
+        stats_out = {
+            'pm2_5_min': round(pm25_stats[0], 1),
+            'pm2_5_max': round(pm25_stats[1], 1),
+            'pm2_5_avg': round(pm25_stats[2], 1)
+        }
+    
+    if since is not None:
+        series = series.since(since)
     
-    for c_lo, c_hi, i_lo, i_hi in breakpoints:
-        if c_lo <= pm25 <= c_hi:
-            aqi = ((i_hi - i_lo) / (c_hi - c_lo)) * (pm25 - c_lo) + i_lo
-            return int(round(aqi))
-    return 500 if pm25 > 500 else 0
-
-
-def get_level(aqi):
-    """Lấy mức độ chất lượng không khí"""
-    if aqi <= 50:
-        return 'good', {'name': 'Tốt', 'color': '#00E400', 'emoji': '😊'}
-    elif aqi <= 100:
-        return 'moderate', {'name': 'Trung bình', 'color': '#FFFF00', 'emoji': '😐'}
-    elif aqi <= 150:
-        return 'poor', {'name': 'Kém', 'color': '#FF7E00', 'emoji': '😷'}
-    elif aqi <= 200:
-        return 'bad', {'name': 'Xấu', 'color': '#FF0000', 'emoji': '🚨'}
+    start = history_start(hours, 300)
+    if fmt == 'rows':
+        data = to_rows(series, HISTORY_FIELDS)
+        start = iso_time(start)
+        cursor = data[-1]['time'] if data else since_raw
     else:
-        return 'hazardous', {'name': 'Nguy hại', 'color': '#8F3F97', 'emoji': '☠️'}
+        data = to_columns(series, HISTORY_FIELDS)
+        cursor = int(series.times[-1]) if len(series) else since
+    
+    return {
+        'status': 'success',
+        'node_id': node_id,
+        'hours': hours,
+        'format': fmt,
+        'delta': since is not None,
+        'start': start,
+        # Bucket cuối có thể còn thay đổi => lần sau gửi lại từ bucket này
+        'cursor': cursor,
+        'data': data,
+        'statistics': stats_out
+    }
+
+
+def compare_payload(series, hours, fmt):
+    """Response /api/compare từ {node_id: [(epoch, row), ...]}"""
+    comparison = {}
+    for node_id, pairs in series.items():
+        node_arrays = from_buckets(pairs, COMPARE_FIELDS).present('pm2_5')
+        if fmt == 'rows':
+            comparison[node_id or 'unknown'] = to_rows(node_arrays, COMPARE_FIELDS)
+        else:
+            comparison[node_id or 'unknown'] = to_columns(node_arrays, COMPARE_FIELDS)
+    
+    return {
+        'status': 'success',
+        'hours': hours,
+        'format': fmt,
+        'comparison': comparison
+    }
 
 
 def get_suggestions(level):
@@ -216,35 +552,17 @@ def get_suggestions(level):
     return suggestions.get(level, suggestions['moderate'])
 
 
-def train_ml_models():
-    """Huấn luyện ML models với dữ liệu gần đây"""
-    try:
-        client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, database=INFLUXDB_DB)
-        
-        # Lấy 7 ngày dữ liệu
-        query = '''
-            SELECT mean(pm2_5) as pm2_5 FROM air_quality 
-            WHERE time > now() - 7d
-            GROUP BY time(1h) fill(null)
-        '''
-        
-        result = client.query(query)
-        points = list(result.get_points())
-        client.close()
-        
-        pm25_values = [p['pm2_5'] for p in points if p['pm2_5'] is not None]
-        
-        if len(pm25_values) > 24:
-            lstm_predictor.fit(pm25_values)
-            anomaly_detector.fit(pm25_values)
-            logger.info(f"✓ ML models trained with {len(pm25_values)} data points")
-        
-    except Exception as e:
-        logger.error(f"Error training ML models: {e}")
+def hourly_pm25(since, until):
+    """{node_id: mảng pm2_5} các bucket 1h trong [since, until) (dữ liệu huấn luyện của model_trainer)"""
+    result = query_aggregated(influx, ['pm2_5'], '1h', f"time >= {since}s AND time < {until}s",
+                              group_by='node_id', epoch='s')
+    return {node_id: series.present('pm2_5')['pm2_5']
+            for node_id, series in from_resultset(result, ['pm2_5'], 'node_id').items()}
 
 
-# Train models khi khởi động
-train_ml_models()
+# Huấn luyện nền theo lịch (1 trainer cho mọi worker), handler chỉ chạy inference
+model_trainer = ModelTrainer(model_store, hourly_pm25, forecasts=forecast_store)
+model_trainer.start()
 
 
 # ============ API ENDPOINTS ============
@@ -260,113 +578,98 @@ def get_current():
     node_id = request.args.get('node_id', 'node1')
     
     try:
-        client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, database=INFLUXDB_DB)
+        point = get_latest_point(node_id)
         
-        query = f'''
-            SELECT last(pm1_0) as pm1_0, last(pm2_5) as pm2_5, last(pm10) as pm10, last(aqi) as aqi
-            FROM air_quality 
-            WHERE node_id = '{node_id}' 
-            AND time > now() - 10m
-        '''
-        
-        result = client.query(query)
-        points = list(result.get_points())
-        client.close()
-        
-        if not points:
+        if not point:
             return jsonify({'status': 'error', 'message': 'No data available'}), 404
         
-        point = points[0]
-        
-        pm1_0 = point.get('pm1_0', 0) or 0
-        pm2_5 = point.get('pm2_5', 0) or 0
-        pm10 = point.get('pm10', 0) or 0
-        aqi = point.get('aqi') or calculate_aqi(pm2_5)
-        
-        level, level_info = get_level(aqi)
-        
-        # Anomaly detection
-        is_anomaly, anomaly_score = anomaly_detector.detect(pm2_5)
+        return jsonify(current_payload(node_id, point))
         
-        data = {
-            'status': 'success',
-            'node_id': node_id,
-            'timestamp': datetime.now(VN_TZ).isoformat(),
-            'pm1_0': round(pm1_0, 1),
-            'pm2_5': round(pm2_5, 1),
-            'pm10': round(pm10, 1),
-            'aqi': aqi,
-            'level': level,
-            'level_info': {
-                **level_info,
-                'suggestions': get_suggestions(level)
-            },
-            'anomaly': {
-                'is_anomaly': bool(is_anomaly),
-                'score': float(anomaly_score),
-                'message': '⚠️ Giá trị bất thường!' if is_anomaly else 'Bình thường'
-            },
-            'standards': STANDARDS
-        }
-        
-        return jsonify(data)
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/api/current/batch')
+def get_current_batch():
+    """Dữ liệu hiện tại của nhiều node trong 1 request (?node_ids=node1,node2; bỏ trống = tất cả)"""
+    node_ids = parse_node_ids(request.args.get('node_ids'), BATCH_MAX_NODES)
+    
+    try:
+        return jsonify(current_batch_payload(get_latest_points(node_ids), node_ids))
         
     except Exception as e:
         logger.error(f"Error: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+@app.route('/api/stream')
+def stream():
+    """
+    Server-Sent Events: reading mới / đổi mức AQI / bất thường theo node, ngay khi nhận MQTT
+    ?node_ids=node1,node2 để lọc; Last-Event-ID (EventSource tự gửi khi kết nối lại) => chỉ gửi phần thay đổi
+    """
+    node_ids = parse_node_ids(request.args.get('node_ids'))
+    
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    since = int(last_id) if last_id and last_id.isdigit() else None
+    
+    try:
+        sub = live_hub.subscribe(node_ids, since_generation=since)
+    except RuntimeError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 503
+    
+    def generate():
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while True:
+                events = sub.get(timeout=KEEPALIVE_INTERVAL)
+                if events is None:
+                    break
+                if not events:
+                    yield ": keepalive\n\n"
+                    continue
+                for event in events:
+                    yield format_sse('level' if event['level_changed'] else 'reading',
+                                     event, event['generation'])
+        finally:
+            live_hub.unsubscribe(sub)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # nginx không buffer stream
+    })
+
+
 @app.route('/api/history')
 def get_history():
-    """Lấy lịch sử dữ liệu"""
+    """
+    Lấy lịch sử dữ liệu
+    ?since=<cursor> (epoch giây hoặc ISO): chỉ trả các bucket từ since trở đi (delta), client giữ phần trước
+    ETag / If-None-Match: 304 nếu dữ liệu không đổi
+    """
     node_id = request.args.get('node_id', 'node1')
     hours = int(request.args.get('hours', 24))
     
     try:
-        client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, database=INFLUXDB_DB)
-        
-        # Group by 5 phút
-        query = f'''
-            SELECT mean(pm1_0) as pm1_0, mean(pm2_5) as pm2_5, mean(pm10) as pm10, mean(aqi) as aqi
-            FROM air_quality 
-            WHERE node_id = '{node_id}' 
-            AND time > now() - {hours}h
-            GROUP BY time(5m) fill(null)
-        '''
-        
-        result = client.query(query)
-        points = list(result.get_points())
-        client.close()
+        since = parse_since(request.args.get('since'))
+        fmt = response_format()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f"Invalid parameter: {e}"}), 400
+    
+    try:
+        # Group by 5 phút (rollup 5m), bucket đã đóng lấy từ cache
+        pairs = cached_aggregated(HISTORY_FIELDS, '5m', hours, node_id=node_id).get(None, [])
+        series = from_buckets(pairs, HISTORY_FIELDS).present('pm2_5')
         
-        data = []
-        for p in points:
-            if p.get('pm2_5') is not None:
-                data.append({
-                    'time': p['time'],
-                    'time_label': datetime.fromisoformat(p['time'].replace('Z', '+00:00')).astimezone(VN_TZ).strftime('%H:%M'),
-                    'pm1_0': round(p.get('pm1_0', 0) or 0, 1),
-                    'pm2_5': round(p.get('pm2_5', 0) or 0, 1),
-                    'pm10': round(p.get('pm10', 0) or 0, 1),
-                    'aqi': int(p.get('aqi', 0) or 0)
-                })
+        etag = history_etag(series, node_id, hours, since, fmt)
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': f'"{etag}"'})
         
-        # Statistics
-        pm25_values = [d['pm2_5'] for d in data if d['pm2_5']]
-        stats = {}
-        if pm25_values:
-            stats = {
-                'pm2_5_min': min(pm25_values),
-                'pm2_5_max': max(pm25_values),
-                'pm2_5_avg': round(sum(pm25_values) / len(pm25_values), 1)
-            }
-        
-        return jsonify({
-            'status': 'success',
-            'node_id': node_id,
-            'hours': hours,
-            'data': data,
-            'statistics': stats
-        })
+        response = send_payload(
+            history_payload(series, node_id, hours, since, fmt, request.args.get('since')), fmt)
+        response.set_etag(etag)
+        return response
         
     except Exception as e:
         logger.error(f"Error: {e}")
@@ -380,63 +683,67 @@ def get_prediction():
     hours = int(request.args.get('hours', 24))
     
     try:
-        # Cập nhật model với dữ liệu mới nhất
-        client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, database=INFLUXDB_DB)
-        
-        query = f'''
-            SELECT mean(pm2_5) as pm2_5 FROM air_quality 
-            WHERE node_id = '{node_id}' AND time > now() - 7d
-            GROUP BY time(1h) fill(null)
-        '''
-        
-        result = client.query(query)
-        points = list(result.get_points())
-        client.close()
+        fmt = response_format()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f"Invalid parameter: {e}"}), 400
+    
+    try:
+        # Dự báo đã tính sẵn mỗi giờ (model_trainer), chỉ cắt theo số giờ yêu cầu
+        if forecast_store.load() is None:
+            return jsonify({
+                'status': 'error',
+                'message': 'Model đang được huấn luyện, thử lại sau'
+            }), 503
         
-        pm25_values = [p['pm2_5'] for p in points if p['pm2_5'] is not None]
+        forecast = cached_forecast(node_id, hours)
         
-        if len(pm25_values) < 24:
+        if forecast is None or not forecast[1]:
             return jsonify({
                 'status': 'error',
                 'message': 'Không đủ dữ liệu để dự báo (cần ít nhất 24 giờ)'
             }), 400
         
-        # Huấn luyện và dự báo
-        lstm_predictor.fit(pm25_values)
-        predictions = lstm_predictor.predict(hours)
+        times, predictions, aqis = forecast
         
         # Tạo dữ liệu dự báo với timestamp
         forecast_data = []
-        base_time = datetime.now(VN_TZ)
         
-        for i, pred in enumerate(predictions):
-            forecast_time = base_time + timedelta(hours=i+1)
-            aqi = calculate_aqi(pred)
-            level, level_info = get_level(aqi)
-            
-            forecast_data.append({
-                'time': forecast_time.isoformat(),
-                'time_label': forecast_time.strftime('%H:%M %d/%m'),
-                'hour': i + 1,
-                'pm2_5': pred,
-                'aqi': aqi,
-                'level': level,
-                'level_name': level_info['name'],
-                'color': level_info['color']
-            })
+        if fmt == 'rows':
+            for i, (ts, pred, aqi) in enumerate(zip(times, predictions, aqis)):
+                forecast_time = datetime.fromtimestamp(ts, VN_TZ)
+                level, level_info = get_level(aqi)
+                
+                forecast_data.append({
+                    'time': forecast_time.isoformat(),
+                    'time_label': forecast_time.strftime('%H:%M %d/%m'),
+                    'hour': i + 1,
+                    'pm2_5': pred,
+                    'aqi': aqi,
+                    'level': level,
+                    'level_name': level_info['name'],
+                    'color': level_info['color']
+                })
+        else:
+            forecast_data = {
+                'time': times,
+                'pm2_5': predictions,
+                'aqi': aqis,
+                'level': level_codes(aqis).tolist()
+            }
         
-        return jsonify({
+        return send_payload({
             'status': 'success',
             'node_id': node_id,
             'model': 'LSTM-Simple',
-            'forecast_hours': hours,
+            'forecast_hours': len(predictions),
+            'format': fmt,
             'predictions': forecast_data,
             'summary': {
-                'avg_pm2_5': round(np.mean(predictions), 1),
+                'avg_pm2_5': round(float(np.mean(predictions)), 1),
                 'max_pm2_5': round(max(predictions), 1),
                 'min_pm2_5': round(min(predictions), 1)
             }
-        })
+        }, fmt)
         
     except Exception as e:
         logger.error(f"Prediction error: {e}")
@@ -450,50 +757,51 @@ def check_anomaly():
     hours = int(request.args.get('hours', 24))
     
     try:
-        client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, database=INFLUXDB_DB)
-        
         query = f'''
             SELECT pm2_5, time FROM air_quality 
             WHERE node_id = '{node_id}' AND time > now() - {hours}h
         '''
         
-        result = client.query(query)
-        points = list(result.get_points())
-        client.close()
+        result = influx.query(query, epoch='s')
+        series = from_resultset(result, ['pm2_5']).get(None)
         
-        if not points:
+        if series is None or not len(series):
             return jsonify({'status': 'error', 'message': 'No data'}), 404
         
-        pm25_values = [p['pm2_5'] for p in points if p['pm2_5'] is not None]
-        
-        # Huấn luyện detector
-        anomaly_detector.fit(pm25_values)
-        
-        # Kiểm tra từng điểm
-        anomalies = []
-        for p in points:
-            if p['pm2_5'] is not None:
-                is_anomaly, score = anomaly_detector.detect(p['pm2_5'])
-                if is_anomaly:
-                    anomalies.append({
-                        'time': p['time'],
-                        'pm2_5': p['pm2_5'],
-                        'anomaly_score': score
-                    })
+        total_points = len(series)
+        series = series.present('pm2_5')
+        
+        # Detector đã huấn luyện của node (hoặc detector chung), chỉ chấm điểm
+        model = model_registry.get(node_id)
+        detector = model_registry.detector(node_id)
+        
+        # Z-score cả mảng, chỉ dựng dict cho 20 bất thường gần nhất
+        scores = detector.scores(series['pm2_5'])
+        mask = scores > detector.threshold
+        found = series.filter(mask)
+        recent = slice(-20, None)
+        anomalies = [
+            {'time': t, 'pm2_5': v, 'anomaly_score': z}
+            for t, v, z in zip(iso_times(found.times[recent]), found['pm2_5'][recent].tolist(),
+                               np.round(scores[mask][recent], 2).tolist())
+        ]
+        anomaly_count = int(mask.sum())
         
         return jsonify({
             'status': 'success',
             'node_id': node_id,
             'hours': hours,
-            'total_points': len(points),
-            'anomaly_count': len(anomalies),
-            'anomaly_rate': round(len(anomalies) / len(points) * 100, 1) if points else 0,
-            'anomalies': anomalies[-20:],  # 20 bất thường gần nhất
+            'total_points': total_points,
+            'anomaly_count': anomaly_count,
+            'anomaly_rate': round(anomaly_count / total_points * 100, 1),
+            'anomalies': anomalies,  # 20 bất thường gần nhất
             'detector': {
                 'type': 'Statistical Z-Score',
-                'threshold': anomaly_detector.threshold,
-                'mean': round(anomaly_detector.mean, 1),
-                'std': round(anomaly_detector.std, 1)
+                'scope': 'node' if model is not None and model.detector is detector else 'global',
+                'version': model.version if model is not None else model_registry.version(),
+                'threshold': detector.threshold,
+                'mean': round(detector.mean, 1),
+                'std': round(detector.std, 1)
             }
         })
         
@@ -508,21 +816,12 @@ def get_suggestions_api():
     node_id = request.args.get('node_id', 'node1')
     
     try:
-        client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, database=INFLUXDB_DB)
-        
-        query = f'''
-            SELECT last(pm2_5) as pm2_5 FROM air_quality 
-            WHERE node_id = '{node_id}' AND time > now() - 10m
-        '''
-        
-        result = client.query(query)
-        points = list(result.get_points())
-        client.close()
+        point = get_latest_point(node_id)
         
-        if not points:
+        if not point:
             return jsonify({'status': 'error', 'message': 'No data'}), 404
         
-        pm2_5 = points[0].get('pm2_5', 0) or 0
+        pm2_5 = point.get('pm2_5', 0) or 0
         aqi = calculate_aqi(pm2_5)
         level, level_info = get_level(aqi)
         
@@ -555,38 +854,13 @@ def compare_nodes():
     hours = int(request.args.get('hours', 24))
     
     try:
-        client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, database=INFLUXDB_DB)
-        
-        query = f'''
-            SELECT mean(pm2_5) as pm2_5, mean(pm10) as pm10, mean(aqi) as aqi
-            FROM air_quality 
-            WHERE time > now() - {hours}h
-            GROUP BY time(30m), node_id fill(null)
-        '''
-        
-        result = client.query(query)
-        client.close()
-        
-        comparison = {}
-        for key, points in result.items():
-            node_id = key[1].get('node_id', 'unknown')
-            comparison[node_id] = []
-            
-            for p in points:
-                if p.get('pm2_5') is not None:
-                    comparison[node_id].append({
-                        'time': p['time'],
-                        'time_label': datetime.fromisoformat(p['time'].replace('Z', '+00:00')).astimezone(VN_TZ).strftime('%H:%M'),
-                        'pm2_5': round(p.get('pm2_5', 0) or 0, 1),
-                        'pm10': round(p.get('pm10', 0) or 0, 1),
-                        'aqi': int(p.get('aqi', 0) or 0)
-                    })
-        
-        return jsonify({
-            'status': 'success',
-            'hours': hours,
-            'comparison': comparison
-        })
+        fmt = response_format()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f"Invalid parameter: {e}"}), 400
+    
+    try:
+        series = cached_aggregated(COMPARE_FIELDS, '30m', hours, group_by='node_id')
+        return send_payload(compare_payload(series, hours, fmt), fmt)
         
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -600,6 +874,8 @@ def health():
         'service': 'Air Quality API v5',
         'features': ['PM Only', 'LSTM Prediction', 'Anomaly Detection'],
         'standards': 'QCVN 05:2023/BTNMT',
+        'history_cache': history_cache.stats(),
+        'models': {**model_trainer.stats(), 'registry': model_registry.stats()},
         'timestamp': datetime.now(VN_TZ).isoformat()
     })
 
@@ -611,4 +887,5 @@ if __name__ == '__main__':
     logger.info("   ML: LSTM Prediction, Anomaly Detection")
     logger.info("   Standard: QCVN 05:2023/BTNMT")
     logger.info("=" * 50)
+    # Production (nhiều worker): gunicorn -c gunicorn.conf.py
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+AQI & mức chất lượng không khí dùng chung (mqtt_subscriber, api_server, notification_service)
+- Bảng breakpoint PM2.5 tính sẵn: QCVN 05:2023/BTNMT (mặc định) và US EPA (2024)
+- calculate_aqi(): 1 giá trị (bisect, dùng khi ingest)
+- aqi_array() / level_codes(): cả mảng NumPy bằng searchsorted (history, dự báo, xếp hạng)
+- 1 bảng mức duy nhất theo AQI: good / moderate / poor / bad / hazardous
+"""
+
+import os
+from bisect import bisect_left
+
+import numpy as np
+
+# ============ BREAKPOINT PM2.5 ============
+# (C_lo, C_hi, I_lo, I_hi), nội suy tuyến tính trong đoạn đầu tiên có C_lo <= C <= C_hi
+BREAKPOINTS = {
+    'qcvn': [
+        (0, 25, 0, 50),
+        (25, 50, 50, 100),
+        (50, 80, 100, 150),
+        (80, 150, 150, 200),
+        (150, 250, 200, 300),
+        (250, 500, 300, 500)
+    ],
+    # US EPA (sửa đổi 2024), nối liền các đoạn thay vì cắt 0.1 μg/m³
+    'epa': [
+        (0.0, 9.0, 0, 50),
+        (9.0, 35.4, 50, 100),
+        (35.4, 55.4, 100, 150),
+        (55.4, 125.4, 150, 200),
+        (125.4, 225.4, 200, 300),
+        (225.4, 325.4, 300, 500)
+    ]
+}
+STANDARD = os.getenv('AQI_STANDARD', 'qcvn')
+AQI_MAX = 500
+
+# ============ MỨC CHẤT LƯỢNG ============
+# (code, AQI tối đa, tên, màu, emoji)
+LEVELS = [
+    ('good', 50, 'Tốt', '#00E400', '😊'),
+    ('moderate', 100, 'Trung bình', '#FFFF00', '😐'),
+    ('poor', 150, 'Kém', '#FF7E00', '😷'),
+    ('bad', 200, 'Xấu', '#FF0000', '🚨'),
+    ('hazardous', AQI_MAX, 'Nguy hại', '#8F3F97', '☠️')
+]
+LEVEL_INFO = {code: {'name': name, 'color': color, 'emoji': emoji}
+              for code, _, name, color, emoji in LEVELS}
+
+
+class _Table:
+    """Breakpoint của 1 tiêu chuẩn dạng list (scalar) và mảng NumPy (vectorized)"""
+    def __init__(self, breakpoints):
+        self.c_lo, self.c_hi, self.i_lo, self.i_hi = (list(col) for col in zip(*breakpoints))
+        self.slope = [(ih - il) / (ch - cl) for cl, ch, il, ih in breakpoints]
+        self.arrays = tuple(np.array(col, dtype=np.float64)
+                            for col in (self.c_lo, self.c_hi, self.i_lo, self.slope))
+
+
+_TABLES = {name: _Table(bp) for name, bp in BREAKPOINTS.items()}
+_LEVEL_LIMITS = np.array([limit for _, limit, _, _, _ in LEVELS[:-1]], dtype=np.float64)
+_LEVEL_CODES = np.array([code for code, _, _, _, _ in LEVELS], dtype=object)
+
+
+def _table(standard):
+    try:
+        return _TABLES[standard or STANDARD]
+    except KeyError:
+        raise ValueError(f"Unknown AQI standard: {standard} ({', '.join(BREAKPOINTS)})")
+
+
+# ============ AQI ============
+def calculate_aqi(pm25, standard=None):
+    """AQI của 1 giá trị PM2.5"""
+    t = _table(standard)
+    if pm25 < 0:
+        return 0
+    i = bisect_left(t.c_hi, pm25)
+    if i == len(t.c_hi):
+        return AQI_MAX
+    return int(round(t.slope[i] * (pm25 - t.c_lo[i]) + t.i_lo[i]))
+
+
+def aqi_array(pm25, standard=None):
+    """AQI của cả mảng PM2.5 (float64, NaN giữ nguyên)"""
+    c_lo, c_hi, i_lo, slope = _table(standard).arrays
+    pm25 = np.asarray(pm25, dtype=np.float64)
+    i = np.minimum(np.searchsorted(c_hi, pm25, side='left'), len(c_hi) - 1)
+    aqi = np.rint(slope[i] * (pm25 - c_lo[i]) + i_lo[i])
+    aqi = np.where(pm25 > c_hi[-1], AQI_MAX, aqi)
+    return np.where(pm25 < 0, 0, aqi)
+
+
+# ============ MỨC ============
+def get_level(aqi):
+    """(code, {'name', 'color', 'emoji'}) của 1 giá trị AQI"""
+    for code, limit, _, _, _ in LEVELS:
+        if aqi <= limit:
+            return code, LEVEL_INFO[code]
+    return 'hazardous', LEVEL_INFO['hazardous']
+
+
+def level_codes(aqi):
+    """Mảng code mức của cả mảng AQI (NaN -> None)"""
+    aqi = np.asarray(aqi, dtype=np.float64)
+    codes = _LEVEL_CODES[np.searchsorted(_LEVEL_LIMITS, aqi, side='left')]
+    codes[np.isnan(aqi)] = None
+    return codes
+
+
+def level_for_pm25(pm25, standard=None):
+    """Mức chất lượng từ nồng độ PM2.5 (qua AQI của tiêu chuẩn đang dùng)"""
+    return get_level(calculate_aqi(pm25, standard))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Time-Bucketed Response Cache cho /api/history, /api/compare
+- Kết quả GROUP BY time(...) được lưu theo từng bucket (5m, 30m ...)
+- Bucket đã "đóng" (kết thúc trước now - SETTLE) được giữ lâu dài, không query lại;
+  SETTLE mặc định = LATENESS + GRACE của rollup (mẫu trễ / node xả buffer còn đổi được bucket)
+- Mỗi request chỉ query phần đuôi: từ bucket chưa đóng đầu tiên đến hiện tại
+- Bucket rỗng chỉ coi là đóng sau EMPTY_SETTLE (spool replay sau mất kết nối có thể
+  ghi bù dữ liệu cũ), bucket quá MAX_RANGE bị cắt
+- Xét riêng từng group (node của /api/compare): bucket chỉ đóng khi mọi group đã qua hạn
+  của chính nó => node trễ / chưa có dữ liệu không bị giữ bucket rỗng vĩnh viễn
+- LRU theo key (endpoint, node, interval) với giới hạn bộ nhớ
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from rollup import GRACE, LATENESS
+
+# ============ CẤU HÌNH ============
+MAX_BYTES = int(os.getenv('HISTORY_CACHE_MB', 64)) * 1024 * 1024
+SETTLE = int(os.getenv('HISTORY_CACHE_SETTLE', LATENESS + GRACE))  # giây sau khi bucket kết thúc
+EMPTY_SETTLE = int(os.getenv('HISTORY_CACHE_EMPTY_SETTLE', 6 * 3600))
+MAX_RANGE = 8 * 86400                                          # Bucket cũ hơn 8 ngày bị cắt
+
+ROW_OVERHEAD = 200    # Ước lượng byte / bucket (dict + key) để tính giới hạn bộ nhớ
+FIELD_BYTES = 40
+
+
+class _Entry:
+    """Các bucket đã đóng của 1 key: liên tục trong [lo, hi)"""
+    __slots__ = ('lo', 'hi', 'rows', 'bytes')
+
+    def __init__(self, lo):
+        self.lo = lo
+        self.hi = lo
+        self.rows = {}     # group -> {bucket_ts: row}
+        self.bytes = 0
+
+
+def _is_empty(row):
+    return all(v is None for v in row.values())
+
+
+def _row_bytes(row):
+    return ROW_OVERHEAD + FIELD_BYTES * len(row)
+
+
+class BucketCache:
+    """
+    get(key, bucket, start, fetch) -> {group: [(bucket_ts, row), ...]} (tăng dần theo thời gian)
+    fetch(since) -> {group: {bucket_ts: row}}: query các bucket từ since (epoch giây) đến hiện tại
+    """
+    def __init__(self, max_bytes=MAX_BYTES, settle=SETTLE, empty_settle=EMPTY_SETTLE,
+                 max_range=MAX_RANGE):
+        self.max_bytes = max_bytes
+        self.settle = settle
+        self.empty_settle = empty_settle
+        self.max_range = max_range
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {'requests': 0, 'cached_buckets': 0, 'fetched_buckets': 0,
+                       'full_fetches': 0, 'tail_fetches': 0, 'evictions': 0}
+
+    def get(self, key, bucket, start, fetch, now=None):
+        if now is None:
+            now = time.time()
+        start -= start % bucket
+        entry, tail, since = self._begin(key, start)
+        return self._finish(key, bucket, start, now, entry, tail, since, fetch(since))
+
+    async def aget(self, key, bucket, start, fetch, now=None):
+        """Như get() nhưng fetch là coroutine (api_async)"""
+        if now is None:
+            now = time.time()
+        start -= start % bucket
+        entry, tail, since = self._begin(key, start)
+        return self._finish(key, bucket, start, now, entry, tail, since, await fetch(since))
+
+    def _begin(self, key, start):
+        """(entry, tail, since): tail=True => chỉ cần query từ entry.hi"""
+        with self._lock:
+            self._stats['requests'] += 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            tail = entry is not None and entry.lo <= start <= entry.hi
+            return entry, tail, entry.hi if tail else start
+
+    def _finish(self, key, bucket, start, now, entry, tail, since, fetched):
+        with self._lock:
+            if not tail:
+                # Miss hoặc khoảng yêu cầu bắt đầu trước phần đã cache => thay bằng kết quả mới
+                self._drop(key)
+                entry = _Entry(start)
+                self._entries[key] = entry
+                self._stats['full_fetches'] += 1
+                self._merge(entry, fetched, bucket, now)
+            else:
+                self._stats['tail_fetches'] += 1
+                # Request khác đã cập nhật / thay entry trong lúc query => chỉ dùng kết quả để trả về
+                if self._entries.get(key) is entry and entry.hi == since:
+                    self._merge(entry, fetched, bucket, now)
+
+            result = {}
+            for group, rows in entry.rows.items():
+                result[group] = [(ts, row) for ts, row in rows.items() if ts >= start]
+            for group, rows in fetched.items():
+                # Bucket chưa đóng: chỉ dùng cho response này
+                series = result.setdefault(group, [])
+                series.extend((ts, row) for ts, row in rows.items() if ts >= entry.hi)
+            for group in result:
+                result[group].sort(key=lambda item: item[0])
+
+            self._stats['cached_buckets'] += sum(
+                1 for rows in entry.rows.values() for ts in rows if start <= ts < since)
+            self._stats['fetched_buckets'] += sum(len(rows) for rows in fetched.values())
+            self._evict()
+            return result
+
+    def _merge(self, entry, fetched, bucket, now):
+        """Chuyển các bucket đã đóng (liên tục từ entry.hi) vào cache"""
+        hi = entry.hi
+        while hi + bucket <= now and self._settled(fetched, hi, hi + bucket, now):
+            hi += bucket
+
+        for group, rows in fetched.items():
+            stored = entry.rows.setdefault(group, {})
+            for ts, row in rows.items():
+                if entry.hi <= ts < hi:
+                    stored[ts] = row
+                    entry.bytes += _row_bytes(row)
+                    self._bytes += _row_bytes(row)
+        entry.hi = hi
+
+        # Cắt bucket quá cũ
+        cutoff = now - self.max_range
+        if entry.lo < cutoff:
+            cutoff -= cutoff % bucket
+            for rows in entry.rows.values():
+                for ts in [ts for ts in rows if ts < cutoff]:
+                    size = _row_bytes(rows.pop(ts))
+                    entry.bytes -= size
+                    self._bytes -= size
+            entry.lo = min(cutoff, entry.hi)
+
+    def _settled(self, fetched, ts, end, now):
+        """Bucket ts đã đóng với mọi group: có dữ liệu => SETTLE, rỗng / chưa có => EMPTY_SETTLE"""
+        if not fetched:
+            return end + self.empty_settle <= now
+        for rows in fetched.values():
+            row = rows.get(ts)
+            wait = self.empty_settle if row is None or _is_empty(row) else self.settle
+            if end + wait > now:
+                return False
+        return True
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.bytes
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            self._drop(key)
+            self._stats['evictions'] += 1
+
+    def invalidate(self, match=None):
+        """Xóa các key mà match(key) trả True (None => xóa hết)"""
+        with self._lock:
+            for key in [k for k in self._entries if match is None or match(k)]:
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'keys': len(self._entries), 'bytes': self._bytes}
@@ -15,6 +15,7 @@
 #include <PubSubClient.h>
 #include <ArduinoJson.h>
 #include <HardwareSerial.h>
+#include <time.h>
 
 // ============ CẤU HÌNH WIFI ============
 const char* WIFI_SSID = "dvkn.thta";       // ← THAY ĐỔI
@@ -30,6 +31,16 @@ const char* MQTT_TOPIC = "airquality/sensors";
 // ============ CẤU HÌNH NODE ============
 const char* NODE_ID = "node1";  // Đổi thành "node2" cho node thứ 2
 
+// ============ CẤU HÌNH PAYLOAD ============
+// 1 = gửi payload binary v2 (header 19 byte + 12 byte / mẫu, xem payload_decoder.py), 0 = JSON
+#define USE_BINARY_PAYLOAD 0
+
+// Mất kết nối MQTT => giữ tối đa 20 mẫu (10 phút), gửi 1 lần khi kết nối lại
+#define MAX_PENDING 20
+
+// ============ CẤU HÌNH NTP ============
+const char* NTP_SERVER = "pool.ntp.org";
+
 // ============ CHÂN KẾT NỐI ============
 #define PMS_RX 16
 #define PMS_TX 17
@@ -50,6 +61,35 @@ struct PMSData {
     bool valid;
 };
 
+// Mẫu chờ gửi
+struct Sample {
+    uint32_t ts;        // epoch (UTC), 0 = chưa đồng bộ NTP
+    uint16_t pm1_0;
+    uint16_t pm2_5;
+    uint16_t pm10;
+    uint16_t aqi;
+};
+
+Sample pending[MAX_PENDING];
+int pendingCount = 0;
+
+// Payload binary v2 (little-endian), khớp BINARY_BATCH_HEADER / BINARY_SAMPLE
+// trong payload_decoder.py
+struct __attribute__((packed)) BinaryHeader {
+    uint8_t magic;      // 0xA7
+    uint8_t version;    // 2
+    char node_id[16];   // NUL padded
+    uint8_t count;
+};
+
+struct __attribute__((packed)) BinarySample {
+    uint32_t ts;
+    uint16_t pm1_0;     // μg/m³ x10
+    uint16_t pm2_5;     // μg/m³ x10
+    uint16_t pm10;      // μg/m³ x10
+    uint16_t aqi;
+};
+
 // ============ HiveMQ Cloud Root CA ============
 const char* root_ca = R"EOF(
 -----BEGIN CERTIFICATE-----
@@ -198,6 +238,86 @@ void connectMQTT() {
     Serial.printf("\n✗ MQTT failed, rc=%d\n", mqtt.state());
 }
 
+// ============ BUFFER MẪU ============
+uint32_t epochNow() {
+    time_t now = time(nullptr);
+    return now > 1577836800 ? (uint32_t)now : 0;  // Trước 2020 => chưa có NTP
+}
+
+void queueSample(const PMSData& pms, int aqi) {
+    // Chưa có NTP thì server dùng thời điểm nhận => chỉ giữ mẫu mới nhất
+    uint32_t ts = epochNow();
+    if (ts == 0) {
+        pendingCount = 0;
+    }
+    
+    if (pendingCount == MAX_PENDING) {
+        memmove(pending, pending + 1, sizeof(Sample) * (MAX_PENDING - 1));
+        pendingCount--;
+    }
+    pending[pendingCount++] = {ts, pms.pm1_0, pms.pm2_5, pms.pm10, (uint16_t)aqi};
+}
+
+void publishPending() {
+    if (pendingCount == 0) return;
+    
+    if (!mqtt.connected()) {
+        Serial.printf("✗ MQTT not connected! (%d samples pending)\n\n", pendingCount);
+        return;
+    }
+    
+    bool ok;
+#if USE_BINARY_PAYLOAD
+    uint8_t buf[sizeof(BinaryHeader) + MAX_PENDING * sizeof(BinarySample)];
+    BinaryHeader* header = (BinaryHeader*)buf;
+    memset(header, 0, sizeof(BinaryHeader));
+    header->magic = 0xA7;
+    header->version = 2;
+    strncpy(header->node_id, NODE_ID, sizeof(header->node_id));
+    header->count = pendingCount;
+    
+    BinarySample* samples = (BinarySample*)(buf + sizeof(BinaryHeader));
+    for (int i = 0; i < pendingCount; i++) {
+        samples[i] = {pending[i].ts, (uint16_t)(pending[i].pm1_0 * 10),
+                      (uint16_t)(pending[i].pm2_5 * 10), (uint16_t)(pending[i].pm10 * 10),
+                      pending[i].aqi};
+    }
+    size_t len = sizeof(BinaryHeader) + pendingCount * sizeof(BinarySample);
+    ok = mqtt.publish(MQTT_TOPIC, buf, len);
+#else
+    DynamicJsonDocument doc(2048);
+    doc["node_id"] = NODE_ID;
+    if (pendingCount == 1) {
+        doc["pm1_0"] = pending[0].pm1_0;
+        doc["pm2_5"] = pending[0].pm2_5;
+        doc["pm10"] = pending[0].pm10;
+        doc["aqi"] = pending[0].aqi;
+        if (pending[0].ts) doc["ts"] = pending[0].ts;
+    } else {
+        JsonArray readings = doc.createNestedArray("readings");
+        for (int i = 0; i < pendingCount; i++) {
+            JsonObject r = readings.createNestedObject();
+            r["ts"] = pending[i].ts;
+            r["pm1_0"] = pending[i].pm1_0;
+            r["pm2_5"] = pending[i].pm2_5;
+            r["pm10"] = pending[i].pm10;
+            r["aqi"] = pending[i].aqi;
+        }
+    }
+    
+    char payload[2048];
+    size_t len = serializeJson(doc, payload);
+    ok = mqtt.publish(MQTT_TOPIC, payload);
+#endif
+    
+    if (ok) {
+        Serial.printf("✓ Published %d sample(s), %u bytes to %s\n\n", pendingCount, (unsigned)len, MQTT_TOPIC);
+        pendingCount = 0;
+    } else {
+        Serial.println("✗ Publish failed!\n");
+    }
+}
+
 // ============ GỬI DỮ LIỆU ============
 void sendSensorData() {
     // Đọc cảm biến PMS7003
@@ -217,28 +337,9 @@ void sendSensorData() {
         Serial.printf("║ 📊 AQI:    %3d                       ║\n", aqi);
         Serial.println("╚══════════════════════════════════════╝");
         
-        // Tạo JSON
-        StaticJsonDocument<256> doc;
-        doc["node_id"] = NODE_ID;
-        doc["pm1_0"] = pms.pm1_0;
-        doc["pm2_5"] = pms.pm2_5;
-        doc["pm10"] = pms.pm10;
-        doc["aqi"] = aqi;
-        doc["timestamp"] = millis();
-        
-        char payload[256];
-        serializeJson(doc, payload);
-        
-        // Gửi MQTT
-        if (mqtt.connected()) {
-            if (mqtt.publish(MQTT_TOPIC, payload)) {
-                Serial.printf("✓ Published to %s\n\n", MQTT_TOPIC);
-            } else {
-                Serial.println("✗ Publish failed!\n");
-            }
-        } else {
-            Serial.println("✗ MQTT not connected!\n");
-        }
+        // Lưu mẫu (kèm epoch) rồi gửi toàn bộ mẫu đang chờ trong 1 message
+        queueSample(pms, aqi);
+        publishPending();
     } else {
         Serial.println("║ ⚠️  PMS7003: No data!                ║");
         Serial.println("╚══════════════════════════════════════╝\n");
@@ -264,10 +365,13 @@ void setup() {
     // Kết nối WiFi
     connectWiFi();
     
+    // Đồng bộ thời gian (epoch UTC) để gửi timestamp theo từng mẫu
+    configTime(0, 0, NTP_SERVER);
+    
     // Cấu hình MQTT với SSL
     wifiClient.setCACert(root_ca);
     mqtt.setServer(MQTT_HOST, MQTT_PORT);
-    mqtt.setBufferSize(512);
+    mqtt.setBufferSize(2048);
     
     Serial.println("\n✓ Setup complete!");
     Serial.println("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n");
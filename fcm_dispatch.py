@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+FCM Dispatcher - gửi 1 cảnh báo đến nhiều token
+- 1 template message (notification + data + android) dựng 1 lần cho cả lượt gửi
+- Chia token thành batch multicast tối đa 500 (giới hạn của FCM),
+  nhiều batch chạy song song (ThreadPoolExecutor)
+- Giới hạn tốc độ (token bucket) tính theo request multicast: 1 lượt / batch
+  => 1 cảnh báo đến N token tốn ceil(N / 500) lượt
+- Lỗi theo token gom lại sau khi gửi: token lỗi vĩnh viễn (unregistered, sender-id-mismatch,
+  invalid-argument) trả về 1 danh sách để xóa 1 lần, không thử lại
+  (cả batch invalid-argument => lỗi ở message, không phải token => không xóa;
+   batch 1 token chỉ xóa khi message đã gửi được tới token khác trong cùng lượt)
+- send_batch thay được (LocalFcm: FCM giả lập trong máy để đo thời gian fan-out)
+
+Đo: python fcm_dispatch.py 10000   (LocalFcm, 50 ms / batch)
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from firebase_admin import messaging, exceptions as firebase_exceptions
+except ImportError:
+    messaging = None  # Chỉ dùng được với send_batch tự truyền vào (LocalFcm)
+    firebase_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH ============
+BATCH_SIZE = 500                                       # Tối đa token / multicast của FCM
+CONCURRENCY = int(os.getenv('FCM_CONCURRENCY', 8))     # Số batch gửi đồng thời
+RATE_LIMIT = float(os.getenv('FCM_RATE_LIMIT', 10))    # Batch (request multicast) / giây
+RATE_BURST = 20
+
+
+class UnregisteredToken(Exception):
+    """Lỗi token không còn đăng ký (LocalFcm; firebase dùng messaging.UnregisteredError)"""
+
+
+class InvalidToken(Exception):
+    """Token sai định dạng (LocalFcm; firebase dùng exceptions.InvalidArgumentError)"""
+
+
+class RateLimiter:
+    """Token bucket: acquire(n) chờ đến khi còn n lượt"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        # n > burst: chờ đầy bucket rồi trừ âm (lượt sau chờ bù)
+        need = min(n, self.burst)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= need:
+                    self._tokens -= n
+                    return
+                wait = (need - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def build_template(title, body, data):
+    """Phần chung của mọi message trong 1 lượt gửi (không có token)"""
+    return {
+        'title': title,
+        'body': body,
+        'data': data,
+        'android': {
+            'priority': 'high',
+            'icon': 'ic_notification',
+            'color': '#FF5722',
+            'sound': 'default',
+            'channel_id': 'air_quality_alerts'
+        }
+    }
+
+
+def _firebase_message(template):
+    """Template -> tham số messaging.MulticastMessage (dựng 1 lần, dùng cho mọi batch)"""
+    android = template['android']
+    return {
+        'notification': messaging.Notification(title=template['title'], body=template['body']),
+        'data': template['data'],
+        'android': messaging.AndroidConfig(
+            priority=android['priority'],
+            notification=messaging.AndroidNotification(
+                icon=android['icon'],
+                color=android['color'],
+                sound=android['sound'],
+                channel_id=android['channel_id']
+            )
+        )
+    }
+
+
+def firebase_send_batch(tokens, message):
+    """Gửi 1 batch qua Firebase; trả về [exception hoặc None] theo thứ tự tokens"""
+    multicast = messaging.MulticastMessage(tokens=tokens, **message)
+    # firebase_admin >= 6.2: send_each_for_multicast (send_multicast đã deprecated)
+    send = getattr(messaging, 'send_each_for_multicast', None) or messaging.send_multicast
+    response = send(multicast)
+    return [None if r.success else r.exception for r in response.responses]
+
+
+def _permanent_types():
+    types = (UnregisteredToken, InvalidToken)
+    if messaging is not None:
+        types += (messaging.UnregisteredError, messaging.SenderIdMismatchError,
+                  firebase_exceptions.InvalidArgumentError)
+    return types
+
+
+def _invalid_argument_types():
+    types = (InvalidToken,)
+    if firebase_exceptions is not None:
+        types += (firebase_exceptions.InvalidArgumentError,)
+    return types
+
+
+def is_permanent(error):
+    """Token không bao giờ gửi được nữa (xóa khỏi subscriber store, không thử lại)"""
+    return isinstance(error, _permanent_types())
+
+
+class FcmDispatcher:
+    """
+    send_batch(tokens, message) -> [exception hoặc None, ...]
+    prepare(template) -> message truyền cho send_batch (mặc định: dựng object firebase)
+    limiter: RateLimiter, acquire() trước mỗi batch (None => không giới hạn)
+    """
+    def __init__(self, send_batch=None, prepare=None, batch_size=BATCH_SIZE, concurrency=CONCURRENCY,
+                 limiter=None):
+        if send_batch is None:
+            if messaging is None:
+                raise RuntimeError("firebase_admin is not installed")
+            send_batch, prepare = firebase_send_batch, _firebase_message
+        self.send_batch = send_batch
+        self.prepare = prepare or (lambda template: template)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fcm')
+
+    def _send(self, tokens, message):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        try:
+            return self.send_batch(tokens, message)
+        except Exception as e:
+            # Cả batch lỗi (mạng, quota...): mọi token trong batch tính là thất bại
+            return [e] * len(tokens)
+
+    def dispatch(self, tokens, title, body, data):
+        """
+        Gửi đến mọi token; trả về
+        {'sent', 'failed', 'invalid': [token lỗi vĩnh viễn], 'retry': [token lỗi tạm thời],
+         'errors': {loại lỗi: số lượng}, 'batches', 'elapsed'}
+        """
+        start = time.perf_counter()
+        message = self.prepare(build_template(title, body, data))
+        batches = [tokens[i:i + self.batch_size] for i in range(0, len(tokens), self.batch_size)]
+
+        results = list(self._pool.map(lambda batch: self._send(batch, message), batches))
+        # Có token nhận được => message hợp lệ, invalid-argument lúc này là lỗi của token
+        message_ok = any(error is None for batch_errors in results for error in batch_errors)
+
+        sent = 0
+        invalid = []
+        retry = []
+        errors = {}
+        invalid_argument = _invalid_argument_types()
+        for batch, batch_errors in zip(batches, results):
+            # Mọi token của batch invalid-argument => message sai, không phải token
+            # (batch 1 token: không phân biệt được => chỉ coi là lỗi token khi message_ok)
+            message_error = (all(isinstance(e, invalid_argument) for e in batch_errors)
+                             and (len(batch) > 1 or not message_ok))
+            for token, error in zip(batch, batch_errors):
+                if error is None:
+                    sent += 1
+                    continue
+                name = type(error).__name__
+                errors[name] = errors.get(name, 0) + 1
+                if is_permanent(error) and not (message_error and isinstance(error, invalid_argument)):
+                    invalid.append(token)
+                else:
+                    retry.append(token)
+
+        return {
+            'sent': sent,
+            'failed': len(tokens) - sent,
+            'invalid': invalid,
+            'retry': retry,
+            'errors': errors,
+            'batches': len(batches),
+            'elapsed': time.perf_counter() - start
+        }
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+class LocalFcm:
+    """
+    FCM giả lập trong máy: mỗi batch mất latency giây, token trong `unregistered` / `invalid`
+    báo lỗi tương ứng
+    FcmDispatcher(send_batch=LocalFcm(...))
+    """
+    def __init__(self, latency=0.05, unregistered=(), invalid=()):
+        self.latency = latency
+        self.unregistered = set(unregistered)
+        self.invalid = set(invalid)
+        self.received = 0
+
+    def __call__(self, tokens, message):
+        time.sleep(self.latency)
+        self.received += len(tokens)
+        return [UnregisteredToken(t) if t in self.unregistered
+                else InvalidToken(t) if t in self.invalid else None for t in tokens]
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tokens = [f"token-{i}" for i in range(count)]
+    fcm = LocalFcm(unregistered=tokens[::100])
+    dispatcher = FcmDispatcher(send_batch=fcm)
+    result = dispatcher.dispatch(tokens, 'Test', 'Fan-out benchmark', {'node_id': 'node1'})
+    dispatcher.close()
+    print(f"{count} tokens: {result['sent']} sent, {len(result['invalid'])} invalid, "
+          f"{result['batches']} batches x {fcm.latency * 1000:.0f} ms, "
+          f"concurrency {dispatcher.concurrency} => {result['elapsed']:.2f}s")
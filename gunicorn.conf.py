@@ -0,0 +1,35 @@
+"""
+Gunicorn cho production: nhiều worker process (pre-fork)
+  gunicorn -c gunicorn.conf.py api_server:app                  (Flask, worker gthread)
+  GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \
+      gunicorn -c gunicorn.conf.py api_async:app               (ASGI, xem api_async.py)
+
+Trạng thái dùng chung giữa các worker (không nằm trong bộ nhớ process):
+  - Giá trị mới nhất: latest store (/dev/shm/airquality_latest, mqtt_subscriber ghi)
+  - Model: model store (/dev/shm/airquality-<uid>/models); 1 worker giữ lease trainer huấn luyện
+    và publish, các worker khác chỉ đọc. Worker trainer chết => worker khác nhận lease
+Mỗi worker có pool InfluxDB, history cache, live hub riêng.
+"""
+
+import os
+
+bind = f"{os.getenv('API_HOST', '0.0.0.0')}:{os.getenv('API_PORT', 5000)}"
+workers = int(os.getenv('API_WORKERS', os.cpu_count() or 1))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# gthread: mỗi kết nối SSE /api/stream giữ 1 thread => threads >= số client live / worker
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+
+# Không preload: mỗi worker tự import app sau khi fork (thread nền, mmap, socket không bị chia sẻ qua fork)
+preload_app = False
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Thay worker định kỳ (jitter để không restart cùng lúc); lease trainer chuyển sang worker khác
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')  # None => tắt
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
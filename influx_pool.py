@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Pooled InfluxDB Query Client
+- 1 pool dùng chung cho mọi route của api_server (và notification_service, train_ml_models)
+- Mỗi client giữ session HTTP keep-alive riêng => không tốn TCP setup mỗi request
+- Thread-safe: client được mượn / trả qua hàng đợi, mỗi lúc chỉ 1 thread dùng
+- Timeout cho từng query, retry với exponential backoff khi lỗi kết nối / lỗi server
+- AsyncInfluxClient: bản bất đồng bộ (aiohttp) cho api_async, cùng timeout / retry
+"""
+
+import asyncio
+import os
+import queue
+import time
+import logging
+from contextlib import contextmanager
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from influxdb.resultset import ResultSet
+from requests.exceptions import ConnectionError, Timeout
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH MẶC ĐỊNH ============
+POOL_SIZE = int(os.getenv('INFLUX_POOL_SIZE', 8))
+QUERY_TIMEOUT = float(os.getenv('INFLUX_QUERY_TIMEOUT', 10))   # giây
+QUERY_RETRIES = int(os.getenv('INFLUX_QUERY_RETRIES', 2))
+RETRY_BACKOFF = 0.2   # 0.2s, 0.4s, 0.8s ...
+
+RETRYABLE_ERRORS = (ConnectionError, Timeout, InfluxDBServerError)
+
+
+class InfluxQueryPool:
+    """Pool InfluxDBClient có kích thước cố định; query() tự mượn / trả client"""
+
+    def __init__(self, host, port, database, size=POOL_SIZE, timeout=QUERY_TIMEOUT,
+                 retries=QUERY_RETRIES, backoff=RETRY_BACKOFF):
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self._clients = queue.LifoQueue()
+        for _ in range(size):
+            # retries=1: retry / backoff do pool xử lý
+            self._clients.put(InfluxDBClient(
+                host=host, port=port, database=database,
+                timeout=timeout, retries=1, pool_size=1
+            ))
+
+    @contextmanager
+    def client(self):
+        """Mượn 1 client (chờ tối đa timeout giây nếu pool đang bận hết)"""
+        try:
+            client = self._clients.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Timeout(f"No InfluxDB connection available within {self.timeout}s")
+        try:
+            yield client
+        finally:
+            self._clients.put(client)
+
+    def query(self, query, timeout=None, **kwargs):
+        """client.query() với timeout riêng và retry + exponential backoff"""
+        for attempt in range(self.retries + 1):
+            try:
+                with self.client() as client:
+                    # Client đang được mượn độc quyền => đổi timeout an toàn
+                    client._timeout = timeout or self.timeout
+                    return client.query(query, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                logger.warning(f"InfluxDB query failed ({e}), retry in {delay:.1f}s")
+                time.sleep(delay)
+
+    def close(self):
+        while True:
+            try:
+                self._clients.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class AsyncInfluxClient:
+    """
+    Query InfluxDB 1.x qua HTTP /query bằng aiohttp, trả về ResultSet như InfluxDBClient.query()
+    Tối đa size kết nối đồng thời (keep-alive); session tạo lười trong event loop đang chạy
+    """
+
+    def __init__(self, host, port, database, size=POOL_SIZE, timeout=QUERY_TIMEOUT,
+                 retries=QUERY_RETRIES, backoff=RETRY_BACKOFF):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for AsyncInfluxClient (pip install aiohttp)")
+        self.url = f"http://{host}:{port}/query"
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def _query_once(self, params, timeout):
+        session = self._get_session()
+        async with session.get(self.url, params=params,
+                               timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            if resp.status >= 500:
+                raise InfluxDBServerError(await resp.text())
+            data = await resp.json(content_type=None)
+            if resp.status >= 400:
+                raise InfluxDBClientError(data.get('error', resp.reason), resp.status)
+            results = data.get('results') or [{}]
+            return ResultSet(results[0])
+
+    async def query(self, query, epoch=None, timeout=None):
+        """Như InfluxQueryPool.query() (retry + exponential backoff) nhưng không chặn thread"""
+        params = {'q': query, 'db': self.database}
+        if epoch:
+            params['epoch'] = epoch
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._query_once(params, timeout or self.timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, InfluxDBServerError) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                logger.warning(f"InfluxDB query failed ({e!r}), retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
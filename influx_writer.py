@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Batched InfluxDB Writer (write-behind)
+- Buffer giới hạn trong RAM, flush theo số điểm hoặc theo thời gian
+- Ghi từ luồng riêng => không chặn network thread của paho
+- Line protocol + gzip (1 HTTP request cho cả lô)
+- Thống kê backpressure: độ sâu buffer, số điểm bị bỏ, thời gian flush
+- Có spool (spool.py): lô ghi lỗi hoặc buffer đầy => ghi xuống đĩa thay vì bỏ
+  (điểm tràn buffer do writer thread ghi spool, paho thread không bao giờ chờ đĩa / fsync)
+"""
+
+import threading
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH MẶC ĐỊNH ============
+BATCH_SIZE = 500         # Flush khi đủ 500 điểm
+FLUSH_INTERVAL = 1.0     # ... hoặc sau 1 giây
+MAX_BUFFER = 50000       # Giới hạn buffer (điểm)
+STATS_INTERVAL = 60      # Log thống kê mỗi 60 giây
+RETRY_INTERVAL = 5       # InfluxDB lỗi => ghi thẳng vào spool trong 5 giây rồi thử lại
+
+
+# ============ LINE PROTOCOL ============
+def _escape_key(value):
+    """Escape measurement / tag key / tag value"""
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace(',', '\\,')
+            .replace('=', '\\=')
+            .replace(' ', '\\ '))
+
+
+def _format_field(value):
+    """Định dạng giá trị field theo kiểu InfluxDB"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def make_line(measurement, tags, fields, timestamp_ns):
+    """Tạo 1 dòng line protocol (timestamp tính bằng nanosecond)"""
+    key = _escape_key(measurement)
+    for k in sorted(tags):
+        key += f",{_escape_key(k)}={_escape_key(tags[k])}"
+    field_str = ','.join(
+        f"{_escape_key(k)}={_format_field(v)}"
+        for k, v in fields.items() if v is not None
+    )
+    return f"{key} {field_str} {timestamp_ns}"
+
+
+# ============ WRITER ============
+class BatchedInfluxWriter:
+    """
+    Hàng đợi ghi InfluxDB theo lô
+    write() chỉ append vào buffer (O(1)), việc ghi HTTP do writer thread đảm nhận
+    Nếu có spool: lô lỗi và điểm tràn buffer được ghi xuống đĩa, SpoolReplayer đẩy lại sau
+    """
+    def __init__(self, client, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_buffer=MAX_BUFFER, spool=None):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spool = spool
+
+        self._healthy = True
+        self._retry_at = 0.0
+
+        self._buffer = deque()
+        self._overflow = []      # Điểm tràn buffer chờ writer thread ghi spool (tối đa max_buffer)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+        self._stats = {
+            'enqueued': 0,
+            'written': 0,
+            'dropped': 0,
+            'failed': 0,
+            'spooled': 0,
+            'flushes': 0,
+            'max_depth': 0,
+            'last_flush_ms': 0.0
+        }
+
+    # ---------- Producer ----------
+    def write(self, measurement, tags, fields, timestamp_ns=None):
+        """Thêm 1 điểm vào buffer (gọi từ paho thread)"""
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+
+        with self._cond:
+            if len(self._buffer) >= self.max_buffer:
+                # Buffer đầy: chuyển điểm cũ nhất cho writer thread ghi spool (hoặc bỏ)
+                # để giữ RAM cố định; không ghi đĩa dưới lock trên paho thread
+                oldest = self._buffer.popleft()
+                if self.spool is not None and len(self._overflow) < self.max_buffer:
+                    self._overflow.append(oldest)
+                    if len(self._overflow) == 1:
+                        self._cond.notify()
+                else:
+                    self._stats['dropped'] += 1
+            self._buffer.append((measurement, tags, fields, timestamp_ns))
+            self._stats['enqueued'] += 1
+
+            depth = len(self._buffer)
+            if depth > self._stats['max_depth']:
+                self._stats['max_depth'] = depth
+            if depth >= self.batch_size:
+                self._cond.notify()
+
+    def stats(self):
+        """Thống kê backpressure hiện tại"""
+        with self._cond:
+            return {**self._stats, 'depth': len(self._buffer), 'healthy': self._healthy}
+
+    def mark_healthy(self):
+        """Replayer báo InfluxDB đã hoạt động lại"""
+        with self._cond:
+            self._healthy = True
+
+    # ---------- Lifecycle ----------
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='influx-writer', daemon=True)
+        self._thread.start()
+        logger.info(f"✓ Batched writer started (batch={self.batch_size}, "
+                    f"interval={self.flush_interval}s, buffer={self.max_buffer})")
+        return self
+
+    def close(self, timeout=10):
+        """Dừng writer thread, flush phần còn lại trong buffer"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+        logger.info(f"Writer stopped: {self.stats()}")
+
+    # ---------- Consumer ----------
+    def _take_batch(self):
+        """
+        Chờ đến khi đủ lô, có điểm tràn hoặc hết flush_interval;
+        trả về (lô, các điểm tràn cần ghi spool)
+        """
+        deadline = time.monotonic() + self.flush_interval
+        with self._cond:
+            while not self._stopped and len(self._buffer) < self.batch_size and not self._overflow:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            overflow, self._overflow = self._overflow, []
+            count = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(count)], overflow
+
+    def _spool_lines(self, lines):
+        if self.spool is None:
+            with self._cond:
+                self._stats['failed'] += len(lines)
+            return
+        try:
+            self.spool.append(lines)
+            with self._cond:
+                self._stats['spooled'] += len(lines)
+        except Exception as e:
+            logger.error(f"Spool write error ({len(lines)} points lost): {e}")
+            with self._cond:
+                self._stats['failed'] += len(lines)
+
+    def _flush(self, batch):
+        lines = [make_line(*p) for p in batch]
+
+        # InfluxDB vừa lỗi: không chờ timeout cho từng lô, ghi thẳng spool
+        with self._cond:
+            skip = not self._healthy and time.monotonic() < self._retry_at
+        if skip and self.spool is not None:
+            self._spool_lines(lines)
+            return False
+
+        start = time.monotonic()
+        try:
+            self.client.write_points(lines, protocol='line', time_precision='n')
+        except Exception as e:
+            logger.error(f"InfluxDB batch write error ({len(lines)} points): {e}")
+            with self._cond:
+                self._healthy = False
+                self._retry_at = time.monotonic() + RETRY_INTERVAL
+            self._spool_lines(lines)
+            return False
+
+        with self._cond:
+            self._healthy = True
+            self._stats['written'] += len(lines)
+            self._stats['flushes'] += 1
+            self._stats['last_flush_ms'] = round((time.monotonic() - start) * 1000, 1)
+        logger.debug(f"✓ Flushed {len(lines)} points to InfluxDB")
+        return True
+
+    def _run(self):
+        last_stats = time.monotonic()
+        while True:
+            batch, overflow = self._take_batch()
+            if overflow:
+                self._spool_lines([make_line(*p) for p in overflow])
+            if batch:
+                self._flush(batch)
+
+            if time.monotonic() - last_stats >= STATS_INTERVAL:
+                logger.info(f"📈 Writer stats: {self.stats()}")
+                last_stats = time.monotonic()
+
+            with self._cond:
+                if self._stopped and not self._buffer and not self._overflow:
+                    break
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Latest-Value Store dùng chung giữa các process (shared memory)
+- mqtt_subscriber cập nhật giá trị mới nhất của từng node ngay khi nhận MQTT
+- api_server / notification_service đọc trực tiếp (vài micro giây), không query InfluxDB
+
+Bố cục file (mmap, mặc định /dev/shm/airquality_latest):
+  Header 64 byte: magic 'AQLS' | version | số slot | generation (tăng mỗi lần ghi)
+  N slot x 128 byte: seq | node_id[32] | ts | pm1_0 | pm2_5 | pm10 | aqi | generation
+                     | pm2_5_1h | pm2_5_24h | pm10_24h | pm2_5_nowcast | aqi_24h | aqi_nowcast
+  (trung bình trượt do rolling_aqi tính; NaN / -1 = chưa có)
+Ghi: flock (nhiều worker process) + seqlock; đọc: không khóa, thử lại nếu seq lẻ / đổi.
+Đổi định dạng: file mới + os.replace (reader đang mmap file cũ không bị SIGBUS),
+shared_reader() thấy inode / header đổi thì mở lại.
+"""
+
+import os
+import mmap
+import fcntl
+import math
+import struct
+import tempfile
+import time
+import zlib
+
+# ============ CẤU HÌNH ============
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+DEFAULT_PATH = os.getenv('LATEST_STORE_PATH', os.path.join(SHM_DIR, 'airquality_latest'))
+DEFAULT_SLOTS = 1024
+
+MAGIC = b'AQLS'
+VERSION = 2   # 2: thêm trung bình trượt (file cũ được tạo lại khi subscriber khởi động)
+HEADER = struct.Struct('<4sIIxxxxQ')     # magic, version, slots, generation
+HEADER_SIZE = 64
+GENERATION_OFFSET = 16
+SLOT = struct.Struct('<I32sddddiQddddii')  # seq, node_id, ts, pm1_0, pm2_5, pm10, aqi, generation, trung bình
+SLOT_SIZE = 128
+SEQ = struct.Struct('<I')
+GEN = struct.Struct('<Q')
+READ_SPINS = 1000      # Số lần đọc lại slot đang ghi trước khi kiểm tra writer còn sống
+CHECK_INTERVAL = 1.0   # shared_reader: giây giữa 2 lần kiểm tra file có bị tạo lại
+AVERAGES = ('pm2_5_1h', 'pm2_5_24h', 'pm10_24h', 'pm2_5_nowcast', 'aqi_24h', 'aqi_nowcast')
+NO_AVERAGES = (math.nan,) * 4 + (-1, -1)
+
+
+class LatestStore:
+    """Bảng băm địa chỉ mở (linear probing) trên file mmap"""
+
+    def __init__(self, path=DEFAULT_PATH, slots=DEFAULT_SLOTS, create=False):
+        self.path = path
+        self._fd = None
+        self._mm = None
+        if create:
+            self._create(path, slots)
+
+        self._fd = os.open(path, os.O_RDWR)
+        size = os.fstat(self._fd).st_size
+        self._mm = mmap.mmap(self._fd, size)
+
+        magic, version, self.slots, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION or size != HEADER_SIZE + self.slots * SLOT_SIZE:
+            self.close()
+            raise ValueError(f"Invalid latest store file: {path}")
+
+        self._index = {}  # node_id -> slot (cache vị trí, slot không bao giờ bị xóa)
+
+    @staticmethod
+    def _valid(path):
+        """True nếu file đúng magic / version / kích thước"""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(HEADER.size)
+                size = os.fstat(f.fileno()).st_size
+        except FileNotFoundError:
+            return False
+        if len(header) != HEADER.size:
+            return False
+        magic, version, slots, _ = HEADER.unpack(header)
+        return magic == MAGIC and version == VERSION and size == HEADER_SIZE + slots * SLOT_SIZE
+
+    @classmethod
+    def _create(cls, path, slots):
+        """
+        Tạo file nếu chưa có hoặc sai định dạng (writer gọi khi khởi động)
+        Không sửa file cũ tại chỗ (reader đang mmap): ghi file mới rồi os.replace
+        """
+        lock = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if cls._valid(path):
+                return
+            fd, tmp = tempfile.mkstemp(prefix='.latest-', dir=os.path.dirname(os.path.abspath(path)))
+            try:
+                try:
+                    os.fchmod(fd, 0o644)
+                    os.ftruncate(fd, HEADER_SIZE + slots * SLOT_SIZE)
+                    os.pwrite(fd, HEADER.pack(MAGIC, VERSION, slots, 0), 0)
+                finally:
+                    os.close(fd)
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            os.close(lock)
+
+    @classmethod
+    def open(cls, path=DEFAULT_PATH):
+        """Mở để đọc; trả về None nếu subscriber chưa tạo store"""
+        try:
+            return cls(path)
+        except (OSError, ValueError):
+            return None
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def replaced(self):
+        """True nếu file tại path đã được tạo lại (inode khác) hoặc header không còn hợp lệ"""
+        try:
+            if os.stat(self.path).st_ino != os.fstat(self._fd).st_ino:
+                return True
+        except FileNotFoundError:
+            return True
+        magic, version, slots, _ = HEADER.unpack_from(self._mm, 0)
+        return magic != MAGIC or version != VERSION or slots != self.slots
+
+    # ---------- Slot ----------
+    def _slot_offset(self, i):
+        return HEADER_SIZE + i * SLOT_SIZE
+
+    def _find(self, key, insert=False):
+        """Tìm slot của node (linear probing); insert=True => trả slot trống nếu chưa có"""
+        start = zlib.crc32(key) % self.slots
+        for n in range(self.slots):
+            i = (start + n) % self.slots
+            off = self._slot_offset(i) + SEQ.size
+            stored = self._mm[off:off + 32]
+            if stored[0] == 0:
+                return i if insert else None
+            if stored.rstrip(b'\0') == key:
+                return i
+        return None
+
+    def _read_slot(self, i):
+        """
+        Đọc slot không khóa (seqlock): thử lại nếu đang có writer
+        Sau READ_SPINS lần vẫn đang ghi: không giữ được flock => writer còn sống, chờ tiếp;
+        lấy được => writer đã chết giữa 2 lần ghi seq, dùng giá trị đang có trong slot
+        """
+        off = self._slot_offset(i)
+        spins = 0
+        while True:
+            seq1 = SEQ.unpack_from(self._mm, off)[0]
+            if not seq1 & 1:
+                data = SLOT.unpack_from(self._mm, off)
+                if SEQ.unpack_from(self._mm, off)[0] == seq1:
+                    return data
+            spins += 1
+            if spins >= READ_SPINS:
+                spins = 0
+                if self._writer_dead():
+                    return SLOT.unpack_from(self._mm, off)
+                time.sleep(0.001)
+
+    def _writer_dead(self):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return True
+
+    @staticmethod
+    def _to_dict(data):
+        _, node_id, ts, pm1_0, pm2_5, pm10, aqi, generation = data[:8]
+        item = {
+            'node_id': node_id.rstrip(b'\0').decode('utf-8', errors='replace'),
+            'timestamp': ts,
+            'pm1_0': pm1_0,
+            'pm2_5': pm2_5,
+            'pm10': pm10,
+            'aqi': aqi,
+            'generation': generation
+        }
+        for name, value in zip(AVERAGES, data[8:]):
+            item[name] = None if value != value or value == -1 else value
+        return item
+
+    @staticmethod
+    def _pack_averages(averages):
+        if not averages:
+            return NO_AVERAGES
+        values = [averages.get(name) for name in AVERAGES]
+        return tuple(math.nan if v is None else float(v) for v in values[:4]) + \
+            tuple(-1 if v is None else int(v) for v in values[4:])
+
+    # ---------- Ghi ----------
+    def update(self, node_id, ts, pm1_0, pm2_5, pm10, aqi, averages=None):
+        """
+        Cập nhật giá trị mới nhất của node (bỏ qua nếu cũ hơn giá trị đang lưu)
+        averages: dict trung bình trượt (RollingAqi.averages), None => chưa có
+        """
+        key = node_id.encode('utf-8')[:32]
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            i = self._index.get(key)
+            if i is None:
+                i = self._find(key, insert=True)
+                if i is None:
+                    raise RuntimeError("Latest store is full")
+                self._index[key] = i
+
+            off = self._slot_offset(i)
+            seq, stored_key, stored_ts = SLOT.unpack_from(self._mm, off)[:3]
+            if stored_key[0] != 0 and ts < stored_ts:
+                return False
+
+            if seq & 1:
+                seq += 1   # Writer trước chết giữa chừng => đưa seq về chẵn
+            generation = GEN.unpack_from(self._mm, GENERATION_OFFSET)[0] + 1
+            SEQ.pack_into(self._mm, off, seq + 1)
+            SLOT.pack_into(self._mm, off, seq + 1, key, ts, pm1_0, pm2_5, pm10, int(aqi), generation,
+                           *self._pack_averages(averages))
+            SEQ.pack_into(self._mm, off, seq + 2)
+            GEN.pack_into(self._mm, GENERATION_OFFSET, generation)
+            return True
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    # ---------- Đọc ----------
+    def generation(self):
+        """Tăng mỗi lần có dữ liệu mới (dùng để phát hiện thay đổi)"""
+        return GEN.unpack_from(self._mm, GENERATION_OFFSET)[0]
+
+    def get(self, node_id, max_age=None):
+        """Giá trị mới nhất của node, None nếu chưa có hoặc cũ hơn max_age giây"""
+        key = node_id.encode('utf-8')[:32]
+        i = self._index.get(key)
+        if i is None:
+            i = self._find(key)
+            if i is None:
+                return None
+            self._index[key] = i
+
+        item = self._to_dict(self._read_slot(i))
+        if max_age is not None and item['timestamp'] < time.time() - max_age:
+            return None
+        return item
+
+    def all(self, max_age=None, since_generation=0):
+        """Tất cả node (lọc theo tuổi dữ liệu / generation)"""
+        cutoff = time.time() - max_age if max_age is not None else None
+        items = {}
+        for i in range(self.slots):
+            off = self._slot_offset(i) + SEQ.size
+            if self._mm[off] == 0:
+                continue
+            item = self._to_dict(self._read_slot(i))
+            if item['generation'] <= since_generation:
+                continue
+            if cutoff is not None and item['timestamp'] < cutoff:
+                continue
+            items[item['node_id']] = item
+        return items
+
+
+# ============ READER DÙNG CHUNG ============
+_reader = None
+_reader_checked = 0.0
+_reader_validated = 0.0
+
+
+def shared_reader(retry_interval=10, path=None):
+    """
+    Store đọc dùng chung trong process; None nếu chưa có (thử mở lại sau retry_interval giây)
+    Mỗi CHECK_INTERVAL giây kiểm tra file có bị tạo lại (vd. đổi định dạng) => mở file mới
+    """
+    global _reader, _reader_checked, _reader_validated
+    now = time.monotonic()
+    if _reader is not None and now - _reader_validated >= CHECK_INTERVAL:
+        _reader_validated = now
+        if _reader.replaced():
+            # Không close(): thread khác có thể đang đọc, mmap cũ được giải phóng khi hết tham chiếu
+            _reader = None
+            _reader_checked = 0.0
+    if _reader is None and now - _reader_checked >= retry_interval:
+        _reader_checked = now
+        _reader_validated = now
+        _reader = LatestStore.open(path or DEFAULT_PATH)
+    return _reader
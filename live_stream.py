@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Live Stream Hub (Server-Sent Events)
+- 1 thread theo dõi generation của latest store (mqtt_subscriber cập nhật ngay khi nhận MQTT)
+- Có dữ liệu mới => phát sự kiện cho từng client: reading mới, đổi mức AQI, cờ bất thường
+- Mỗi client có bộ lọc node riêng và hàng đợi gộp theo node: client chậm chỉ nhận
+  giá trị mới nhất của mỗi node (không dồn hàng đợi, không chặn client khác)
+- Không query InfluxDB: dashboard không cần poll 30 giây / lần nữa
+"""
+
+import json
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from latest_store import shared_reader
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH ============
+POLL_INTERVAL = float(os.getenv('LIVE_POLL_INTERVAL', 0.2))   # giây, độ trễ tối đa thêm vào
+KEEPALIVE_INTERVAL = 15                                      # comment ": keepalive" giữ kết nối qua proxy
+MAX_CLIENTS = int(os.getenv('LIVE_MAX_CLIENTS', 500))
+SNAPSHOT_MAX_AGE = 600                                       # Snapshot khi kết nối: node có dữ liệu trong 10 phút
+RETRY_MS = 3000                                              # EventSource tự kết nối lại sau 3 giây
+
+
+def format_sse(event, data, event_id=None):
+    """1 sự kiện SSE (text/event-stream)"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    """Hàng đợi của 1 client: giữ sự kiện mới nhất theo node (tối đa = số node)"""
+
+    def __init__(self, node_ids=None):
+        self.node_ids = set(node_ids) if node_ids else None
+        self.coalesced = 0
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def wants(self, node_id):
+        return self.node_ids is None or node_id in self.node_ids
+
+    def put(self, event):
+        with self._cond:
+            node_id = event['node_id']
+            old = self._pending.pop(node_id, None)
+            if old is not None:
+                # Client chưa đọc sự kiện cũ: gộp, nhưng không làm mất việc đổi mức AQI
+                self.coalesced += 1
+                if old.get('level_changed'):
+                    event = {**event, 'level_changed': True,
+                             'previous_level': old.get('previous_level')}
+            self._pending[node_id] = event
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Lấy hết sự kiện đang chờ; [] nếu hết timeout, None nếu đã đóng"""
+        with self._cond:
+            if not self._pending and not self._closed:
+                self._cond.wait(timeout)
+            if self._closed:
+                return None
+            events = list(self._pending.values())
+            self._pending.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class LiveHub:
+    """
+    enrich(item) -> dict: bổ sung level / anomaly cho 1 bản ghi của latest store
+    (api_server truyền hàm dùng get_level + detector của model store)
+    """
+    def __init__(self, enrich, reader=shared_reader, poll_interval=POLL_INTERVAL,
+                 max_clients=MAX_CLIENTS):
+        self.enrich = enrich
+        self.reader = reader
+        self.poll_interval = poll_interval
+        self.max_clients = max_clients
+
+        self._lock = threading.Lock()
+        self._subs = set()
+        self._levels = {}          # node_id -> mức AQI gần nhất (phát hiện đổi mức)
+        self._generation = 0
+        self._stats = {'events': 0, 'level_changes': 0}
+        self._thread = None
+
+    # ---------- Client ----------
+    def subscribe(self, node_ids=None, since_generation=None):
+        """
+        Đăng ký client; raise RuntimeError nếu quá MAX_CLIENTS
+        since_generation (Last-Event-ID) => gửi lại các node thay đổi sau đó, None => snapshot
+        """
+        sub = Subscription(node_ids)
+        with self._lock:
+            if len(self._subs) >= self.max_clients:
+                raise RuntimeError(f"Too many live clients ({self.max_clients})")
+            self._subs.add(sub)
+            self._ensure_started()
+
+        store = self.reader()
+        if store is not None:
+            items = store.all(max_age=SNAPSHOT_MAX_AGE, since_generation=since_generation or 0)
+            for node_id, item in sorted(items.items(), key=lambda kv: kv[1]['generation']):
+                if sub.wants(node_id):
+                    sub.put(self._event(item, track=False))
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.close()
+        with self._lock:
+            self._subs.discard(sub)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'clients': len(self._subs), 'generation': self._generation,
+                    'coalesced': sum(s.coalesced for s in self._subs)}
+
+    # ---------- Phát sự kiện ----------
+    def _event(self, item, track=True):
+        event = self.enrich(item)
+        event['level_changed'] = False
+        if track:
+            previous = self._levels.get(item['node_id'])
+            self._levels[item['node_id']] = event['level']
+            if previous is not None and previous != event['level']:
+                event['level_changed'] = True
+                event['previous_level'] = previous
+                self._stats['level_changes'] += 1
+        return event
+
+    def _poll(self):
+        store = self.reader()
+        if store is None:
+            return
+        generation = store.generation()
+        if generation == self._generation:
+            return
+        if generation < self._generation:
+            # Store được tạo lại (subscriber khởi động lại) => đọc lại từ đầu
+            self._generation = 0
+
+        items = store.all(since_generation=self._generation)
+        self._generation = generation
+        events = [self._event(item) for item in
+                  sorted(items.values(), key=lambda item: item['generation'])]
+
+        with self._lock:
+            subs = list(self._subs)
+            self._stats['events'] += len(events)
+        for event in events:
+            for sub in subs:
+                if sub.wants(event['node_id']):
+                    sub.put(event)
+
+    def _ensure_started(self):
+        """Khởi động thread theo dõi khi có client đầu tiên (gọi khi đang giữ _lock)"""
+        if self._thread is not None:
+            return
+        store = self.reader()
+        if store is not None:
+            self._generation = store.generation()
+            # Mức AQI hiện tại làm mốc để phát hiện đổi mức ngay từ sự kiện đầu tiên
+            for node_id, item in store.all().items():
+                self._levels[node_id] = self.enrich(item)['level']
+
+        def run():
+            while True:
+                try:
+                    self._poll()
+                except Exception as e:
+                    logger.error(f"Live stream poll error: {e}")
+                time.sleep(self.poll_interval)
+
+        self._thread = threading.Thread(target=run, name='live-hub', daemon=True)
+        self._thread.start()
+        logger.info(f"✓ Live stream hub started (poll {self.poll_interval}s)")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+ML models cho dự báo / phát hiện bất thường PM2.5
+- SimpleLSTMPredictor: moving average + trend + hệ số giờ cao điểm
+- IsolationForestDetector: z-score theo mean / std đã huấn luyện
+Huấn luyện ở model_trainer (process trainer), api_server chỉ gọi predict / detect
+"""
+
+from datetime import datetime
+
+import numpy as np
+
+from result_arrays import zscores
+
+
+# LSTM Model (Simple implementation - có thể thay bằng TensorFlow model)
+class SimpleLSTMPredictor:
+    """
+    Dự báo PM2.5 đơn giản dựa trên moving average và trend
+    Có thể thay bằng TensorFlow LSTM model thực sự
+    """
+    def __init__(self):
+        self.history = []
+        self.lookback = 24  # 24 giờ
+    
+    def fit(self, data):
+        """Cập nhật lịch sử"""
+        self.history = list(data)[-168:]  # Giữ 7 ngày
+    
+    def predict(self, hours=24, start=None):
+        """Dự báo PM2.5 cho n giờ tới (start: datetime giờ đầu tiên, mặc định hiện tại)"""
+        if len(self.history) < 24:
+            return []
+        
+        predictions = []
+        recent = self.history[-24:]
+        
+        # Tính trend
+        if len(self.history) >= 48:
+            trend = (np.mean(self.history[-24:]) - np.mean(self.history[-48:-24])) / 24
+        else:
+            trend = 0
+        
+        # Moving average với trend
+        base = np.mean(recent)
+        
+        for h in range(hours):
+            # Thêm pattern theo giờ trong ngày (giả lập)
+            hour_of_day = ((start or datetime.now()).hour + h) % 24
+            
+            # Rush hour factor (7-9h và 17-19h cao hơn)
+            if 7 <= hour_of_day <= 9 or 17 <= hour_of_day <= 19:
+                hour_factor = 1.15
+            elif 0 <= hour_of_day <= 5:
+                hour_factor = 0.85
+            else:
+                hour_factor = 1.0
+            
+            pred = (base + trend * h) * hour_factor
+            pred = max(5, min(300, pred))  # Giới hạn hợp lý
+            predictions.append(round(pred, 1))
+        
+        return predictions
+
+
+class IsolationForestDetector:
+    """
+    Phát hiện điểm bất thường trong dữ liệu PM2.5
+    Sử dụng statistical approach thay vì sklearn để đơn giản
+    """
+    def __init__(self):
+        self.mean = 0
+        self.std = 0
+        self.threshold = 2.5  # Z-score threshold
+    
+    def fit(self, data):
+        """Huấn luyện với dữ liệu lịch sử"""
+        if len(data) > 10:
+            self.mean = np.mean(data)
+            self.std = np.std(data)
+            if self.std == 0:
+                self.std = 1
+    
+    def detect(self, value):
+        """Kiểm tra xem giá trị có bất thường không"""
+        if self.std == 0:
+            return False, 0
+        
+        z_score = abs(value - self.mean) / self.std
+        is_anomaly = z_score > self.threshold
+        
+        return is_anomaly, round(z_score, 2)
+    
+    def scores(self, values):
+        """Z-score của cả mảng (vectorized)"""
+        return zscores(np.asarray(values, dtype=np.float64), self.mean, self.std)
+    
+    def detect_batch(self, values):
+        """Kiểm tra nhiều giá trị"""
+        values = np.asarray(values, dtype=np.float64)
+        scores = self.scores(values)
+        return [
+            {'value': v, 'is_anomaly': z > self.threshold, 'anomaly_score': round(z, 2)}
+            for v, z in zip(values.tolist(), scores.tolist())
+        ]
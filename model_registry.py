@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Model Registry theo node
+- Mỗi node 1 model riêng (lịch sử dự báo + detector mean / std của chính node),
+  lưu tại ML_MODEL_PATH/nodes/<node_id>.pkl, mỗi lần trainer ghi lại version + 1
+- Model store (/dev/shm) chỉ giữ manifest {node_id: version} + detector chung
+- Worker nạp model của node khi cần (lazy), giữ tối đa MAX_MODELS model trong LRU
+  => bộ nhớ không tăng theo số node; manifest đổi version => nạp lại file
+- Như model store: thư mục nodes 0700, file không thuộc user hoặc group / other ghi được thì không unpickle
+- Node chưa đủ dữ liệu cho detector riêng dùng detector chung (tất cả node)
+"""
+
+import os
+import pickle
+import threading
+import logging
+from collections import OrderedDict
+from urllib.parse import quote
+
+from config import Config
+from model_store import write_atomic, private_dir, _trusted
+from ml_models import SimpleLSTMPredictor, IsolationForestDetector
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH ============
+NODES_DIR = os.path.join(Config.ML_MODEL_PATH, 'nodes')
+MAX_MODELS = int(os.getenv('MODEL_CACHE_SIZE', 256))   # Model node giữ trong bộ nhớ / worker
+NODE_MIN_POINTS = 48                                   # Điểm 1h tối thiểu cho detector riêng
+
+
+# ============ LƯU TRỮ ============
+def node_path(directory, node_id):
+    return os.path.join(directory, quote(node_id, safe='') + '.pkl')
+
+
+def save_node(directory, model):
+    """Ghi model 1 node (dict: node_id, version, history, anomaly) - chỉ trainer gọi"""
+    private_dir(directory)
+    write_atomic(node_path(directory, model['node_id']), model)
+
+
+def load_node(directory, node_id):
+    """Model 1 node từ đĩa; None nếu chưa có hoặc file không tin được"""
+    try:
+        with open(node_path(directory, node_id), 'rb') as f:
+            # Kiểm tra trên file đã mở (không phải path) rồi mới unpickle
+            if not _trusted(os.fstat(f.fileno())):
+                logger.error(f"Cannot load model of {node_id}: not owned by this user "
+                             f"or writable by group / others")
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def make_detector(params):
+    """{'mean', 'std'} -> IsolationForestDetector (None nếu không có)"""
+    if not params:
+        return None
+    detector = IsolationForestDetector()
+    detector.mean = params['mean']
+    detector.std = params['std']
+    return detector
+
+
+class NodeModel:
+    """Model đã nạp của 1 node (không bị sửa sau khi tạo, dùng chung giữa các thread)"""
+    __slots__ = ('node_id', 'version', 'predictor', 'detector')
+
+    def __init__(self, model):
+        self.node_id = model['node_id']
+        self.version = model['version']
+        self.predictor = SimpleLSTMPredictor()
+        self.predictor.history = model['history']
+        self.detector = make_detector(model.get('anomaly'))
+
+
+class ModelRegistry:
+    """
+    get(node_id) -> NodeModel hoặc None (node chưa có model)
+    detector(node_id) -> detector riêng của node, hoặc detector chung
+    """
+    def __init__(self, store, directory=NODES_DIR, max_models=MAX_MODELS):
+        self.store = store
+        self.directory = directory
+        self.max_models = max_models
+
+        self._lock = threading.Lock()
+        self._models = OrderedDict()     # node_id -> NodeModel (LRU)
+        self._global = (None, IsolationForestDetector())   # (version store, detector chung)
+        self._stats = {'hits': 0, 'loads': 0, 'evictions': 0}
+
+    def ready(self):
+        """True khi trainer đã publish ít nhất 1 lần"""
+        return self.store.load() is not None
+
+    def version(self):
+        state = self.store.load()
+        return state['version'] if state else None
+
+    def get(self, node_id):
+        state = self.store.load()
+        version = (state or {}).get('nodes', {}).get(node_id)
+        if version is None:
+            return None
+
+        with self._lock:
+            model = self._models.get(node_id)
+            if model is not None and model.version == version:
+                self._models.move_to_end(node_id)
+                self._stats['hits'] += 1
+                return model
+
+        # Nạp ngoài lock (đọc file), request khác vẫn dùng model đã cache
+        data = load_node(self.directory, node_id)
+        if data is None:
+            return None
+        model = NodeModel(data)
+
+        with self._lock:
+            self._stats['loads'] += 1
+            current = self._models.get(node_id)
+            if current is None or current.version <= model.version:
+                self._models[node_id] = model
+            self._models.move_to_end(node_id)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+                self._stats['evictions'] += 1
+        return model
+
+    def global_detector(self):
+        state = self.store.load()
+        if state is None:
+            return self._global[1]
+        version, detector = self._global
+        if version != state['version']:
+            detector = make_detector(state.get('anomaly')) or IsolationForestDetector()
+            self._global = (state['version'], detector)
+        return detector
+
+    def detector(self, node_id):
+        model = self.get(node_id)
+        if model is not None and model.detector is not None:
+            return model.detector
+        return self.global_detector()
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'loaded': len(self._models), 'max_models': self.max_models}
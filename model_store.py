@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Model Store dùng chung giữa các worker process (chỉ đọc với request handler)
+- 1 process trainer (bầu bằng flock, tự chuyển sang worker khác nếu trainer chết)
+  huấn luyện rồi publish trạng thái model: ghi file tạm + os.replace (nguyên tử)
+- Worker đọc file (mặc định /dev/shm/airquality-<uid>/models) khi inode / mtime đổi,
+  kiểm tra tối đa CHECK_INTERVAL giây / lần => handler không bao giờ fit / ghi model
+- Trạng thái là dict thuần (pickle): {'version', 'trained_at', ...}, mỗi lần publish version + 1
+- File + lock nằm trong thư mục riêng 0700 của user (mặc định /dev/shm/airquality-<uid>):
+  user khác không tạo trước / thay được file mà worker sẽ unpickle, không giữ được lock trainer;
+  file không thuộc user hoặc group / other ghi được thì không nạp
+"""
+
+import os
+import stat
+import fcntl
+import pickle
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH ============
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+STORE_DIR = os.getenv('MODEL_STORE_DIR', os.path.join(SHM_DIR, f'airquality-{os.getuid()}'))
+DEFAULT_PATH = os.getenv('MODEL_STORE_PATH', os.path.join(STORE_DIR, 'models'))
+FORECAST_PATH = os.getenv('FORECAST_STORE_PATH', os.path.join(STORE_DIR, 'forecast'))
+CHECK_INTERVAL = 1.0  # giây giữa 2 lần stat() file
+
+
+def _trusted(st):
+    """Thuộc user hiện tại và group / other không ghi được"""
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def private_dir(directory):
+    """Tạo thư mục 0700 nếu chưa có; PermissionError nếu thư mục có sẵn không an toàn"""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or not _trusted(st):
+        raise PermissionError(f"Model store directory {directory} must be a directory owned by "
+                              f"uid {os.getuid()} and not writable by group / others")
+    return directory
+
+
+def write_atomic(path, obj):
+    """Pickle obj vào path: file tạm cùng thư mục + fsync + os.replace (reader không thấy file dở)"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.models-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class ModelStore:
+    def __init__(self, path=DEFAULT_PATH, check_interval=CHECK_INTERVAL):
+        self.path = path
+        private_dir(os.path.dirname(os.path.abspath(path)))
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._state = None
+        self._stamp = None       # (st_ino, st_mtime_ns, st_size) của file đã nạp
+        self._checked = 0.0
+        self._lease_fd = None
+
+    # ---------- Đọc (mọi worker) ----------
+    def load(self):
+        """Trạng thái model mới nhất (dict, không được sửa); None nếu chưa có"""
+        if time.monotonic() - self._checked < self.check_interval:
+            return self._state
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                return self._state
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if stamp != self._stamp:
+                try:
+                    with open(self.path, 'rb') as f:
+                        # Kiểm tra trên file đã mở (không phải path) rồi mới unpickle
+                        if not _trusted(os.fstat(f.fileno())):
+                            self._stamp = stamp
+                            raise PermissionError("not owned by this user or writable by group / others")
+                        self._state = pickle.load(f)
+                    self._stamp = stamp
+                except Exception as e:
+                    logger.error(f"Cannot load model store {self.path}: {e}")
+            return self._state
+
+    # ---------- Ghi (chỉ trainer) ----------
+    def publish(self, state):
+        """Ghi trạng thái mới (version tự tăng); worker thấy sau tối đa CHECK_INTERVAL giây"""
+        current = self.load() or {}
+        state = {**state, 'version': current.get('version', 0) + 1, 'trained_at': time.time()}
+        write_atomic(self.path, state)
+        self._checked = 0.0
+        return state['version']
+
+    def acquire_lease(self):
+        """
+        Thử làm trainer (flock không chặn trên <path>.lock); True nếu process này giữ lock
+        Lock tự nhả khi process chết => worker khác nhận lại ở lần thử sau
+        """
+        if self._lease_fd is not None:
+            return True
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lease_fd = fd
+        logger.info(f"✓ Model trainer lease acquired (pid {os.getpid()})")
+        return True
+
+    def age(self):
+        """Số giây từ lần publish gần nhất (inf nếu chưa có)"""
+        state = self.load()
+        if state is None:
+            return float('inf')
+        return time.time() - state['trained_at']
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Model Trainer - lập lịch huấn luyện nền (request chỉ chạy inference)
+- Huấn luyện lại toàn bộ mỗi ML_RETRAIN_INTERVAL_DAYS ngày trên TRAIN_WINDOW rollup 1h:
+  model riêng từng node (lịch sử dự báo + detector của node) và detector chung,
+  cần ít nhất ML_MIN_DATA_POINTS điểm (chưa đủ mà chưa có model => huấn luyện tạm,
+  thử lại toàn bộ ở giờ sau)
+- Cập nhật tăng dần mỗi giờ ngay khi rollup 1h đóng: chỉ query các bucket 1h mới
+  từ lần trước, chỉ ghi lại model của node có dữ liệu mới (kể cả node mới)
+- Model node: ML_MODEL_PATH/nodes/<node_id>.pkl (model_registry); manifest + detector chung:
+  ML_MODEL_PATH/models.pkl, publish vào model store (/dev/shm) cho các worker đọc
+- Sau mỗi bucket 1h mới: dự báo FORECAST_HORIZON giờ cho mọi node, publish vào
+  forecast store (/dev/shm) => /api/predict chỉ tra cứu
+- Chỉ chạy ở process giữ lease trainer (ModelStore.acquire_lease)
+"""
+
+import os
+import threading
+import time
+import logging
+from datetime import datetime
+
+import numpy as np
+
+from config import Config
+from model_store import ModelStore, private_dir
+from ml_models import SimpleLSTMPredictor, IsolationForestDetector
+from model_registry import save_node, load_node, NODE_MIN_POINTS
+from aqi import aqi_array
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH ============
+BUCKET = 3600               # Rollup 1h
+TRAIN_WINDOW = 7 * 86400    # Dữ liệu cho 1 lần huấn luyện toàn bộ
+READY_DELAY = 120           # Bucket 1h coi như đã ghi sau end + 120s (rollup đóng ở end + GRACE 60s)
+CHECK_INTERVAL = 60         # Giây giữa 2 lần kiểm tra lịch / lease
+FORECAST_HORIZON = int(os.getenv('FORECAST_HORIZON', 72))  # Số giờ dự báo tính sẵn / node
+MODEL_FILE = 'models.pkl'
+
+
+class ModelTrainer:
+    """
+    fetch(since, until) -> {node_id: mảng pm2_5 theo giờ (không NaN, tăng dần)}
+    của các bucket 1h trong [since, until) (epoch giây)
+    """
+    def __init__(self, store, fetch, forecasts=None, model_path=Config.ML_MODEL_PATH,
+                 retrain_days=Config.ML_RETRAIN_INTERVAL_DAYS,
+                 min_points=Config.ML_MIN_DATA_POINTS, check_interval=CHECK_INTERVAL):
+        self.store = store
+        self.fetch = fetch
+        self.forecasts = forecasts   # ModelStore dự báo tính sẵn (None => không tính)
+        self.model_path = model_path
+        self.node_dir = os.path.join(model_path, 'nodes')
+        self.retrain_interval = retrain_days * 86400
+        self.min_points = min_points
+        self.check_interval = check_interval
+
+        self._disk = None
+        self._thread = None
+        self._attempted = None   # until của lần huấn luyện thiếu dữ liệu gần nhất (không thử lại trong giờ)
+        self._stats = {'full': 0, 'incremental': 0, 'skipped': 0}
+
+    # ---------- Lịch ----------
+    @staticmethod
+    def closed_until(now):
+        """Đầu bucket 1h đầu tiên chưa chắc đã có rollup (epoch giây)"""
+        ready = int(now) - READY_DELAY
+        return ready - ready % BUCKET
+
+    def run_once(self, now=None):
+        """Huấn luyện nếu đến lịch; trả về 'full' / 'incremental' / None"""
+        now = now or time.time()
+        until = self.closed_until(now)
+        state = self._restore()
+
+        result = None
+        if (state is None or state.get('bootstrap')
+                or now - state['full_trained_at'] >= self.retrain_interval):
+            if (state is None and until != self._attempted) or (state and until > state['until']):
+                result = self.train_full(until, state)
+        elif until > state['until']:
+            result = self.train_incremental(until, state)
+
+        if self.forecasts is not None:
+            self.refresh_forecasts()
+        return result
+
+    def train_full(self, until, previous=None):
+        series = self.fetch(until - TRAIN_WINDOW, until)
+        values = np.concatenate(list(series.values())) if series else np.empty(0)
+        bootstrap = len(values) < self.min_points
+
+        if bootstrap and previous is not None and not previous.get('bootstrap'):
+            # Model đầy đủ cũ vẫn tốt hơn model tạm: chỉ cập nhật lịch sử dự báo
+            logger.info(f"Full retrain skipped: {len(values)} < {self.min_points} data points")
+            self._stats['skipped'] += 1
+            return self.train_incremental(until, previous)
+        if len(values) <= 24:
+            self._attempted = until
+            self._stats['skipped'] += 1
+            return None
+
+        versions = dict(previous['nodes']) if previous else {}
+        for node_id, node_values in series.items():
+            versions[node_id] = self._save_node(node_id, node_values.tolist(), versions.get(node_id, 0),
+                                                fit_detector=True)
+
+        self._publish({
+            'anomaly': self._fit_detector(values),
+            'nodes': versions,
+            'until': until,
+            'full_trained_at': time.time(),
+            'bootstrap': bootstrap
+        })
+        self._stats['full'] += 1
+        logger.info(f"✓ ML models trained with {len(values)} data points ({len(series)} nodes"
+                    f"{', bootstrap' if bootstrap else ''})")
+        return 'full'
+
+    def train_incremental(self, until, state):
+        """Nối các bucket 1h mới (state['until'] -> until) vào lịch sử của từng node"""
+        since = max(state['until'], until - TRAIN_WINDOW)
+        series = self.fetch(since, until)
+
+        versions = dict(state['nodes'])
+        for node_id, node_values in series.items():
+            if not len(node_values):
+                continue
+            model = load_node(self.node_dir, node_id) if node_id in versions else None
+            history = model['history'] if model else []
+            versions[node_id] = self._save_node(
+                node_id, history + node_values.tolist(), versions.get(node_id, 0),
+                anomaly=model.get('anomaly') if model else None)
+
+        self._publish({**state, 'nodes': versions, 'until': until})
+        self._stats['incremental'] += 1
+        logger.info(f"✓ ML models updated with {(until - since) // BUCKET}h of new rollups "
+                    f"({len(series)} nodes)")
+        return 'incremental'
+
+    # ---------- Model ----------
+    @staticmethod
+    def _fit_detector(values):
+        detector = IsolationForestDetector()
+        detector.fit(values)
+        return {'mean': float(detector.mean), 'std': float(detector.std), 'points': int(len(values))}
+
+    def _save_node(self, node_id, values, version, anomaly=None, fit_detector=False):
+        """
+        Ghi model mới của node (version + 1); detector riêng fit lại khi huấn luyện toàn bộ,
+        hoặc lần đầu node đủ NODE_MIN_POINTS điểm
+        """
+        predictor = SimpleLSTMPredictor()
+        predictor.fit(values)
+        if (fit_detector or anomaly is None) and len(predictor.history) >= NODE_MIN_POINTS:
+            anomaly = self._fit_detector(predictor.history)
+        elif fit_detector:
+            anomaly = None
+        save_node(self.node_dir, {
+            'node_id': node_id,
+            'version': version + 1,
+            'history': predictor.history,
+            'anomaly': anomaly,
+            'trained_at': time.time()
+        })
+        return version + 1
+
+    # ---------- Dự báo tính sẵn ----------
+    def refresh_forecasts(self):
+        """
+        Dự báo FORECAST_HORIZON giờ cho mọi node, 1 lần mỗi khi model có bucket 1h mới
+        (hoặc forecast store trống sau khi khởi động lại); /api/predict chỉ cắt theo ?hours
+        """
+        state = self.store.load()
+        if state is None:
+            return False
+        start = state['until']
+        if (self.forecasts.load() or {}).get('start') == start:
+            return False
+
+        # Phần tử i: giờ bắt đầu start + (i + 1) * BUCKET
+        first_hour = datetime.fromtimestamp(start + BUCKET)
+        nodes = {}
+        for node_id in state['nodes']:
+            model = load_node(self.node_dir, node_id)
+            if model is None:
+                continue
+            predictor = SimpleLSTMPredictor()
+            predictor.history = model['history']
+            values = predictor.predict(FORECAST_HORIZON, start=first_hour)
+            if values:
+                nodes[node_id] = {'pm2_5': [float(v) for v in values],
+                                  'aqi': aqi_array(values).astype(np.int64).tolist()}
+
+        self.forecasts.publish({'start': start, 'horizon': FORECAST_HORIZON, 'nodes': nodes})
+        logger.info(f"✓ Forecasts precomputed for {len(nodes)} nodes ({FORECAST_HORIZON}h)")
+        return True
+
+    # ---------- Lưu trữ ----------
+    def _disk_store(self):
+        if self._disk is None:
+            # 0700 như model store /dev/shm (makedirs mặc định theo umask => private_dir từ chối)
+            private_dir(self.model_path)
+            self._disk = ModelStore(os.path.join(self.model_path, MODEL_FILE), check_interval=0)
+        return self._disk
+
+    def _restore(self):
+        """Trạng thái hiện tại; model store trống (máy khởi động lại) => nạp từ ML_MODEL_PATH"""
+        state = self.store.load()
+        if state is None or 'nodes' not in state:
+            saved = self._disk_store().load()
+            if saved is not None and 'nodes' in saved:
+                self.store.publish(saved)
+                logger.info(f"✓ ML models restored from {self._disk.path}")
+                state = saved
+            else:
+                state = None  # Chưa có hoặc định dạng cũ => huấn luyện lại toàn bộ
+        return state
+
+    def _publish(self, state):
+        self._disk_store().publish(state)
+        self.store.publish(state)
+
+    # ---------- Thread nền ----------
+    def start(self):
+        """
+        Thread nền ở mọi worker: process giữ được lease trainer chạy lịch huấn luyện,
+        các process khác thử nhận lease mỗi CHECK_INTERVAL giây (trainer chết => chuyển)
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                try:
+                    if self.store.acquire_lease():
+                        self.run_once()
+                except Exception as e:
+                    logger.error(f"Model trainer error: {e}")
+                time.sleep(self.check_interval)
+
+        self._thread = threading.Thread(target=run, name='model-trainer', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        state = self.store.load() or {}
+        forecasts = (self.forecasts.load() if self.forecasts is not None else None) or {}
+        return {**self._stats, 'version': state.get('version'), 'until': state.get('until'),
+                'bootstrap': state.get('bootstrap'), 'forecast_start': forecasts.get('start')}
@@ -7,12 +7,24 @@ Loại bỏ: CO2, CO, NH4, VOC (không có MQ135)
 
 import paho.mqtt.client as mqtt
 from influxdb import InfluxDBClient
-import json
 import ssl
 import time
 import logging
-from datetime import datetime
-import pytz
+import os
+import re
+import zlib
+import queue
+import signal
+import threading
+import multiprocessing
+
+from influx_writer import BatchedInfluxWriter
+from payload_decoder import PayloadDecoder, InvalidPayload, JSON_BACKEND
+from rollup import RollupEngine, measurement_for, backfill
+from rolling_aqi import RollingAqi
+from latest_store import LatestStore
+from spool import DiskSpool, SpoolReplayer
+from aqi import calculate_aqi
 
 # ============ CẤU HÌNH ============
 # HiveMQ Cloud
@@ -27,8 +39,23 @@ INFLUXDB_HOST = "localhost"
 INFLUXDB_PORT = 8086
 INFLUXDB_DB = "airquality"
 
-# Timezone
-VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+# Batched writer: flush mỗi 500 điểm hoặc mỗi 1 giây
+INFLUX_BATCH_SIZE = 500
+INFLUX_FLUSH_INTERVAL = 1.0
+INFLUX_BUFFER_MAX = 50000
+INFLUX_TIMEOUT = 5  # giây
+
+# Spool trên đĩa khi InfluxDB lỗi / chậm
+SPOOL_DIR = "./spool"
+
+# Multi-process ingestion
+# - shared: MQTT v5 shared subscription ($share/<group>/topic), broker chia tải
+# - hash:   mỗi worker nhận mọi message, chỉ xử lý node có crc32(node_id) % N == index
+SUBSCRIBER_WORKERS = int(os.getenv('SUBSCRIBER_WORKERS', 1))
+PARTITION_MODE = os.getenv('SUBSCRIBER_PARTITION', 'shared')
+MQTT_SHARE_GROUP = os.getenv('MQTT_SHARE_GROUP', 'airquality-ingest')
+STATS_INTERVAL = 60  # giây
+WORKER_STOP_TIMEOUT = 30  # giây chờ worker flush sau SIGTERM trước khi kill
 
 # Logging
 logging.basicConfig(
@@ -41,108 +68,255 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# InfluxDB client
+# InfluxDB client + batched writer + spool
 influx_client = None
+influx_writer = None
+spool_replayer = None
+rollup_engine = None
+rolling_aqi = None
+latest_store = None
 
-# ============ TÍNH AQI THEO QCVN ============
-def calculate_aqi(pm25):
-    """Tính AQI theo QCVN 05:2023/BTNMT"""
-    breakpoints = [
-        (0, 25, 0, 50),
-        (25, 50, 50, 100),
-        (50, 80, 100, 150),
-        (80, 150, 150, 200),
-        (150, 250, 200, 300),
-        (250, 500, 300, 500)
-    ]
-    
-    for c_lo, c_hi, i_lo, i_hi in breakpoints:
-        if c_lo <= pm25 <= c_hi:
-            aqi = ((i_hi - i_lo) / (c_hi - c_lo)) * (pm25 - c_lo) + i_lo
-            return int(round(aqi))
-    return 500 if pm25 > 500 else 0
+# Worker hiện tại (mỗi process có bản riêng)
+worker_index = 0
+worker_count = 1
+subscribe_topic = MQTT_TOPIC
+ingest_stats = {'messages': 0, 'readings': 0, 'errors': 0, 'skipped': 0, 'rejected': 0}
+payload_decoder = PayloadDecoder()
+NODE_ID_RE = re.compile(rb'"node_id"\s*:\s*"([^"]*)"')
 
 # ============ MQTT CALLBACKS ============
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
-        logger.info("✓ Connected to HiveMQ Cloud")
-        client.subscribe(MQTT_TOPIC)
-        logger.info(f"✓ Subscribed to {MQTT_TOPIC}")
+        logger.info(f"✓ [worker {worker_index}] Connected to HiveMQ Cloud")
+        client.subscribe(subscribe_topic)
+        logger.info(f"✓ [worker {worker_index}] Subscribed to {subscribe_topic}")
     else:
         logger.error(f"✗ Connection failed, code: {rc}")
 
+def owns_message(raw):
+    """Hash partitioning: worker chỉ xử lý các node có crc32(node_id) % N == index"""
+    if worker_count <= 1 or PARTITION_MODE != 'hash':
+        return True
+    if raw[:1] == b'\xa7':
+        # Binary payload: node_id nằm ở byte 2..17
+        node_id = raw[2:18].rstrip(b'\0')
+    else:
+        match = NODE_ID_RE.search(raw)
+        node_id = match.group(1) if match else b'unknown'
+    return zlib.crc32(node_id) % worker_count == worker_index
+
 def on_message(client, userdata, msg):
-    global influx_client
+    global influx_writer
+    
+    if not owns_message(msg.payload):
+        ingest_stats['skipped'] += 1
+        return
     
     try:
-        payload = json.loads(msg.payload.decode())
+        # JSON (msgspec/orjson) hoặc binary, 1 hoặc nhiều bản ghi, timestamp do node gửi
+        # Bản ghi thiếu trường / vượt ngưỡng bị loại
+        readings = payload_decoder.decode(msg.payload)
         
-        node_id = payload.get('node_id', 'unknown')
-        pm1_0 = float(payload.get('pm1_0', 0))
-        pm2_5 = float(payload.get('pm2_5', 0))
-        pm10 = float(payload.get('pm10', 0))
-        
-        # Tính AQI
-        aqi = payload.get('aqi') or calculate_aqi(pm2_5)
-        
-        # Log
-        logger.info(f"📊 {node_id}: PM1.0={pm1_0}, PM2.5={pm2_5}, PM10={pm10}, AQI={aqi}")
-        
-        # Lưu vào InfluxDB
-        json_body = [{
-            "measurement": "air_quality",
-            "tags": {
-                "node_id": node_id
-            },
-            "time": datetime.now(VN_TZ).isoformat(),
-            "fields": {
-                "pm1_0": pm1_0,
-                "pm2_5": pm2_5,
-                "pm10": pm10,
+        latest = None
+        for reading in readings:
+            # Tính AQI
+            aqi = reading.aqi if reading.aqi is not None else calculate_aqi(reading.pm2_5)
+            
+            fields = {
+                "pm1_0": reading.pm1_0,
+                "pm2_5": reading.pm2_5,
+                "pm10": reading.pm10,
                 "aqi": aqi
             }
-        }]
+            
+            # Đưa vào buffer, writer thread sẽ ghi InfluxDB theo lô
+            if influx_writer:
+                influx_writer.write("air_quality", {"node_id": reading.node_id}, fields, reading.ts_ns)
+            
+            # Cập nhật rollup 1m / 5m / 1h
+            if rollup_engine:
+                rollup_engine.add(reading.node_id, reading.ts_ns, fields)
+            
+            # Trung bình trượt 1h / 24h / NowCast (O(1) / bản ghi)
+            if rolling_aqi is not None:
+                rolling_aqi.add(reading.node_id, reading.ts_ns / 1e9, reading.pm2_5, reading.pm10)
+            
+            if latest is None or reading.ts_ns >= latest[0].ts_ns:
+                latest = (reading, aqi)
         
-        if influx_client:
-            influx_client.write_points(json_body)
-            logger.debug("✓ Saved to InfluxDB")
+        # Giá trị mới nhất => shared memory cho API / notification service
+        if latest_store:
+            newest, newest_aqi = latest
+            averages = rolling_aqi.averages(newest.node_id, newest.ts_ns / 1e9) if rolling_aqi else None
+            latest_store.update(newest.node_id, newest.ts_ns / 1e9, newest.pm1_0,
+                                newest.pm2_5, newest.pm10, newest_aqi, averages)
+        
+        # Log
+        last = readings[-1]
+        if len(readings) == 1:
+            logger.info(f"📊 {last.node_id}: PM1.0={last.pm1_0}, PM2.5={last.pm2_5}, "
+                        f"PM10={last.pm10}, AQI={aqi}")
+        else:
+            logger.info(f"📊 {last.node_id}: {len(readings)} readings, "
+                        f"latest PM2.5={last.pm2_5}, AQI={aqi}")
+        ingest_stats['messages'] += 1
+        ingest_stats['readings'] += len(readings)
         
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
+    except InvalidPayload as e:
+        ingest_stats['rejected'] += 1
+        logger.warning(f"Rejected payload on {msg.topic}: {e}")
     except Exception as e:
+        ingest_stats['errors'] += 1
         logger.error(f"Error processing message: {e}")
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     logger.warning(f"Disconnected from MQTT broker (rc={rc})")
     if rc != 0:
         logger.info("Attempting to reconnect...")
 
-# ============ MAIN ============
-def main():
-    global influx_client
+# ============ WORKER ============
+def ensure_database():
+    """Tạo database nếu chưa có (gọi lại khi InfluxDB hoạt động trở lại)"""
+    influx_client.create_database(INFLUXDB_DB)
+
+def backfill_rollups(until):
+    """Rollup cho dữ liệu raw có trước khi rollup engine chạy lần đầu (API đọc rollup trước raw)"""
+    try:
+        if backfill(influx_client, until):
+            logger.info("✓ Rollup backfill complete")
+    except Exception as e:
+        logger.warning(f"Rollup backfill stopped: {e} (continues on next start)")
+
+def seed_rolling_aqi(engine):
+    """
+    Nạp trung bình trượt khi khởi động từ rollup (không đọc raw): 24 dòng 1h + 60 dòng 1m / node
+    Gộp mọi worker (GROUP BY node_id, sum / count); hash mode chỉ nạp node của worker này
+    Shared mode: nạp đủ lịch sử của mọi node, worker chỉ nhận ~1/N message live
+    => RollingAqi(weight=N) để lịch sử và mẫu live cùng trọng số
+    """
+    def owned(node_id):
+        if worker_count <= 1 or PARTITION_MODE != 'hash':
+            return True
+        return zlib.crc32(node_id.encode('utf-8')) % worker_count == worker_index
     
-    logger.info("=" * 50)
-    logger.info("🌬️ Air Quality MQTT Subscriber")
-    logger.info("   Sensors: PMS7003 (PM1.0, PM2.5, PM10)")
-    logger.info("   Standard: QCVN 05:2023/BTNMT")
-    logger.info("=" * 50)
+    def rows(tier, window):
+        result = influx_client.query(
+            f"SELECT sum(pm2_5_sum) AS pm2_5, sum(pm10_sum) AS pm10, sum(count) AS count "
+            f"FROM {measurement_for(tier)} WHERE time > now() - {window} "
+            f"GROUP BY time({tier}), node_id fill(none)", epoch='s')
+        for key, series in result.items():
+            node_id = key[1].get('node_id')
+            if node_id and owned(node_id):
+                for p in series:
+                    if p.get('count'):
+                        yield node_id, p['time'], (p.get('pm2_5') or 0.0, p.get('pm10') or 0.0), p['count']
+    
+    try:
+        hours = set()
+        for node_id, ts, sums, count in rows('1h', '24h'):
+            engine.seed(node_id, ts, sums, count, minutes=False)
+            hours.add((node_id, ts // 3600))
+        # Giờ chưa có rollup 1h (đang mở / vừa đóng) => lấy từ các dòng 1m
+        for node_id, ts, sums, count in rows('1m', '1h'):
+            engine.seed(node_id, ts, sums, count, hours=(node_id, ts // 3600) not in hours)
+        logger.info(f"✓ Rolling averages seeded from rollups ({len(engine)} nodes)")
+    except Exception as e:
+        logger.warning(f"Cannot seed rolling averages: {e} (starting empty)")
+
+def report_stats(stats_queue, stop_event):
+    """Gửi thống kê của worker cho supervisor mỗi STATS_INTERVAL giây"""
+    while not stop_event.wait(STATS_INTERVAL):
+        stats_queue.put((worker_index, os.getpid(), dict(ingest_stats, **{
+            f"decode_{k}": v for k, v in payload_decoder.stats.items()
+        }), influx_writer.stats()))
+
+def run_worker(index=0, count=1, stats_queue=None):
+    """Chạy 1 MQTT client + batched writer + spool (1 process)"""
+    global influx_client, influx_writer, spool_replayer, rollup_engine, rolling_aqi, latest_store
+    global worker_index, worker_count, subscribe_topic
+    
+    # Supervisor dừng / khởi động lại worker bằng SIGTERM => thoát loop_forever bình thường
+    # để finally bên dưới flush rollup / writer / spool (không mất điểm đang buffer).
+    # Cài đầu tiên: SIGTERM lúc đang khởi động => bỏ qua phần còn lại, vẫn flush
+    stop_event = threading.Event()
+    mqtt_client = None
+    
+    def stop(signum, frame):
+        stop_event.set()
+        if mqtt_client is not None:
+            mqtt_client.disconnect()
+    
+    signal.signal(signal.SIGTERM, stop)
+    
+    worker_index = index
+    worker_count = count
+    shared = count > 1 and PARTITION_MODE == 'shared'
+    subscribe_topic = f"$share/{MQTT_SHARE_GROUP}/{MQTT_TOPIC}" if shared else MQTT_TOPIC
     
     # Kết nối InfluxDB
+    influx_client = InfluxDBClient(
+        host=INFLUXDB_HOST,
+        port=INFLUXDB_PORT,
+        database=INFLUXDB_DB,
+        timeout=INFLUX_TIMEOUT,
+        gzip=True
+    )
     try:
-        influx_client = InfluxDBClient(
-            host=INFLUXDB_HOST,
-            port=INFLUXDB_PORT,
-            database=INFLUXDB_DB
-        )
-        # Tạo database nếu chưa có
-        influx_client.create_database(INFLUXDB_DB)
+        ensure_database()
         logger.info("✓ Connected to InfluxDB")
     except Exception as e:
-        logger.error(f"InfluxDB connection error: {e}")
-        return
+        # Không thoát: dữ liệu được ghi vào spool cho đến khi InfluxDB lên lại
+        logger.error(f"InfluxDB connection error: {e} (spooling to {SPOOL_DIR})")
+    
+    # Mỗi worker 1 thư mục spool riêng (segment file không dùng chung giữa các process)
+    spool_dir = SPOOL_DIR if count <= 1 else os.path.join(SPOOL_DIR, f"worker-{index}")
+    spool = DiskSpool(spool_dir)
+    influx_writer = BatchedInfluxWriter(
+        influx_client,
+        batch_size=INFLUX_BATCH_SIZE,
+        flush_interval=INFLUX_FLUSH_INTERVAL,
+        max_buffer=INFLUX_BUFFER_MAX,
+        spool=spool
+    ).start()
+    spool_replayer = SpoolReplayer(
+        influx_client, spool, writer=influx_writer, on_recover=ensure_database
+    ).start()
+    
+    # Latest-value store (shared memory) cho api_server / notification_service
+    try:
+        latest_store = LatestStore(create=True)
+    except Exception as e:
+        logger.error(f"Latest store unavailable: {e}")
     
-    # Kết nối MQTT
-    mqtt_client = mqtt.Client(client_id=f"rpi-subscriber-{int(time.time())}")
+    # Shared subscription: 1 node có thể rơi vào nhiều worker => tag worker để các
+    # cửa sổ một phần không ghi đè nhau (API gộp bằng sum / count)
+    rollup_engine = RollupEngine(
+        influx_writer.write,
+        extra_tags={'worker': str(index)} if shared else None
+    ).start()
+    
+    # Lần đầu có rollup: tạo rollup cho dữ liệu raw cũ (1 worker, chạy nền)
+    if index == 0:
+        threading.Thread(target=backfill_rollups, args=(rollup_engine.started,),
+                         name='rollup-backfill', daemon=True).start()
+    
+    # Trung bình trượt cho AQI ngày / giờ. Shared mode: worker chỉ thấy ~1/N bản ghi của node
+    # => mỗi bản ghi live tính N lần (cân với lịch sử seed đầy đủ); trung bình vẫn là ước lượng
+    # trên mẫu con, các worker ghi đè nhau trong latest store; hash mode / 1 worker: chính xác
+    rolling_aqi = RollingAqi(weight=count if shared else 1)
+    if not stop_event.is_set():
+        seed_rolling_aqi(rolling_aqi)
+    
+    if stats_queue is not None:
+        threading.Thread(target=report_stats, args=(stats_queue, stop_event),
+                         name='stats-reporter', daemon=True).start()
+    
+    # Kết nối MQTT (shared subscription cần MQTT v5)
+    client_id = f"rpi-subscriber-{int(time.time())}-{index}"
+    if shared:
+        mqtt_client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
+    else:
+        mqtt_client = mqtt.Client(client_id=client_id)
     mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
     
     # SSL/TLS
@@ -155,17 +329,115 @@ def main():
     
     # Kết nối
     try:
-        logger.info(f"🔌 Connecting to {MQTT_HOST}:{MQTT_PORT}...")
-        mqtt_client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-        mqtt_client.loop_forever()
+        if stop_event.is_set():
+            logger.info("Stopped during startup")
+        else:
+            logger.info(f"🔌 Connecting to {MQTT_HOST}:{MQTT_PORT}...")
+            mqtt_client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
+            mqtt_client.loop_forever()
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     except Exception as e:
         logger.error(f"MQTT connection error: {e}")
     finally:
+        stop_event.set()
         mqtt_client.disconnect()
+        if rollup_engine:
+            rollup_engine.close()
+        if influx_writer:
+            influx_writer.close()
+        if spool_replayer:
+            spool_replayer.close()
+            spool.close()
         if influx_client:
             influx_client.close()
 
+# ============ SUPERVISOR ============
+def run_supervisor(count):
+    """Chạy N worker process, khởi động lại worker bị chết, log tổng throughput"""
+    stats_queue = multiprocessing.Queue()
+    workers = {}
+    
+    # systemctl stop / docker stop gửi SIGTERM cho supervisor => dừng vòng lặp,
+    # finally gửi SIGTERM cho từng worker (worker tự flush) rồi chờ
+    def stop(signum, frame):
+        raise SystemExit(0)
+    
+    signal.signal(signal.SIGTERM, stop)
+    
+    def spawn(index):
+        proc = multiprocessing.Process(
+            target=run_worker, args=(index, count, stats_queue),
+            name=f"mqtt-worker-{index}", daemon=True
+        )
+        proc.start()
+        workers[index] = proc
+        logger.info(f"✓ Started worker {index} (pid={proc.pid})")
+    
+    for i in range(count):
+        spawn(i)
+    
+    latest = {}
+    received = 0                # Message mới từ lần báo cáo trước (cộng delta theo từng worker)
+    last_report = time.monotonic()
+    try:
+        while True:
+            try:
+                index, pid, ingest, writer = stats_queue.get(timeout=STATS_INTERVAL)
+                previous = latest.get(index)
+                # Worker khởi động lại (pid mới) => bộ đếm bắt đầu lại từ 0
+                base = previous[2]['messages'] if previous and previous[0] == pid else 0
+                received += max(ingest['messages'] - base, 0)
+                latest[index] = (pid, writer, ingest)
+            except queue.Empty:
+                pass
+            
+            for index, proc in list(workers.items()):
+                if not proc.is_alive():
+                    logger.error(f"Worker {index} exited (code={proc.exitcode}), restarting")
+                    spawn(index)
+            
+            now = time.monotonic()
+            if now - last_report >= STATS_INTERVAL and latest:
+                total = sum(ingest['messages'] for _, _, ingest in latest.values())
+                readings = sum(ingest['readings'] for _, _, ingest in latest.values())
+                errors = sum(ingest['errors'] for _, _, ingest in latest.values())
+                rejected = sum(ingest['rejected'] for _, _, ingest in latest.values())
+                written = sum(writer['written'] for _, writer, _ in latest.values())
+                spooled = sum(writer['spooled'] for _, writer, _ in latest.values())
+                depth = sum(writer['depth'] for _, writer, _ in latest.values())
+                rate = received / (now - last_report)
+                logger.info(f"📈 Ingest: {rate:.1f} msg/s | messages={total} readings={readings} errors={errors} rejected={rejected} "
+                            f"written={written} spooled={spooled} depth={depth} "
+                            f"workers={len(latest)}/{count}")
+                received = 0
+                last_report = now
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Shutting down workers...")
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for proc in workers.values():
+            proc.terminate()
+        for proc in workers.values():
+            proc.join(WORKER_STOP_TIMEOUT)
+            if proc.is_alive():
+                logger.error(f"{proc.name} did not stop in {WORKER_STOP_TIMEOUT}s, killing")
+                proc.kill()
+
+# ============ MAIN ============
+def main():
+    logger.info("=" * 50)
+    logger.info("🌬️ Air Quality MQTT Subscriber")
+    logger.info("   Sensors: PMS7003 (PM1.0, PM2.5, PM10)")
+    logger.info("   Standard: QCVN 05:2023/BTNMT")
+    logger.info(f"   Payload: JSON ({JSON_BACKEND}) / binary")
+    logger.info("=" * 50)
+    
+    if SUBSCRIBER_WORKERS > 1:
+        logger.info(f"   Workers: {SUBSCRIBER_WORKERS} ({PARTITION_MODE} partitioning)")
+        run_supervisor(SUBSCRIBER_WORKERS)
+    else:
+        run_worker()
+
 if __name__ == '__main__':
     main()
@@ -2,57 +2,46 @@
 """
 Firebase Push Notification Service for Air Quality Alerts
 Gửi cảnh báo khi chất lượng không khí xấu theo QCVN 05:2023/BTNMT
+- Theo sự kiện: theo dõi generation của latest store (mqtt_subscriber cập nhật khi nhận MQTT),
+  chỉ đánh giá node có bản ghi mới => cảnh báo trong < 1 giây khi vượt ngưỡng
+- Đánh giá theo PM2.5 NowCast (AQI giờ, rolling_aqi) thay vì 1 mẫu tức thời
+  => 1 mẫu nhiễu không gây cảnh báo; node chưa đủ dữ liệu dùng giá trị tức thời
+- Chỉ query InfluxDB (60 giây / lần) khi chưa có latest store
+- Gửi qua hàng đợi bền (alert_queue): Firebase chậm / lỗi không làm trễ việc đánh giá,
+  gửi lỗi được thử lại
 """
 
 import firebase_admin
-from firebase_admin import credentials, messaging
-from influxdb import InfluxDBClient
+from firebase_admin import credentials
 import time
 import logging
-import json
 import os
 from datetime import datetime
 import pytz
 
+from influx_pool import InfluxQueryPool
+from latest_store import shared_reader
+from aqi import level_for_pm25
+from fcm_dispatch import FcmDispatcher, RateLimiter, RATE_LIMIT, RATE_BURST
+from subscriber_store import SubscriberStore
+from alert_queue import AlertQueue
+
 # ============ CẤU HÌNH ============
 FIREBASE_CRED_PATH = os.path.expanduser("~/airquality_project/firebase-credentials.json")
 INFLUXDB_HOST = "localhost"
 INFLUXDB_PORT = 8086
 INFLUXDB_DB = "airquality"
 
-CHECK_INTERVAL = 60  # Kiểm tra mỗi 60 giây
+CHECK_INTERVAL = 60  # Fallback InfluxDB: kiểm tra mỗi 60 giây; nhắc lại khi vẫn ở mức cảnh báo
 ALERT_COOLDOWN = 1800  # Không gửi lại trong 30 phút
+POLL_INTERVAL = 0.2  # Giây giữa 2 lần đọc generation của latest store (độ trễ cảnh báo tối đa)
+READING_MAX_AGE = 300  # Bỏ qua bản ghi cũ hơn 5 phút (node mất kết nối)
 
-# File lưu FCM tokens
+# FCM tokens + đăng ký theo node (SQLite); file JSON cũ chỉ dùng để nhập 1 lần
+SUBSCRIBERS_DB = os.path.expanduser("~/airquality_project/subscribers.db")
+ALERT_QUEUE_DB = os.path.expanduser("~/airquality_project/alert_queue.db")
 FCM_TOKENS_FILE = os.path.expanduser("~/airquality_project/fcm_tokens.json")
 
-# ============ NGƯỠNG CẢNH BÁO THEO QCVN 05:2023/BTNMT ============
-THRESHOLDS = {
-    'pm2_5': {
-        'moderate': 25,      # Vượt TB năm
-        'poor': 50,          # Vượt TB 24h
-        'bad': 80,           # Xấu
-        'hazardous': 100     # Nguy hại
-    },
-    'pm10': {
-        'moderate': 50,
-        'poor': 100,
-        'bad': 150,
-        'hazardous': 200
-    },
-    'co2_ppm': {  # WHO Indoor
-        'moderate': 800,
-        'poor': 1000,
-        'bad': 1500,
-        'hazardous': 2000
-    },
-    'co_ppm': {  # QCVN
-        'poor': 9,
-        'bad': 15,
-        'hazardous': 26
-    }
-}
-
 # ============ SETUP LOGGING ============
 logging.basicConfig(
     level=logging.INFO,
@@ -64,9 +53,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Pool kết nối InfluxDB (giữ keep-alive giữa các lần kiểm tra)
+influx = InfluxQueryPool(INFLUXDB_HOST, INFLUXDB_PORT, INFLUXDB_DB, size=2)
+
 # ============ BIẾN TOÀN CỤC ============
 last_alert_time = {}  # {node_id: timestamp}
-fcm_tokens = []
+subscribers = None  # SubscriberStore, mở trong load_fcm_tokens()
+dispatcher = None  # FcmDispatcher, tạo sau khi khởi tạo Firebase
+alert_queue = None  # AlertQueue: đánh giá -> hàng đợi -> sender thread
+node_levels = {}  # {node_id: mức gần nhất} - phát hiện vượt ngưỡng
+last_evaluated = {}  # {node_id: lần gọi send_notification gần nhất}
 
 # ============ KHỞI TẠO FIREBASE ============
 def init_firebase():
@@ -86,63 +82,63 @@ def init_firebase():
 
 # ============ QUẢN LÝ FCM TOKENS ============
 def load_fcm_tokens():
-    """Tải danh sách FCM tokens từ file"""
-    global fcm_tokens
+    """Mở subscriber store; lần đầu nhập token từ FCM_TOKENS_FILE cũ (nhận mọi node)"""
+    global subscribers
+    subscribers = SubscriberStore(SUBSCRIBERS_DB)
     try:
-        if os.path.exists(FCM_TOKENS_FILE):
-            with open(FCM_TOKENS_FILE, 'r') as f:
-                data = json.load(f)
-                fcm_tokens = data.get('tokens', [])
-        logger.info(f"Loaded {len(fcm_tokens)} FCM tokens")
+        if subscribers.count() == 0 and os.path.exists(FCM_TOKENS_FILE):
+            imported = subscribers.import_json(FCM_TOKENS_FILE)
+            logger.info(f"Imported {imported} FCM tokens from {FCM_TOKENS_FILE}")
     except Exception as e:
-        logger.error(f"Error loading FCM tokens: {e}")
-        fcm_tokens = []
+        logger.error(f"Error importing FCM tokens: {e}")
+    logger.info(f"Loaded {subscribers.count()} FCM tokens")
 
-def save_fcm_token(token, user_id=None):
-    """Lưu FCM token mới"""
-    global fcm_tokens
-    if token not in fcm_tokens:
-        fcm_tokens.append(token)
-        try:
-            with open(FCM_TOKENS_FILE, 'w') as f:
-                json.dump({'tokens': fcm_tokens, 'updated': datetime.now().isoformat()}, f)
-            logger.info(f"Saved new FCM token: {token[:20]}...")
-        except Exception as e:
-            logger.error(f"Error saving FCM token: {e}")
+def save_fcm_token(token, user_id=None, node_ids=None, min_level=None):
+    """
+    Lưu / cập nhật FCM token
+    node_ids: chỉ nhận cảnh báo của các node này (None = mọi node)
+    min_level: chỉ nhận từ mức này trở lên (moderate / poor / bad / hazardous, None = poor)
+    """
+    try:
+        subscribers.upsert(token, node_ids=node_ids, min_level=min_level, user_id=user_id)
+        logger.info(f"Saved FCM token: {token[:20]}...")
+    except Exception as e:
+        logger.error(f"Error saving FCM token: {e}")
+
+def remove_invalid_tokens(tokens):
+    """Xóa các token không hợp lệ (1 transaction cho cả danh sách)"""
+    try:
+        subscribers.remove(tokens)
+    except Exception as e:
+        logger.error(f"Error removing FCM tokens: {e}")
 
 def remove_invalid_token(token):
     """Xóa token không hợp lệ"""
-    global fcm_tokens
-    if token in fcm_tokens:
-        fcm_tokens.remove(token)
-        try:
-            with open(FCM_TOKENS_FILE, 'w') as f:
-                json.dump({'tokens': fcm_tokens}, f)
-        except:
-            pass
+    remove_invalid_tokens([token])
 
 # ============ ĐÁNH GIÁ MỨC ĐỘ ============
 def get_air_quality_level(pm25, pm10=None, co2=None, co=None):
-    """Đánh giá mức độ chất lượng không khí theo QCVN"""
-    if pm25 > THRESHOLDS['pm2_5']['hazardous']:
-        return 'hazardous', 'Nguy hại', '☠️'
-    elif pm25 > THRESHOLDS['pm2_5']['bad']:
-        return 'bad', 'Xấu', '🚨'
-    elif pm25 > THRESHOLDS['pm2_5']['poor']:
-        return 'poor', 'Kém', '😷'
-    elif pm25 > THRESHOLDS['pm2_5']['moderate']:
-        return 'moderate', 'Trung bình', '😐'
-    else:
-        return 'good', 'Tốt', '😊'
+    """Mức cảnh báo theo AQI PM2.5 (bảng LEVELS của aqi.py, cùng bảng với api_server / dashboard)"""
+    level, info = level_for_pm25(pm25)
+    return level, info['name'], info['emoji']
+
+def alert_pm25(item):
+    """PM2.5 để đánh giá 1 bản ghi latest store: NowCast nếu có, không thì giá trị tức thời"""
+    nowcast = item.get('pm2_5_nowcast')
+    return item['pm2_5'] if nowcast is None else nowcast
 
 def should_alert(level):
     """Kiểm tra có cần gửi cảnh báo không"""
-    # Chỉ cảnh báo khi mức Kém trở lên
-    return level in ['poor', 'bad', 'hazardous']
+    # Từ mức Trung bình: send_notification chỉ đưa vào hàng đợi khi có subscriber
+    # với ngưỡng riêng <= level (mặc định Kém)
+    return level in ['moderate', 'poor', 'bad', 'hazardous']
 
 # ============ GỬI NOTIFICATION ============
 def send_notification(node_id, level, level_name, pm25, pm10, co2, emoji):
-    """Gửi push notification qua Firebase"""
+    """
+    Đưa cảnh báo vào hàng đợi gửi (sender thread gửi qua Firebase, không chặn việc đánh giá)
+    Cooldown + ngưỡng subscriber kiểm tra ở đây => cảnh báo trùng / không ai nhận không vào hàng đợi
+    """
     global last_alert_time
     
     # Kiểm tra cooldown
@@ -153,8 +149,10 @@ def send_notification(node_id, level, level_name, pm25, pm10, co2, emoji):
             logger.debug(f"Skipping alert for {node_id} (cooldown)")
             return False
     
-    if not fcm_tokens:
-        logger.warning("No FCM tokens registered")
+    # Không subscriber nào nhận mức này của node (vd. moderate với ngưỡng mặc định Kém)
+    # => không vào hàng đợi, không tính cooldown (subscriber mới vẫn nhận được sau đó)
+    if not subscribers.has_subscribers(node_id, level):
+        logger.debug(f"No subscribers for {node_id} at level {level}")
         return False
     
     # Tạo message
@@ -176,50 +174,92 @@ def send_notification(node_id, level, level_name, pm25, pm10, co2, emoji):
         'click_action': 'FLUTTER_NOTIFICATION_CLICK'
     }
     
-    # Gửi đến từng token
-    success_count = 0
-    for token in fcm_tokens[:]:
-        try:
-            message = messaging.Message(
-                notification=messaging.Notification(
-                    title=title,
-                    body=body
-                ),
-                data=data,
-                token=token,
-                android=messaging.AndroidConfig(
-                    priority='high',
-                    notification=messaging.AndroidNotification(
-                        icon='ic_notification',
-                        color='#FF5722',
-                        sound='default',
-                        channel_id='air_quality_alerts'
-                    )
-                )
-            )
-            
-            response = messaging.send(message)
-            logger.info(f"✓ Notification sent: {response}")
-            success_count += 1
-            
-        except messaging.UnregisteredError:
-            logger.warning(f"Token unregistered, removing: {token[:20]}...")
-            remove_invalid_token(token)
-        except Exception as e:
-            logger.error(f"Send error: {e}")
-    
-    if success_count > 0:
+    if alert_queue.put(node_id, level, {'node_id': node_id, 'level': level, 'title': title,
+                                        'body': body, 'data': data, 'tokens': None}):
         last_alert_time[key] = now
         return True
     
     return False
 
+def deliver_notification(alert):
+    """
+    Gửi 1 cảnh báo của hàng đợi (sender thread); trả về alert chỉ còn các token
+    lỗi tạm thời để thử lại, None nếu xong
+    """
+    # Chỉ subscriber của node này có ngưỡng riêng <= level (lần thử lại: token còn lỗi)
+    tokens = alert['tokens'] or subscribers.tokens_for(alert['node_id'], alert['level'])
+    if not tokens:
+        logger.debug(f"No subscribers for {alert['node_id']} at level {alert['level']}")
+        return None
+    
+    # Multicast theo batch 500 token, nhiều batch song song
+    result = dispatcher.dispatch(tokens, alert['title'], alert['body'], alert['data'])
+    
+    if result['invalid']:
+        # Unregistered / sender-id-mismatch / invalid-argument: không bao giờ gửi được nữa
+        logger.warning(f"{len(result['invalid'])} tokens permanently invalid, removing")
+        remove_invalid_tokens(result['invalid'])
+    if result['errors']:
+        logger.error(f"Send errors: {result['errors']}")
+    logger.info(f"✓ Notification sent to {result['sent']}/{len(tokens)} tokens "
+                f"in {result['elapsed']:.2f}s ({result['batches']} batches)")
+    
+    if result['retry']:
+        return {**alert, 'tokens': result['retry']}
+    return None
+
+def alert_dropped(node_id, level):
+    """Bỏ cảnh báo sau nhiều lần lỗi => bỏ cooldown để lần đánh giá sau thử lại"""
+    last_alert_time.pop(f"{node_id}_{level}", None)
+
 # ============ KIỂM TRA DỮ LIỆU ============
+def evaluate_node(node_id, pm25, pm10, co2, co):
+    """
+    Đánh giá 1 bản ghi của node (O(1)) và gửi cảnh báo nếu cần:
+    ngay khi đổi mức, hoặc nhắc lại tối đa mỗi CHECK_INTERVAL khi vẫn ở mức cảnh báo
+    """
+    level, level_name, emoji = get_air_quality_level(pm25, pm10, co2, co)
+    
+    previous = node_levels.get(node_id)
+    node_levels[node_id] = level
+    if level != previous:
+        logger.info(f"Node {node_id}: PM2.5={pm25:.1f}, Level={level_name}")
+    
+    # Gửi cảnh báo nếu cần
+    now = time.time()
+    if should_alert(level) and (level != previous
+                                or now - last_evaluated.get(node_id, 0) >= CHECK_INTERVAL):
+        last_evaluated[node_id] = now
+        send_notification(node_id, level, level_name, pm25, pm10, co2, emoji)
+
+
+def process_readings(store, since_generation):
+    """Đánh giá các node có bản ghi mới sau since_generation; trả về generation đã xử lý"""
+    generation = store.generation()
+    if generation == since_generation:
+        return generation
+    if generation < since_generation:
+        # Store được tạo lại (subscriber khởi động lại) => đọc lại từ đầu
+        since_generation = 0
+    
+    items = store.all(max_age=READING_MAX_AGE, since_generation=since_generation)
+    for item in sorted(items.values(), key=lambda item: item['generation']):
+        evaluate_node(item['node_id'], alert_pm25(item), item['pm10'], 0, 0)
+    return generation
+
 def check_air_quality():
     """Kiểm tra chất lượng không khí và gửi cảnh báo nếu cần"""
+    # Ưu tiên latest store (shared memory do mqtt_subscriber cập nhật) => không query InfluxDB
+    store = shared_reader()
+    if store is not None:
+        try:
+            for node_id, item in store.all(max_age=READING_MAX_AGE).items():
+                evaluate_node(node_id, alert_pm25(item), item['pm10'], 0, 0)
+            return
+        except Exception as e:
+            logger.error(f"Latest store error: {e}, falling back to InfluxDB")
+    
     try:
-        client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, database=INFLUXDB_DB)
-        
         # Lấy dữ liệu mới nhất từ mỗi node
         query = """
             SELECT last(pm2_5) as pm2_5, last(pm10) as pm10, 
@@ -229,7 +269,7 @@ def check_air_quality():
             GROUP BY node_id
         """
         
-        result = client.query(query)
+        result = influx.query(query)
         
         for key, points in result.items():
             node_id = key[1].get('node_id', 'unknown')
@@ -240,16 +280,7 @@ def check_air_quality():
                 co2 = point.get('co2_ppm', 0) or 0
                 co = point.get('co_ppm', 0) or 0
                 
-                # Đánh giá mức độ
-                level, level_name, emoji = get_air_quality_level(pm25, pm10, co2, co)
-                
-                logger.info(f"Node {node_id}: PM2.5={pm25:.1f}, Level={level_name}")
-                
-                # Gửi cảnh báo nếu cần
-                if should_alert(level):
-                    send_notification(node_id, level, level_name, pm25, pm10, co2, emoji)
-        
-        client.close()
+                evaluate_node(node_id, pm25, pm10, co2, co)
         
     except Exception as e:
         logger.error(f"Check error: {e}")
@@ -262,11 +293,13 @@ def register_fcm():
     data = request.json
     token = data.get('token')
     user_id = data.get('user_id', 'anonymous')
+    node_ids = data.get('node_ids')        # ["node1", "node2"], bỏ trống = mọi node
+    min_level = data.get('min_level')      # "moderate" / "poor" / "bad" / "hazardous"
     
     if token:
         # Gọi hàm save_fcm_token
         from notification_service import save_fcm_token
-        save_fcm_token(token, user_id)
+        save_fcm_token(token, user_id, node_ids=node_ids, min_level=min_level)
         return jsonify({'status': 'success', 'message': 'Token registered'})
     
     return jsonify({'status': 'error', 'message': 'Token required'}), 400
@@ -279,22 +312,37 @@ def main():
     logger.info("=" * 50)
     
     # Khởi tạo Firebase
+    global dispatcher, alert_queue
     if not init_firebase():
         logger.error("Failed to initialize Firebase. Exiting.")
         return
+    # Giới hạn theo request multicast (batch 500 token), không theo cảnh báo
+    dispatcher = FcmDispatcher(limiter=RateLimiter(RATE_LIMIT, RATE_BURST))
     
     # Tải FCM tokens
     load_fcm_tokens()
     
-    # Vòng lặp chính
-    logger.info(f"Starting monitoring (interval: {CHECK_INTERVAL}s)")
+    # Hàng đợi gửi (cảnh báo chưa gửi từ lần chạy trước được gửi tiếp)
+    alert_queue = AlertQueue(ALERT_QUEUE_DB, deliver_notification, on_drop=alert_dropped)
+    alert_queue.start()
+    
+    # Vòng lặp chính: theo sự kiện từ latest store, fallback InfluxDB
+    logger.info(f"Starting monitoring (latest store every {POLL_INTERVAL}s, "
+                f"InfluxDB fallback every {CHECK_INTERVAL}s)")
     
+    generation = 0
     while True:
         try:
-            check_air_quality()
-            time.sleep(CHECK_INTERVAL)
+            store = shared_reader()
+            if store is not None:
+                generation = process_readings(store, generation)
+                time.sleep(POLL_INTERVAL)
+            else:
+                check_air_quality()
+                time.sleep(CHECK_INTERVAL)
         except KeyboardInterrupt:
             logger.info("Shutting down...")
+            alert_queue.close()  # Cảnh báo chưa gửi còn trong ALERT_QUEUE_DB
             break
         except Exception as e:
             logger.error(f"Main loop error: {e}")
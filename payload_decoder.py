@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Payload Decoder cho MQTT ingest
+- JSON: msgspec (schema biên dịch sẵn) hoặc orjson nếu có, fallback json chuẩn
+- Binary: struct cố định (26 byte / bản ghi) mà ESP32 có thể gửi thay cho JSON
+- Timestamp do node gửi (epoch) + nhiều bản ghi trong 1 message (node xả buffer sau khi mất mạng)
+- Loại bỏ bản ghi thiếu trường / vượt ngưỡng cảm biến và đếm theo lý do
+  (không ghi 0 vào InfluxDB như trước)
+"""
+
+import json
+import struct
+import time
+from collections import namedtuple
+
+from config import Config
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ============ ĐỊNH DẠNG ============
+Reading = namedtuple('Reading', ['node_id', 'ts_ns', 'pm1_0', 'pm2_5', 'pm10', 'aqi'])
+
+# JSON: 1 bản ghi   {"node_id", "pm1_0", "pm2_5", "pm10", "aqi"?, "ts"?}
+#       nhiều bản ghi {"node_id", "readings": [{"ts", "pm1_0", "pm2_5", "pm10", "aqi"?}, ...]}
+# "ts" là epoch (giây, UTC) do node gửi; thiếu / không hợp lệ => dùng thời điểm nhận
+
+# Binary payload (little-endian), khớp với struct trong esp32_pm_only.ino:
+#   v1: uint8 magic (0xA7) | uint8 version (1) | char[16] node_id (NUL padded)
+#       uint16 pm1_0 x10 | uint16 pm2_5 x10 | uint16 pm10 x10 | uint16 aqi (0xFFFF = không có)
+#   v2: uint8 magic | uint8 version (2) | char[16] node_id | uint8 count
+#       + count x (uint32 ts | uint16 pm1_0 x10 | uint16 pm2_5 x10 | uint16 pm10 x10 | uint16 aqi)
+BINARY_MAGIC = 0xA7
+BINARY_VERSION = 1
+BINARY_BATCH_VERSION = 2
+BINARY_FORMAT = struct.Struct('<BB16sHHHH')
+BINARY_BATCH_HEADER = struct.Struct('<BB16sB')
+BINARY_SAMPLE = struct.Struct('<IHHHH')
+AQI_NONE = 0xFFFF
+
+PM25_MAX = Config.SENSOR_PM25_MAX
+PM10_MAX = Config.SENSOR_PM10_MAX
+
+MAX_READINGS = 500          # Số bản ghi tối đa trong 1 message
+MIN_VALID_TS = 1577836800   # 2020-01-01: nhỏ hơn => node chưa đồng bộ NTP (vd. millis())
+MAX_CLOCK_SKEW = 300        # Cho phép đồng hồ node chạy nhanh tối đa 5 phút
+
+
+class InvalidPayload(ValueError):
+    """Payload không hợp lệ; reason dùng làm key thống kê"""
+    def __init__(self, reason, detail=''):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+
+
+# ============ JSON ============
+# Mỗi backend trả về (node_id, [(pm1_0, pm2_5, pm10, aqi, ts), ...])
+if msgspec is not None:
+    class _JsonSample(msgspec.Struct):
+        pm1_0: float
+        pm2_5: float
+        pm10: float
+        aqi: float | None = None
+        ts: float | None = None
+
+    class _JsonMessage(msgspec.Struct):
+        node_id: str
+        pm1_0: float | None = None
+        pm2_5: float | None = None
+        pm10: float | None = None
+        aqi: float | None = None
+        ts: float | None = None
+        readings: list[_JsonSample] | None = None
+
+    _json_decoder = msgspec.json.Decoder(_JsonMessage)
+
+    def _decode_json(raw):
+        try:
+            m = _json_decoder.decode(raw)
+        except msgspec.ValidationError as e:
+            raise InvalidPayload('schema', str(e))
+        except msgspec.DecodeError as e:
+            raise InvalidPayload('malformed', str(e))
+
+        if m.readings is not None:
+            return m.node_id, [(r.pm1_0, r.pm2_5, r.pm10, r.aqi, r.ts) for r in m.readings]
+        if m.pm1_0 is None or m.pm2_5 is None or m.pm10 is None:
+            raise InvalidPayload('schema', 'missing field')
+        return m.node_id, [(m.pm1_0, m.pm2_5, m.pm10, m.aqi, m.ts)]
+
+else:
+    _loads = orjson.loads if orjson is not None else json.loads
+    _NUMBER = (int, float)
+
+    def _sample(obj):
+        pm1_0 = obj.get('pm1_0')
+        pm2_5 = obj.get('pm2_5')
+        pm10 = obj.get('pm10')
+        aqi = obj.get('aqi')
+        ts = obj.get('ts')
+        if type(pm1_0) not in _NUMBER or type(pm2_5) not in _NUMBER or type(pm10) not in _NUMBER:
+            raise InvalidPayload('schema', 'missing or non-numeric field')
+        if (aqi is not None and type(aqi) not in _NUMBER) or (ts is not None and type(ts) not in _NUMBER):
+            raise InvalidPayload('schema', 'non-numeric aqi / ts')
+        return pm1_0, pm2_5, pm10, aqi, ts
+
+    def _decode_json(raw):
+        try:
+            payload = _loads(raw)
+        except ValueError as e:
+            raise InvalidPayload('malformed', str(e))
+        if not isinstance(payload, dict):
+            raise InvalidPayload('schema', 'payload is not an object')
+
+        node_id = payload.get('node_id')
+        if type(node_id) is not str:
+            raise InvalidPayload('schema', 'missing node_id')
+
+        readings = payload.get('readings')
+        if readings is None:
+            return node_id, [_sample(payload)]
+        if not isinstance(readings, list) or not all(isinstance(r, dict) for r in readings):
+            raise InvalidPayload('schema', 'readings is not a list of objects')
+        return node_id, [_sample(r) for r in readings]
+
+
+# ============ BINARY ============
+def _decode_binary(raw):
+    version = raw[1] if len(raw) > 1 else None
+
+    if version == BINARY_VERSION:
+        if len(raw) != BINARY_FORMAT.size:
+            raise InvalidPayload('malformed', f"binary payload is {len(raw)} bytes")
+        _, _, node_id, pm1_0, pm2_5, pm10, aqi = BINARY_FORMAT.unpack(raw)
+        samples = [(pm1_0 / 10.0, pm2_5 / 10.0, pm10 / 10.0,
+                    None if aqi == AQI_NONE else aqi, None)]
+
+    elif version == BINARY_BATCH_VERSION:
+        if len(raw) < BINARY_BATCH_HEADER.size:
+            raise InvalidPayload('malformed', f"binary payload is {len(raw)} bytes")
+        _, _, node_id, count = BINARY_BATCH_HEADER.unpack_from(raw)
+        if len(raw) != BINARY_BATCH_HEADER.size + count * BINARY_SAMPLE.size:
+            raise InvalidPayload('malformed', f"binary batch of {count} is {len(raw)} bytes")
+        samples = [
+            (pm1_0 / 10.0, pm2_5 / 10.0, pm10 / 10.0,
+             None if aqi == AQI_NONE else aqi, ts or None)
+            for ts, pm1_0, pm2_5, pm10, aqi
+            in BINARY_SAMPLE.iter_unpack(raw[BINARY_BATCH_HEADER.size:])
+        ]
+
+    else:
+        raise InvalidPayload('schema', f"unsupported binary version {version}")
+
+    return node_id.rstrip(b'\0').decode('ascii', errors='replace'), samples
+
+
+def encode_binary(node_id, pm1_0, pm2_5, pm10, aqi=None):
+    """Đóng gói payload binary v1 (dùng để test / giả lập node)"""
+    return BINARY_FORMAT.pack(
+        BINARY_MAGIC, BINARY_VERSION, node_id.encode('ascii')[:16],
+        int(round(pm1_0 * 10)), int(round(pm2_5 * 10)), int(round(pm10 * 10)),
+        AQI_NONE if aqi is None else int(aqi)
+    )
+
+
+def encode_binary_batch(node_id, samples):
+    """Đóng gói payload binary v2; samples: [(ts, pm1_0, pm2_5, pm10, aqi), ...]"""
+    body = b''.join(
+        BINARY_SAMPLE.pack(int(ts or 0), int(round(pm1_0 * 10)), int(round(pm2_5 * 10)),
+                           int(round(pm10 * 10)), AQI_NONE if aqi is None else int(aqi))
+        for ts, pm1_0, pm2_5, pm10, aqi in samples
+    )
+    return BINARY_BATCH_HEADER.pack(
+        BINARY_MAGIC, BINARY_BATCH_VERSION, node_id.encode('ascii')[:16], len(samples)) + body
+
+
+# ============ DECODER ============
+def validate(reading):
+    """Kiểm tra giới hạn cảm biến (Config.SENSOR_PM25_MAX / SENSOR_PM10_MAX)"""
+    if not reading.node_id:
+        raise InvalidPayload('schema', 'empty node_id')
+    if not (0 <= reading.pm2_5 <= PM25_MAX) or not (0 <= reading.pm1_0 <= PM25_MAX):
+        raise InvalidPayload('out_of_range', f"pm2_5={reading.pm2_5} pm1_0={reading.pm1_0}")
+    if not (0 <= reading.pm10 <= PM10_MAX):
+        raise InvalidPayload('out_of_range', f"pm10={reading.pm10}")
+    return reading
+
+
+class PayloadDecoder:
+    """
+    Nhận diện định dạng theo byte đầu tiên: 0xA7 => binary, còn lại => JSON
+    Đếm số bản ghi hợp lệ / bị loại theo lý do
+    """
+    def __init__(self):
+        self.stats = {'decoded': 0, 'malformed': 0, 'schema': 0, 'out_of_range': 0,
+                      'ts_fallback': 0}
+
+    def decode(self, raw, received_ns=None):
+        """
+        Giải mã + kiểm tra, trả về list Reading (timestamp nanosecond)
+        Lỗi cả message => raise InvalidPayload; bản ghi lẻ vượt ngưỡng trong batch bị bỏ qua,
+        không còn bản ghi hợp lệ nào => raise InvalidPayload
+        """
+        if received_ns is None:
+            received_ns = time.time_ns()
+
+        try:
+            if raw[:1] == b'\xa7':
+                node_id, samples = _decode_binary(raw)
+            else:
+                node_id, samples = _decode_json(raw)
+            if not samples or len(samples) > MAX_READINGS:
+                raise InvalidPayload('schema', f"{len(samples)} readings")
+        except InvalidPayload as e:
+            self.stats[e.reason] += 1
+            raise
+
+        max_ts = received_ns / 1e9 + MAX_CLOCK_SKEW
+        readings = []
+        rejected = None
+        for i, (pm1_0, pm2_5, pm10, aqi, ts) in enumerate(samples):
+            if ts is not None and MIN_VALID_TS <= ts <= max_ts:
+                ts_ns = int(ts * 1_000_000_000)
+            else:
+                # Lệch i ns để các bản ghi không timestamp trong cùng batch không ghi đè nhau
+                ts_ns = received_ns + i
+                if ts is not None:
+                    self.stats['ts_fallback'] += 1
+
+            reading = Reading(node_id, ts_ns, float(pm1_0), float(pm2_5), float(pm10),
+                              int(aqi) if aqi is not None else None)
+            try:
+                validate(reading)
+            except InvalidPayload as e:
+                self.stats[e.reason] += 1
+                if len(samples) == 1:
+                    raise
+                rejected = e.reason
+                continue
+            readings.append(reading)
+
+        if not readings:
+            # Mọi bản ghi trong batch bị loại (đã đếm theo lý do ở trên)
+            raise InvalidPayload(rejected, f"all {len(samples)} readings rejected")
+
+        self.stats['decoded'] += len(readings)
+        return readings
+
+
+JSON_BACKEND = 'msgspec' if msgspec is not None else ('orjson' if orjson is not None else 'json')
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Result-to-Array Layer
+- Chuyển kết quả InfluxDB / bucket cache thành mảng NumPy 1 lần:
+  timestamp int64 (epoch giây), giá trị float64 (NaN = null)
+- Làm tròn, lọc, thống kê, z-score, ISO time / nhãn giờ địa phương đều vectorized
+  => request khoảng dài không còn bị chi phối bởi vòng lặp Python theo từng điểm
+"""
+
+import numpy as np
+
+
+class SeriesArrays:
+    """1 chuỗi thời gian: times (int64, epoch giây) + values {field: float64}"""
+    __slots__ = ('times', 'values')
+
+    def __init__(self, times, values):
+        self.times = times
+        self.values = values
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, field):
+        return self.values[field]
+
+    def filter(self, mask):
+        return SeriesArrays(self.times[mask], {f: v[mask] for f, v in self.values.items()})
+
+    def present(self, field):
+        """Chỉ giữ các điểm field không null"""
+        return self.filter(~np.isnan(self.values[field]))
+
+    def since(self, ts):
+        return self.filter(self.times >= ts)
+
+
+def _empty(fields):
+    return SeriesArrays(np.empty(0, dtype=np.int64), {f: np.empty(0) for f in fields})
+
+
+def from_buckets(pairs, fields):
+    """[(epoch, row), ...] (bucket cache) -> SeriesArrays"""
+    if not pairs:
+        return _empty(fields)
+    times = np.fromiter((ts for ts, _ in pairs), dtype=np.int64, count=len(pairs))
+    matrix = np.array([[row.get(f) for f in fields] for _, row in pairs], dtype=np.float64)
+    return SeriesArrays(times, {f: matrix[:, i] for i, f in enumerate(fields)})
+
+
+def from_resultset(result, fields, group_by=None):
+    """
+    ResultSet (query với epoch='s') -> {group: SeriesArrays}, group = tag group_by (None nếu không group)
+    Đọc thẳng mảng 'values' của từng series, không qua get_points()
+    """
+    out = {}
+    for series in result.raw.get('series', []):
+        columns = series['columns']
+        values = series.get('values') or []
+        group = (series.get('tags') or {}).get(group_by) if group_by else None
+        if not values:
+            out[group] = _empty(fields)
+            continue
+        matrix = np.array(values, dtype=np.float64)
+        times = matrix[:, columns.index('time')].astype(np.int64)
+        out[group] = SeriesArrays(times, {f: matrix[:, columns.index(f)] for f in fields})
+    return out
+
+
+# ============ TÍNH TOÁN ============
+def round1(values):
+    """
+    Làm tròn 0.1 như round() của Python: np.round nhân 10 rồi làm tròn nên lệch ở các giá trị
+    ngay nửa (55.55 -> 55.6, round() -> 55.5) => chỉ các giá trị đó tính lại bằng round()
+    """
+    out = np.round(values, 1)
+    scaled = np.asarray(values, dtype=np.float64) * 10
+    for i in np.flatnonzero(np.abs(scaled - np.trunc(scaled)) == 0.5):
+        out.flat[i] = round(float(values.flat[i]), 1)
+    return out
+
+
+def stats(values):
+    """min / max / mean bỏ qua NaN và 0 (như trước: chỉ tính giá trị > 0); None nếu rỗng"""
+    values = values[~np.isnan(values) & (values != 0)]
+    if not len(values):
+        return None
+    return float(values.min()), float(values.max()), float(values.mean())
+
+
+def zscores(values, mean, std):
+    if std == 0:
+        return np.zeros_like(values)
+    return np.abs(values - mean) / std
+
+
+# ============ ĐẦU RA ============
+def to_list(values):
+    """float64 -> list Python, NaN -> None"""
+    nan = np.isnan(values)
+    if not nan.any():
+        return values.tolist()
+    out = values.astype(object)
+    out[nan] = None
+    return out.tolist()
+
+
+def iso_times(times):
+    """epoch giây -> ['2024-01-01T00:00:00Z', ...] (như InfluxDB trả về)"""
+    return np.char.add(np.datetime_as_string(times.astype('datetime64[s]'), unit='s'), 'Z').tolist()
+
+
+def hour_labels(times, utc_offset):
+    """epoch giây -> ['HH:MM', ...] theo múi giờ cố định (utc_offset giây, VN không có DST)"""
+    if not len(times):
+        return []     # np.char.zfill không nhận mảng rỗng
+    local = times + int(utc_offset)
+    return np.char.add(np.char.add(np.char.zfill(((local // 3600) % 24).astype(str), 2), ':'),
+                       np.char.zfill(((local // 60) % 60).astype(str), 2)).tolist()
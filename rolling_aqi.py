@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Rolling AQI Engine - trung bình trượt theo node, cập nhật ngay khi ingest
+- Giới hạn QCVN 05:2023 (TB 24h, TB năm) và ngưỡng cảnh báo là giá trị trung bình,
+  không phải 1 mẫu tức thời => ngoài AQI tức thời còn công bố:
+    pm2_5_1h      TB 60 phút gần nhất (ring 60 ô x 1 phút)
+    pm2_5_24h     TB 24 giờ gần nhất (ring 24 ô x 1 giờ) -> aqi_24h (AQI ngày)
+    pm10_24h      TB 24 giờ PM10
+    pm2_5_nowcast NowCast 12 giờ (trọng số theo độ biến động) -> aqi_nowcast (AQI giờ)
+- Mỗi ô giữ sum + count, tổng của cả ring cập nhật khi thêm mẫu / ô hết hạn
+  => add() O(1) (khấu hao), không bao giờ query lại dữ liệu raw nhiều ngày
+- Khởi động: seed() từ rollup 1m / 1h đã có (tối đa 60 + 24 dòng / node)
+- weight: mỗi mẫu live tính như weight mẫu (shared subscription N worker: worker chỉ nhận
+  ~1/N message của node, seed() nạp đủ lịch sử => weight = N để 2 phần cùng trọng số)
+
+Chỉ thread on_message của mqtt_subscriber gọi add() (không khóa).
+"""
+
+from aqi import calculate_aqi
+
+# ============ CẤU HÌNH ============
+MINUTE = 60
+HOUR = 3600
+FIELDS = ('pm2_5', 'pm10')
+
+NOWCAST_HOURS = 12
+NOWCAST_MIN_WEIGHT = 0.5    # Trọng số tối thiểu cho PM (EPA)
+NOWCAST_MIN_RECENT = 2      # Cần dữ liệu ít nhất 2 trong 3 giờ gần nhất
+
+
+class _Ring:
+    """size ô x width giây; ô hết hạn được trừ khỏi tổng khi ring tiến tới"""
+    __slots__ = ('width', 'size', 'head', 'counts', 'sums', 'count', 'total')
+
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        self.head = None                                   # Chỉ số ô (ts // width) mới nhất
+        self.counts = [0] * size
+        self.sums = [[0.0] * size for _ in FIELDS]
+        self.count = 0
+        self.total = [0.0] * len(FIELDS)
+
+    def advance(self, ts):
+        """Tiến ring tới thời điểm ts, xóa các ô đã ra khỏi cửa sổ"""
+        idx = int(ts // self.width)
+        if self.head is None:
+            self.head = idx
+            return
+        for k in range(1, min(idx - self.head, self.size) + 1):
+            slot = (self.head + k) % self.size
+            if self.counts[slot]:
+                self.count -= self.counts[slot]
+                self.counts[slot] = 0
+                for f in range(len(FIELDS)):
+                    self.total[f] -= self.sums[f][slot]
+                    self.sums[f][slot] = 0.0
+        if idx > self.head:
+            self.head = idx
+            if self.count == 0:
+                self.total = [0.0] * len(FIELDS)           # Tránh sai số cộng dồn khi ring rỗng
+
+    def add(self, ts, sums, count=1):
+        """Thêm count mẫu có tổng sums vào ô của ts; False nếu ts đã ra khỏi cửa sổ"""
+        self.advance(ts)
+        idx = int(ts // self.width)
+        if idx <= self.head - self.size:
+            return False
+        slot = idx % self.size
+        self.counts[slot] += count
+        self.count += count
+        for f, value in enumerate(sums):
+            self.sums[f][slot] += value
+            self.total[f] += value
+        return True
+
+    def mean(self, field=0):
+        return self.total[field] / self.count if self.count else None
+
+    def recent_means(self, n, field=0):
+        """TB của n ô gần nhất (mới nhất trước), None nếu ô không có dữ liệu"""
+        means = []
+        for k in range(min(n, self.size)):
+            slot = (self.head - k) % self.size
+            count = self.counts[slot]
+            means.append(self.sums[field][slot] / count if count else None)
+        return means
+
+
+def nowcast(hourly):
+    """
+    NowCast (US EPA, dùng cho AQI giờ của VN_AQI) từ TB các giờ, mới nhất trước
+    w = max(min / max, 0.5); NowCast = sum(w^(i-1) * c_i) / sum(w^(i-1)) trên các giờ có dữ liệu
+    """
+    if sum(c is not None for c in hourly[:3]) < NOWCAST_MIN_RECENT:
+        return None
+    values = [c for c in hourly if c is not None]
+    high = max(values)
+    if high <= 0:
+        return 0.0
+    weight = max(min(values) / high, NOWCAST_MIN_WEIGHT)
+    num = den = 0.0
+    for i, c in enumerate(hourly):
+        if c is not None:
+            num += weight ** i * c
+            den += weight ** i
+    return num / den
+
+
+class _NodeAverages:
+    __slots__ = ('minutes', 'hours')
+
+    def __init__(self):
+        self.minutes = _Ring(MINUTE, 60)
+        self.hours = _Ring(HOUR, 24)
+
+
+class RollingAqi:
+    """
+    add(node_id, ts, pm2_5, pm10) cho mỗi bản ghi
+    averages(node_id, now) -> dict trung bình + AQI trung bình (None nếu chưa đủ dữ liệu)
+    """
+    def __init__(self, standard=None, weight=1):
+        self.standard = standard
+        self.weight = weight
+        self._nodes = {}
+
+    def _node(self, node_id):
+        node = self._nodes.get(node_id)
+        if node is None:
+            node = self._nodes[node_id] = _NodeAverages()
+        return node
+
+    def add(self, node_id, ts, pm2_5, pm10):
+        node = self._node(node_id)
+        sums = (float(pm2_5) * self.weight, float(pm10 or 0) * self.weight)
+        node.minutes.add(ts, sums, self.weight)
+        node.hours.add(ts, sums, self.weight)
+
+    def seed(self, node_id, ts, sums, count, minutes=True, hours=True):
+        """Nạp 1 dòng rollup (sum theo FIELDS + count) vào ring 1 phút và / hoặc 1 giờ khi khởi động"""
+        node = self._node(node_id)
+        if minutes:
+            node.minutes.add(ts, sums, count)
+        if hours:
+            node.hours.add(ts, sums, count)
+
+    def averages(self, node_id, now):
+        node = self._nodes.get(node_id)
+        if node is None:
+            return None
+        node.minutes.advance(now)
+        node.hours.advance(now)
+
+        pm2_5_24h = node.hours.mean()
+        pm2_5_nowcast = nowcast(node.hours.recent_means(NOWCAST_HOURS))
+        return {
+            'pm2_5_1h': node.minutes.mean(),
+            'pm2_5_24h': pm2_5_24h,
+            'pm10_24h': node.hours.mean(field=1),
+            'pm2_5_nowcast': pm2_5_nowcast,
+            'aqi_24h': None if pm2_5_24h is None else calculate_aqi(pm2_5_24h, self.standard),
+            'aqi_nowcast': None if pm2_5_nowcast is None else calculate_aqi(pm2_5_nowcast, self.standard)
+        }
+
+    def __len__(self):
+        return len(self._nodes)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Streaming Rollup Engine
+- Gộp dữ liệu ngay khi ingest theo cửa sổ 1 phút, 5 phút, 1 giờ cho từng node
+- Mỗi cửa sổ giữ count / sum / min / max / last, ghi vào measurement riêng
+  (air_quality_1m, air_quality_5m, air_quality_1h) khi cửa sổ đóng
+- API đọc từ tầng thô nhất phù hợp thay vì GROUP BY trên dữ liệu raw
+
+Lưu sum + count (không chỉ mean) để gộp tiếp chính xác: mean của khoảng lớn hơn
+= sum(x_sum) / sum(count), kể cả khi nhiều worker cùng ghi 1 node (tag "worker").
+Cửa sổ bắt đầu trước khi engine khởi động chỉ có phần mẫu sau khởi động => ghi kèm tag
+"epoch" riêng của process, không ghi đè phần do process trước ghi (API cộng các phần lại).
+backfill(): tạo rollup cho dữ liệu raw có trước khi engine chạy lần đầu (SELECT INTO).
+"""
+
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH ============
+TIERS = {
+    '1m': 60,
+    '5m': 300,
+    '1h': 3600
+}
+MEASUREMENT_PREFIX = 'air_quality_'
+FIELDS = ('pm1_0', 'pm2_5', 'pm10', 'aqi')
+
+GRACE = 60          # Cửa sổ đóng khi đồng hồ vượt end + 60s (hoặc node gửi mẫu mới hơn end)
+LATENESS = 900      # Giữ trạng thái cửa sổ đã đóng 15 phút để nhận mẫu trễ (node xả buffer)
+FLUSH_INTERVAL = 5  # Timer đóng cửa sổ mỗi 5 giây
+
+
+def measurement_for(tier):
+    return f"{MEASUREMENT_PREFIX}{tier}"
+
+
+class _Window:
+    """Trạng thái 1 cửa sổ của 1 node"""
+    __slots__ = ('count', 'sum', 'min', 'max', 'last', 'last_ts', 'dirty')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = dict.fromkeys(FIELDS, 0.0)
+        self.min = {}
+        self.max = {}
+        self.last = {}
+        self.last_ts = 0
+        self.dirty = False
+
+    def add(self, ts, fields):
+        self.count += 1
+        for f in FIELDS:
+            v = fields.get(f)
+            if v is None:
+                continue
+            v = float(v)
+            self.sum[f] += v
+            if f not in self.min or v < self.min[f]:
+                self.min[f] = v
+            if f not in self.max or v > self.max[f]:
+                self.max[f] = v
+        if ts >= self.last_ts:
+            self.last_ts = ts
+            self.last = fields
+        self.dirty = True
+
+    def to_fields(self):
+        out = {'count': self.count}
+        for f in FIELDS:
+            if f not in self.min:
+                continue
+            out[f] = self.sum[f] / self.count
+            out[f"{f}_sum"] = self.sum[f]
+            out[f"{f}_min"] = self.min[f]
+            out[f"{f}_max"] = self.max[f]
+            if self.last.get(f) is not None:
+                out[f"{f}_last"] = float(self.last[f])
+        return out
+
+
+class RollupEngine:
+    """
+    add() gọi từ paho thread cho mỗi bản ghi, flush() gọi định kỳ từ timer thread
+    emit(measurement, tags, fields, timestamp_ns) thường là BatchedInfluxWriter.write
+    """
+    def __init__(self, emit, tiers=TIERS, extra_tags=None, grace=GRACE, lateness=LATENESS):
+        self.emit = emit
+        self.tiers = tiers
+        self.extra_tags = extra_tags or {}
+        self.grace = grace
+        self.lateness = lateness
+
+        self._lock = threading.Lock()
+        self._windows = {}     # (tier, node_id, start) -> _Window
+        self._watermark = {}   # node_id -> timestamp (giây) mới nhất đã thấy
+        self._stats = {'added': 0, 'emitted': 0, 'late_dropped': 0}
+        self.started = time.time()
+        self.epoch = f"{time.time_ns():x}"
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ---------- Ingest ----------
+    def add(self, node_id, ts_ns, fields):
+        ts = ts_ns // 1_000_000_000
+        now = time.time()
+        with self._lock:
+            self._stats['added'] += 1
+            if ts > self._watermark.get(node_id, 0):
+                self._watermark[node_id] = ts
+
+            for tier, size in self.tiers.items():
+                start = ts - ts % size
+                if start + size + self.lateness < now:
+                    # Quá trễ: chỉ còn trong dữ liệu raw
+                    self._stats['late_dropped'] += 1
+                    continue
+                key = (tier, node_id, start)
+                window = self._windows.get(key)
+                if window is None:
+                    window = self._windows[key] = _Window()
+                window.add(ts, fields)
+
+    # ---------- Đóng cửa sổ ----------
+    def flush(self, now=None, force=False):
+        """Ghi các cửa sổ đã đóng (hoặc đã đóng nhưng nhận thêm mẫu trễ)"""
+        if now is None:
+            now = time.time()
+        out = []
+        with self._lock:
+            for key, window in list(self._windows.items()):
+                tier, node_id, start = key
+                end = start + self.tiers[tier]
+                closed = force or now >= end + self.grace or self._watermark.get(node_id, 0) >= end
+
+                if closed and window.dirty:
+                    # Ghi lại toàn bộ trạng thái => điểm cũ (cùng timestamp) bị ghi đè đúng
+                    out.append((tier, node_id, start, window.to_fields()))
+                    window.dirty = False
+
+                if end + self.lateness < now:
+                    del self._windows[key]
+            self._stats['emitted'] += len(out)
+
+        for tier, node_id, start, fields in out:
+            tags = {'node_id': node_id, **self.extra_tags}
+            if start < self.started:
+                tags['epoch'] = self.epoch
+            self.emit(measurement_for(tier), tags, fields, start * 1_000_000_000)
+        return len(out)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'windows': len(self._windows)}
+
+    # ---------- Timer ----------
+    def start(self, interval=FLUSH_INTERVAL):
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"Rollup flush error: {e}")
+
+        self._thread = threading.Thread(target=run, name='rollup-flush', daemon=True)
+        self._thread.start()
+        logger.info(f"✓ Rollup engine started (tiers: {', '.join(self.tiers)})")
+        return self
+
+    def close(self, timeout=10):
+        """
+        Dừng timer, ghi cả các cửa sổ đang mở; process sau ghi phần còn lại của các
+        cửa sổ này với tag epoch của nó => 2 phần được cộng, không ghi đè nhau
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self.flush(force=True)
+
+
+# ============ BACKFILL ============
+BACKFILL_CHUNK = 6 * 3600   # 1 query SELECT INTO / 6 giờ dữ liệu raw (trong timeout client)
+
+
+def backfill_query(tier, since, until):
+    """SELECT INTO tạo rollup của tier từ raw trong [since, until) (cùng field với _Window)"""
+    # * 1.0: aqi raw là integer, rollup do engine ghi là float (tránh xung đột kiểu field)
+    select = ['count("pm2_5") AS "count"']
+    for f in FIELDS:
+        select += [f'mean("{f}") AS "{f}"', f'sum("{f}") * 1.0 AS "{f}_sum"',
+                   f'min("{f}") * 1.0 AS "{f}_min"', f'max("{f}") * 1.0 AS "{f}_max"',
+                   f'last("{f}") * 1.0 AS "{f}_last"']
+    return (f'SELECT {", ".join(select)} INTO "{measurement_for(tier)}" FROM "air_quality" '
+            f'WHERE time >= {since}s AND time < {until}s '
+            f'GROUP BY time({tier}), "node_id" fill(none)')
+
+
+def _first_time(client, measurement, field):
+    result = client.query(f'SELECT first("{field}") FROM "{measurement}"', epoch='s')
+    points = list(result.get_points())
+    return int(points[0]['time']) if points else None
+
+
+def backfill(client, until, tiers=TIERS, chunk=BACKFILL_CHUNK):
+    """
+    Rollup cho dữ liệu raw trước khi có rollup: [đầu raw, until) với until = rollup sớm nhất
+    của tier, hoặc thời điểm engine khởi động nếu tier chưa có rollup nào
+    Chạy từ mới về cũ theo từng đoạn chunk giây => dừng giữa chừng thì lần sau tiếp tục phần cũ hơn
+    """
+    raw_start = _first_time(client, 'air_quality', 'pm2_5')
+    if raw_start is None:
+        return 0
+    written = 0
+    for tier, size in tiers.items():
+        end = _first_time(client, measurement_for(tier), 'count')
+        end = int(until) if end is None else end
+        begin = raw_start - raw_start % size
+        if end <= begin:
+            continue
+        logger.info(f"Backfilling {measurement_for(tier)} from raw ({(end - begin) / 86400:.1f} days)")
+        while end > begin:
+            since = max(begin, end - chunk)
+            since -= since % size
+            client.query(backfill_query(tier, since, end), method='POST')
+            written += 1
+            end = since
+    return written
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Durable On-Disk Spool cho InfluxDB
+- Append-only segment files (line protocol), fsync theo lô
+- Writer ghi vào spool khi InfluxDB lỗi / chậm => không mất dữ liệu, không tăng heap
+- SpoolReplayer đẩy lại dữ liệu theo lô lớn khi InfluxDB hoạt động trở lại
+
+Ghi lại 1 segment nhiều lần là an toàn: InfluxDB ghi đè điểm trùng
+(cùng measurement + tags + timestamp), nên segment chỉ bị xóa sau khi replay xong.
+"""
+
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ============ CẤU HÌNH MẶC ĐỊNH ============
+SEGMENT_BYTES = 16 * 1024 * 1024       # 16 MB / segment
+MAX_SPOOL_BYTES = 2 * 1024 * 1024 * 1024  # Tối đa 2 GB trên đĩa
+FSYNC_INTERVAL = 1.0                   # fsync tối đa 1 lần / giây
+REPLAY_BATCH_SIZE = 5000               # Số dòng / request khi replay
+REPLAY_IDLE_INTERVAL = 5               # Nghỉ khi spool rỗng / DB chưa sẵn sàng
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.lp'
+
+
+class DiskSpool:
+    """
+    Spool dạng segment: segment đang ghi (active) + các segment đã đóng
+    Mỗi dòng là 1 điểm line protocol
+    """
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES,
+                 max_bytes=MAX_SPOOL_BYTES, fsync_interval=FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_path = None
+        self._active_size = 0
+        self._last_fsync = 0.0
+
+        self._stats = {'spooled': 0, 'replayed': 0, 'discarded_segments': 0}
+
+        os.makedirs(directory, exist_ok=True)
+        segments = self._list_segments()
+        self._next_seq = self._segment_seq(segments[-1]) + 1 if segments else 1
+        if segments:
+            logger.info(f"Spool: found {len(segments)} pending segments in {directory}")
+
+    # ---------- Segment files ----------
+    def _list_segments(self):
+        names = [n for n in os.listdir(self.directory)
+                 if n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX)]
+        return sorted(os.path.join(self.directory, n) for n in names)
+
+    @staticmethod
+    def _segment_seq(path):
+        name = os.path.basename(path)
+        return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def _open_segment(self):
+        self._active_path = os.path.join(
+            self.directory, f"{SEGMENT_PREFIX}{self._next_seq:010d}{SEGMENT_SUFFIX}")
+        self._next_seq += 1
+        self._active = open(self._active_path, 'ab')
+        self._active_size = 0
+
+    def _close_active(self):
+        if self._active is None:
+            return
+        self._active.flush()
+        os.fsync(self._active.fileno())
+        self._active.close()
+        self._active = None
+        self._active_path = None
+
+    def _enforce_limit(self):
+        """Vượt giới hạn đĩa => bỏ segment cũ nhất"""
+        segments = self._list_segments()
+        total = sum(os.path.getsize(p) for p in segments)
+        while total > self.max_bytes and len(segments) > 1:
+            oldest = segments.pop(0)
+            if oldest == self._active_path:
+                break
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+            self._stats['discarded_segments'] += 1
+            logger.error(f"Spool over {self.max_bytes} bytes, discarded {oldest}")
+
+    # ---------- Ghi ----------
+    def append(self, lines):
+        """Ghi danh sách dòng line protocol vào segment hiện tại"""
+        if not lines:
+            return
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+
+        with self._lock:
+            if self._active is None:
+                self._open_segment()
+            self._active.write(data)
+            self._active_size += len(data)
+            self._stats['spooled'] += len(lines)
+
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                self._active.flush()
+                os.fsync(self._active.fileno())
+                self._last_fsync = now
+
+            if self._active_size >= self.segment_bytes:
+                self._close_active()
+                self._enforce_limit()
+
+    def seal(self):
+        """Đóng segment đang ghi để replayer có thể xử lý"""
+        with self._lock:
+            if self._active is not None and self._active_size > 0:
+                self._close_active()
+
+    def close(self):
+        with self._lock:
+            self._close_active()
+
+    # ---------- Đọc / replay ----------
+    def pending_segments(self):
+        """Các segment đã đóng, cũ nhất trước"""
+        with self._lock:
+            active = self._active_path
+        return [p for p in self._list_segments() if p != active]
+
+    def has_active_data(self):
+        with self._lock:
+            return self._active is not None and self._active_size > 0
+
+    @staticmethod
+    def read_batches(path, batch_size=REPLAY_BATCH_SIZE):
+        """Đọc segment theo lô, không nạp cả file vào RAM"""
+        batch = []
+        with open(path, 'rb') as f:
+            for raw in f:
+                line = raw.rstrip(b'\n')
+                if not line:
+                    continue
+                batch.append(line.decode('utf-8', errors='replace'))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def remove(self, path, replayed=0):
+        os.remove(path)
+        with self._lock:
+            self._stats['replayed'] += replayed
+
+    def stats(self):
+        segments = self._list_segments()
+        with self._lock:
+            return {
+                **self._stats,
+                'segments': len(segments),
+                'bytes': sum(os.path.getsize(p) for p in segments)
+            }
+
+
+class SpoolReplayer:
+    """
+    Luồng nền: khi InfluxDB sẵn sàng, đẩy các segment trong spool theo lô lớn
+    """
+    def __init__(self, client, spool, writer=None, batch_size=REPLAY_BATCH_SIZE,
+                 idle_interval=REPLAY_IDLE_INTERVAL, on_recover=None):
+        self.client = client
+        self.spool = spool
+        self.writer = writer
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.on_recover = on_recover
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self, timeout=10):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _influx_ready(self):
+        """Kiểm tra InfluxDB còn sống (ping)"""
+        try:
+            self.client.ping()
+        except Exception:
+            return False
+        if self.writer is not None:
+            self.writer.mark_healthy()
+        return True
+
+    def _replay_segment(self, path):
+        count = 0
+        start = time.monotonic()
+        for batch in self.spool.read_batches(path, self.batch_size):
+            if self._stop.is_set():
+                return False
+            self.client.write_points(batch, protocol='line', time_precision='n')
+            count += len(batch)
+
+        self.spool.remove(path, replayed=count)
+        elapsed = max(time.monotonic() - start, 1e-6)
+        logger.info(f"✓ Replayed {count} points from {os.path.basename(path)} "
+                    f"({count / elapsed:.0f} points/s)")
+        return True
+
+    def _run(self):
+        # Lần đầu kết nối được cũng gọi on_recover (vd. tạo database nếu lúc khởi động DB chưa lên)
+        was_down = True
+        while not self._stop.is_set():
+            segments = self.spool.pending_segments()
+            if not segments and self.spool.has_active_data() and self._influx_ready():
+                self.spool.seal()
+                segments = self.spool.pending_segments()
+
+            if not segments:
+                self._stop.wait(self.idle_interval)
+                continue
+
+            if not self._influx_ready():
+                was_down = True
+                self._stop.wait(self.idle_interval)
+                continue
+
+            if was_down:
+                was_down = False
+                if self.on_recover:
+                    try:
+                        self.on_recover()
+                    except Exception as e:
+                        logger.error(f"Spool recover hook error: {e}")
+
+            for path in segments:
+                try:
+                    if not self._replay_segment(path):
+                        break
+                except Exception as e:
+                    logger.error(f"Spool replay error ({os.path.basename(path)}): {e}")
+                    self._stop.wait(self.idle_interval)
+                    break
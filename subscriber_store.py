@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Subscriber Store - FCM token + đăng ký theo node (SQLite, WAL)
+- subscribers: token (khóa chính) -> user_id
+- subscriptions: (token, node_id) -> mức tối thiểu muốn nhận (ngưỡng riêng của người dùng)
+  node_id '*' = mọi node (token cũ từ fcm_tokens.json)
+- Index (node_id, min_rank): cảnh báo của 1 node chỉ đọc subscriber của node đó
+- Upsert / xóa 1 token: vài thao tác theo khóa chính, không ghi lại cả danh sách
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from aqi import LEVELS
+
+# ============ CẤU HÌNH ============
+ALL_NODES = '*'
+LEVEL_RANK = {code: i for i, (code, _, _, _, _) in enumerate(LEVELS)}
+DEFAULT_MIN_LEVEL = 'poor'   # Như trước: mặc định chỉ cảnh báo từ mức Kém
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscribers (
+    token TEXT PRIMARY KEY,
+    user_id TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    token TEXT NOT NULL REFERENCES subscribers(token) ON DELETE CASCADE,
+    node_id TEXT NOT NULL,
+    min_rank INTEGER NOT NULL,
+    PRIMARY KEY (token, node_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_subscriptions_node ON subscriptions (node_id, min_rank);
+"""
+
+
+def level_rank(level):
+    """Thứ tự mức (good = 0); mức tối thiểu nhận cảnh báo phải từ moderate trở lên"""
+    rank = LEVEL_RANK.get(level or DEFAULT_MIN_LEVEL)
+    if not rank:
+        raise ValueError(f"Invalid alert level: {level} ({', '.join(list(LEVEL_RANK)[1:])})")
+    return rank
+
+
+class SubscriberStore:
+    """1 connection SQLite / thread (WAL: đọc không chặn ghi)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+        return conn
+
+    # ---------- Ghi ----------
+    def upsert(self, token, node_ids=None, min_level=None, user_id=None):
+        """
+        Đăng ký / cập nhật token: node_ids None => mọi node; min_level None => DEFAULT_MIN_LEVEL
+        Thay toàn bộ đăng ký cũ của token
+        """
+        rank = level_rank(min_level)
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT INTO subscribers (token, user_id, created, updated) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(token) DO UPDATE SET user_id = COALESCE(excluded.user_id, user_id), '
+                'updated = excluded.updated',
+                (token, user_id, now, now))
+            conn.execute('DELETE FROM subscriptions WHERE token = ?', (token,))
+            conn.executemany(
+                'INSERT INTO subscriptions (token, node_id, min_rank) VALUES (?, ?, ?)',
+                [(token, node_id, rank) for node_id in (node_ids or [ALL_NODES])])
+
+    def remove(self, tokens):
+        """Xóa nhiều token trong 1 transaction (đăng ký bị xóa theo ON DELETE CASCADE)"""
+        if isinstance(tokens, str):
+            tokens = [tokens]
+        with self._conn() as conn:
+            conn.executemany('DELETE FROM subscribers WHERE token = ?', [(t,) for t in tokens])
+
+    def import_json(self, path):
+        """Nhập fcm_tokens.json cũ (mọi node, mức mặc định); trả về số token"""
+        with open(path, 'r') as f:
+            tokens = json.load(f).get('tokens', [])
+        now = time.time()
+        rank = level_rank(None)
+        with self._conn() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO subscribers (token, user_id, created, updated) VALUES (?, NULL, ?, ?)',
+                [(t, now, now) for t in tokens])
+            conn.executemany(
+                'INSERT OR IGNORE INTO subscriptions (token, node_id, min_rank) VALUES (?, ?, ?)',
+                [(t, ALL_NODES, rank) for t in tokens])
+        return len(tokens)
+
+    # ---------- Đọc ----------
+    def tokens_for(self, node_id, level):
+        """Token cần nhận cảnh báo mức level của node (đăng ký node đó hoặc mọi node)"""
+        rows = self._conn().execute(
+            'SELECT DISTINCT token FROM subscriptions WHERE node_id IN (?, ?) AND min_rank <= ?',
+            (node_id, ALL_NODES, level_rank(level)))
+        return [token for token, in rows]
+
+    def has_subscribers(self, node_id, level):
+        """Có ít nhất 1 token nhận cảnh báo mức level của node (1 lần tra index)"""
+        row = self._conn().execute(
+            'SELECT 1 FROM subscriptions WHERE node_id IN (?, ?) AND min_rank <= ? LIMIT 1',
+            (node_id, ALL_NODES, level_rank(level))).fetchone()
+        return row is not None
+
+    def subscriptions(self, token):
+        """{node_id: mức tối thiểu} của 1 token"""
+        rows = self._conn().execute(
+            'SELECT node_id, min_rank FROM subscriptions WHERE token = ?', (token,))
+        return {node_id: LEVELS[rank][0] for node_id, rank in rows}
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM subscribers').fetchone()[0]
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Module nằm ở thư mục gốc repo (không phải package)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Store dùng chung (/dev/shm) và model của test nằm trong thư mục tạm riêng
+_TMP = tempfile.mkdtemp(prefix='airquality-test-')
+for name, path in (('LATEST_STORE_PATH', 'latest'), ('MODEL_STORE_PATH', 'models'),
+                   ('FORECAST_STORE_PATH', 'forecast'), ('ML_MODEL_PATH', 'ml')):
+    os.environ.setdefault(name, os.path.join(_TMP, path))
+os.makedirs(os.environ['ML_MODEL_PATH'], exist_ok=True)
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+
+import pytest
+
+import alert_queue
+from alert_queue import AlertQueue, BACKOFF_BASE, MAX_ATTEMPTS
+
+
+def payload(title, tokens=None):
+    return {'node_id': 'node1', 'level': 'poor', 'title': title, 'tokens': tokens}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    dropped = []
+    q = AlertQueue(str(tmp_path / 'alerts.db'), deliver=lambda alert: None,
+                   on_drop=lambda node_id, level: dropped.append((node_id, level)), senders=1)
+    q.dropped = dropped
+    yield q
+    q.close()
+
+
+def stored(q):
+    return [json.loads(p) for (p,) in q._conn().execute('SELECT payload FROM alerts')]
+
+
+def test_coalesce_keeps_latest_payload(queue):
+    assert queue.put('node1', 'poor', payload('a'))
+    assert queue.put('node1', 'poor', payload('b'))
+    assert queue.put('node1', 'bad', payload('c'))
+    assert queue.pending() == 2
+    assert queue.stats()['coalesced'] == 1
+    assert sorted(p['title'] for p in stored(queue)) == ['b', 'c']
+
+
+def test_coalesce_onto_retry_keeps_remaining_tokens(queue):
+    queue.put('node1', 'poor', payload('a'))
+    alert_id = queue._claim()[0]
+    queue._retry(alert_id, 'node1', 'poor', payload('a', tokens=['t1']), 1)
+
+    queue.put('node1', 'poor', payload('b'))
+    assert stored(queue) == [payload('b', tokens=['t1'])]
+
+
+def test_retry_backoff(queue, monkeypatch):
+    monkeypatch.setattr(alert_queue.random, 'uniform', lambda a, b: 1.0)
+    queue.put('node1', 'poor', payload('a'))
+    for attempts in (1, 3):
+        alert_id = queue._claim()[0]
+        before = time.time()
+        queue._retry(alert_id, 'node1', 'poor', payload('a'), attempts)
+        next_attempt, = queue._conn().execute('SELECT next_attempt FROM alerts').fetchone()
+        assert next_attempt - before == pytest.approx(BACKOFF_BASE * 2 ** (attempts - 1), abs=0.5)
+        # Chưa đến hạn => không lấy ra được
+        assert queue._claim() is None
+        queue._conn().execute('UPDATE alerts SET next_attempt = 0')
+        queue._conn().commit()
+
+
+def test_dropped_after_max_attempts(queue):
+    queue.put('node1', 'poor', payload('a'))
+    alert_id = queue._claim()[0]
+    queue._retry(alert_id, 'node1', 'poor', payload('a'), MAX_ATTEMPTS)
+    assert queue.pending() == 0
+    assert queue.dropped == [('node1', 'poor')]
+    assert queue.stats()['dropped'] == 1
+
+
+def test_sender_delivers_most_severe_first(tmp_path):
+    delivered = []
+    done = threading.Event()
+
+    def deliver(alert):
+        delivered.append(alert['title'])
+        if len(delivered) == 2:
+            done.set()
+
+    q = AlertQueue(str(tmp_path / 'alerts.db'), deliver, senders=1)
+    q.put('node1', 'poor', payload('poor'))
+    q.put('node2', 'hazardous', payload('hazardous'))
+    q.start()
+    try:
+        assert done.wait(5)
+    finally:
+        q.close()
+    assert delivered == ['hazardous', 'poor']
+    assert q.stats()['sent'] == 2
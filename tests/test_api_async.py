@@ -0,0 +1,145 @@
+import asyncio
+import re
+import time
+
+import pytest
+
+pytest.importorskip('starlette')
+pytest.importorskip('httpx')
+pytest.importorskip('aiohttp')
+
+from starlette.testclient import TestClient  # noqa: E402
+
+import api_async  # noqa: E402
+import latest_store  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.status = 200
+        self.reason = 'OK'
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self, content_type=None):
+        return self.data
+
+    async def text(self):
+        return ''
+
+
+class FakeSession:
+    """Thay aiohttp.ClientSession của AsyncInfluxClient: trả JSON /query như InfluxDB 1.x"""
+    closed = False
+
+    def __init__(self):
+        self.queries = []
+
+    def get(self, url, params=None, timeout=None):
+        query = params['q']
+        self.queries.append(query)
+        return FakeResponse({'results': [{'statement_id': 0, 'series': self.series(query)}]})
+
+    async def close(self):
+        self.closed = True
+
+    @staticmethod
+    def series(query):
+        now = int(time.time())
+        if 'last(' in query:
+            return [{'name': 'air_quality', 'tags': {'node_id': 'node9'},
+                     'columns': ['time', 'pm1_0', 'pm2_5', 'pm10', 'aqi'],
+                     'values': [[now, 1.0, 12.0, 20.0, 50]]}]
+        since = int(re.search(r'time >= (\d+)s', query).group(1))
+        values = [[t, 1.0, 20.0 + (t // 300) % 5, 30.0, 60.0] for t in range(since, now, 300)]
+        return [{'name': 'air_quality', 'columns': ['time', 'pm1_0', 'pm2_5', 'pm10', 'aqi'],
+                 'values': values}]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(api_async.influx, '_session', session)
+    monkeypatch.setattr(latest_store, '_reader', None)
+    monkeypatch.setattr(latest_store, '_reader_checked', 0.0)
+    api_async.history_cache.invalidate()
+
+    store = latest_store.LatestStore(create=True)
+    store.update('node1', time.time(), 5.0, 42.0, 60.0, 117, {'pm2_5_24h': 30.0, 'aqi_24h': 75})
+    with TestClient(api_async.app) as test_client:
+        test_client.session = session
+        yield test_client
+
+
+def test_current_from_latest_store(client):
+    response = client.get('/api/current', params={'node_id': 'node1'})
+    assert response.status_code == 200
+    body = response.json()
+    assert (body['pm2_5'], body['aqi'], body['level']) == (42.0, 117, 'poor')
+    assert body['averages']['aqi_24h'] == 75
+    assert client.session.queries == []
+
+
+def test_current_falls_back_to_influx(client):
+    response = client.get('/api/current', params={'node_id': 'node9'})
+    assert response.status_code == 200
+    assert response.json()['pm2_5'] == 12.0
+    assert len(client.session.queries) == 1
+
+
+def test_current_batch(client):
+    body = client.get('/api/current/batch', params={'node_ids': 'node1,node9'}).json()
+    assert set(body['nodes']) == {'node1', 'node9'}
+    assert body['nodes']['node1']['averages']['pm2_5_24h'] == 30.0
+    assert body['nodes']['node9']['averages'] is None
+
+
+def test_history_etag(client):
+    response = client.get('/api/history', params={'node_id': 'node1', 'hours': 2})
+    assert response.status_code == 200
+    assert len(response.json()['data']) > 0
+    etag = response.headers['etag']
+
+    again = client.get('/api/history', params={'node_id': 'node1', 'hours': 2},
+                       headers={'If-None-Match': etag})
+    assert again.status_code == 304
+
+
+def test_health(client):
+    body = client.get('/health').json()
+    assert body['status'] == 'healthy'
+    assert 'registry' in body['models']
+
+
+def test_stream_subscribes_off_event_loop(client, monkeypatch):
+    calls = []
+
+    def on_loop():
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    class Sub:
+        def get(self, timeout=None):
+            return None   # Hub dừng => kết thúc stream
+
+    def subscribe(node_ids, since_generation=None):
+        calls.append(('subscribe', on_loop()))
+        return Sub()
+
+    def unsubscribe(sub):
+        calls.append(('unsubscribe', on_loop()))
+
+    monkeypatch.setattr(api_async.live_hub, 'subscribe', subscribe)
+    monkeypatch.setattr(api_async.live_hub, 'unsubscribe', unsubscribe)
+    response = client.get('/api/stream', params={'node_ids': 'node1'})
+    assert response.status_code == 200
+    assert response.text.startswith('retry:')
+    assert calls == [('subscribe', False), ('unsubscribe', False)]
@@ -0,0 +1,100 @@
+from bucket_cache import BucketCache
+
+BUCKET = 300
+T0 = 1_700_000_000 - 1_700_000_000 % BUCKET
+
+
+class Source:
+    """Dữ liệu giả: mỗi bucket 1 dòng {'pm2_5': giá trị}; ghi lại các lần fetch"""
+
+    def __init__(self, values):
+        self.values = values      # bucket_ts -> giá trị (None = bucket rỗng)
+        self.calls = []
+
+    def __call__(self, since):
+        self.calls.append(since)
+        return {None: {ts: {'pm2_5': v} for ts, v in self.values.items() if ts >= since}}
+
+
+def series(result):
+    return [(ts, row['pm2_5']) for ts, row in result[None]]
+
+
+def test_tail_fetch_reuses_closed_buckets():
+    cache = BucketCache(settle=60, empty_settle=3600)
+    source = Source({T0 + i * BUCKET: float(i) for i in range(10)})
+    now = T0 + 10 * BUCKET + 30          # Bucket cuối (9) đã kết thúc nhưng chưa qua settle
+
+    first = cache.get('k', BUCKET, T0, source, now)
+    assert series(first) == [(T0 + i * BUCKET, float(i)) for i in range(10)]
+    assert source.calls == [T0]
+
+    # Bucket 9 đổi giá trị (dữ liệu trễ) và có thêm bucket 10
+    source.values[T0 + 9 * BUCKET] = 99.0
+    source.values[T0 + 10 * BUCKET] = 10.0
+    now += BUCKET
+    second = cache.get('k', BUCKET, T0, source, now)
+
+    assert source.calls == [T0, T0 + 9 * BUCKET]    # Chỉ query phần đuôi chưa đóng
+    assert series(second)[-2:] == [(T0 + 9 * BUCKET, 99.0), (T0 + 10 * BUCKET, 10.0)]
+    assert len(second[None]) == 11
+    assert cache.stats()['tail_fetches'] == 1
+
+
+def test_open_bucket_not_cached():
+    cache = BucketCache(settle=60, empty_settle=3600)
+    source = Source({T0: 1.0, T0 + BUCKET: 2.0})
+    now = T0 + BUCKET + 100              # Bucket 0 đã đóng, bucket 1 đang mở
+    cache.get('k', BUCKET, T0, source, now)
+    source.values[T0 + BUCKET] = 5.0
+    result = cache.get('k', BUCKET, T0, source, now + 5)
+    assert series(result) == [(T0, 1.0), (T0 + BUCKET, 5.0)]
+    assert source.calls[-1] == T0 + BUCKET
+
+
+def test_empty_bucket_waits_for_empty_settle():
+    cache = BucketCache(settle=60, empty_settle=3600)
+    source = Source({T0: 1.0, T0 + BUCKET: None, T0 + 2 * BUCKET: 3.0})
+    now = T0 + 3 * BUCKET + 120
+    cache.get('k', BUCKET, T0, source, now)
+
+    # Spool replay ghi bù bucket rỗng => lần sau vẫn query lại từ bucket đó
+    source.values[T0 + BUCKET] = 2.0
+    result = cache.get('k', BUCKET, T0, source, now + 10)
+    assert source.calls[-1] == T0 + BUCKET
+    assert series(result) == [(T0, 1.0), (T0 + BUCKET, 2.0), (T0 + 2 * BUCKET, 3.0)]
+
+
+def test_earlier_start_refetches_everything():
+    cache = BucketCache(settle=60, empty_settle=3600)
+    source = Source({T0 + i * BUCKET: float(i) for i in range(6)})
+    now = T0 + 6 * BUCKET + 120
+    cache.get('k', BUCKET, T0 + 3 * BUCKET, source, now)
+    result = cache.get('k', BUCKET, T0, source, now)
+    assert source.calls == [T0 + 3 * BUCKET, T0]
+    assert len(result[None]) == 6
+    assert cache.stats()['full_fetches'] == 2
+
+
+def test_default_settle_covers_rollup_lateness():
+    from rollup import GRACE, LATENESS
+    assert BucketCache().settle >= LATENESS + GRACE
+
+
+def test_lagging_group_keeps_bucket_open():
+    # /api/compare: node2 chưa gửi bucket 1 (trễ) => bucket 1 không đóng dù node1 đã có
+    cache = BucketCache(settle=60, empty_settle=3600)
+    data = {'node1': {T0: {'pm2_5': 1.0}, T0 + BUCKET: {'pm2_5': 2.0}},
+            'node2': {T0: {'pm2_5': 5.0}}}
+    calls = []
+
+    def fetch(since):
+        calls.append(since)
+        return {g: {ts: row for ts, row in rows.items() if ts >= since} for g, rows in data.items()}
+
+    now = T0 + 2 * BUCKET + 120
+    cache.get('k', BUCKET, T0, fetch, now)
+    data['node2'][T0 + BUCKET] = {'pm2_5': 6.0}
+    result = cache.get('k', BUCKET, T0, fetch, now + 10)
+    assert calls[-1] == T0 + BUCKET
+    assert [row['pm2_5'] for _, row in result['node2']] == [5.0, 6.0]
@@ -0,0 +1,85 @@
+import time
+
+from fcm_dispatch import FcmDispatcher, LocalFcm, InvalidToken, RateLimiter
+
+
+def dispatch(send_batch, tokens, batch_size=500):
+    dispatcher = FcmDispatcher(send_batch=send_batch, batch_size=batch_size, concurrency=2)
+    try:
+        return dispatcher.dispatch(tokens, 'title', 'body', {'node_id': 'node1'})
+    finally:
+        dispatcher.close()
+
+
+def test_permanent_failures_are_not_retried():
+    tokens = [f"t{i}" for i in range(10)]
+    fcm = LocalFcm(latency=0, unregistered=['t1'], invalid=['t2'])
+    result = dispatch(fcm, tokens)
+    assert result['sent'] == 8
+    assert sorted(result['invalid']) == ['t1', 't2']
+    assert result['retry'] == []
+
+
+def test_transient_failures_are_retried():
+    def flaky(tokens, message):
+        return [TimeoutError() if t == 't0' else None for t in tokens]
+
+    result = dispatch(flaky, ['t0', 't1'])
+    assert result['retry'] == ['t0']
+    assert result['errors'] == {'TimeoutError': 1}
+
+
+def test_invalid_message_does_not_prune_tokens():
+    # Cả batch invalid-argument => lỗi ở message, token vẫn giữ
+    def bad_message(tokens, message):
+        return [InvalidToken(t) for t in tokens]
+
+    result = dispatch(bad_message, ['t0', 't1', 't2'])
+    assert result['invalid'] == []
+    assert sorted(result['retry']) == ['t0', 't1', 't2']
+
+    # 1 token: không phân biệt được message sai hay token sai => thử lại, không xóa
+    result = dispatch(bad_message, ['t0'])
+    assert result['invalid'] == []
+    assert result['retry'] == ['t0']
+
+    # Batch 1 token cuối (501 token) cũng vậy khi không token nào nhận được
+    tokens = [f"t{i}" for i in range(501)]
+    result = dispatch(bad_message, tokens)
+    assert result['invalid'] == []
+    assert len(result['retry']) == 501
+
+
+def test_single_token_batch_pruned_when_message_is_valid():
+    # Batch khác gửi được => message hợp lệ => token lẻ invalid-argument là token sai
+    fcm = LocalFcm(latency=0, invalid=['t500'])
+    result = dispatch(fcm, [f"t{i}" for i in range(501)])
+    assert result['invalid'] == ['t500']
+    assert result['sent'] == 500
+
+
+def test_rate_limit_charged_per_batch():
+    class CountingLimiter:
+        calls = 0
+
+        def acquire(self, n=1):
+            self.calls += n
+
+    limiter = CountingLimiter()
+    dispatcher = FcmDispatcher(send_batch=LocalFcm(latency=0), batch_size=500, concurrency=2,
+                               limiter=limiter)
+    try:
+        dispatcher.dispatch([f"t{i}" for i in range(1201)], 'title', 'body', {})
+    finally:
+        dispatcher.close()
+    assert limiter.calls == 3          # ceil(1201 / 500), không phải 1 / cảnh báo
+
+
+def test_rate_limiter_waits_for_tokens():
+    limiter = RateLimiter(rate=50, burst=2)
+    start = time.monotonic()
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - start < 0.01
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.015
@@ -0,0 +1,52 @@
+import threading
+
+from influx_writer import BatchedInfluxWriter, make_line
+
+
+class Client:
+    def __init__(self):
+        self.lines = []
+
+    def write_points(self, lines, protocol=None, time_precision=None):
+        self.lines.extend(lines)
+
+
+class Spool:
+    """Ghi lại thread gọi append (spool thật: ghi file + fsync)"""
+    def __init__(self):
+        self.lines = []
+        self.threads = set()
+
+    def append(self, lines):
+        self.threads.add(threading.current_thread().name)
+        self.lines.extend(lines)
+
+
+def point(i):
+    return ('air_quality', {'node_id': 'node1'}, {'pm2_5': float(i)}, i)
+
+
+def test_overflow_spooled_by_writer_thread():
+    client, spool = Client(), Spool()
+    writer = BatchedInfluxWriter(client, batch_size=100, max_buffer=10, spool=spool)
+    for i in range(28):
+        writer.write(*point(i))
+    # write() (paho thread) không chạm spool
+    assert spool.lines == []
+    assert writer.stats()['depth'] == 10
+
+    writer.start()
+    writer.close()
+    assert spool.threads == {'influx-writer'}
+    # 18 điểm tràn: 10 đầu chờ ghi spool (giới hạn max_buffer), 8 sau bị bỏ
+    assert spool.lines == [make_line(*point(i)) for i in range(10)]
+    assert client.lines == [make_line(*point(i)) for i in range(18, 28)]
+    assert writer.stats()['spooled'] == 10
+    assert writer.stats()['dropped'] == 8
+
+
+def test_overflow_without_spool_is_dropped():
+    writer = BatchedInfluxWriter(Client(), batch_size=100, max_buffer=10)
+    for i in range(12):
+        writer.write(*point(i))
+    assert writer.stats()['dropped'] == 2
@@ -0,0 +1,97 @@
+import fcntl
+import threading
+import time
+
+import pytest
+
+import latest_store
+from latest_store import LatestStore, SEQ
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'latest')
+
+
+@pytest.fixture
+def reset_reader(monkeypatch):
+    monkeypatch.setattr(latest_store, '_reader', None)
+    monkeypatch.setattr(latest_store, '_reader_checked', 0.0)
+    monkeypatch.setattr(latest_store, '_reader_validated', 0.0)
+
+
+def test_update_and_read(path):
+    writer = LatestStore(path, slots=16, create=True)
+    reader = LatestStore.open(path)
+    assert writer.update('node1', 100.0, 1, 2, 3, 4, {'pm2_5_24h': 20.5, 'aqi_24h': 41})
+    assert not writer.update('node1', 99.0, 9, 9, 9, 9)   # Cũ hơn => bỏ qua
+
+    item = reader.get('node1')
+    assert (item['pm2_5'], item['aqi'], item['pm2_5_24h'], item['aqi_24h']) == (2, 4, 20.5, 41)
+    assert item['aqi_nowcast'] is None
+    assert reader.generation() == 1
+    assert list(reader.all(since_generation=1)) == []
+
+
+def test_reader_does_not_spin_on_dead_writer(path):
+    writer = LatestStore(path, slots=16, create=True)
+    writer.update('node1', 100.0, 1, 2, 3, 4)
+    i = writer._index[b'node1']
+    off = writer._slot_offset(i)
+    # Writer chết giữa 2 lần ghi seq: seq lẻ, không ai giữ flock
+    SEQ.pack_into(writer._mm, off, SEQ.unpack_from(writer._mm, off)[0] + 1)
+
+    reader = LatestStore.open(path)
+    start = time.monotonic()
+    assert reader.get('node1')['pm2_5'] == 2
+    assert time.monotonic() - start < 1
+
+    # Writer sau đưa seq về chẵn
+    writer.update('node1', 101.0, 1, 5, 3, 4)
+    assert SEQ.unpack_from(writer._mm, off)[0] % 2 == 0
+    assert reader.get('node1')['pm2_5'] == 5
+
+
+def test_reader_waits_for_live_writer(path):
+    writer = LatestStore(path, slots=16, create=True)
+    writer.update('node1', 100.0, 1, 2, 3, 4)
+    off = writer._slot_offset(writer._index[b'node1'])
+    seq = SEQ.unpack_from(writer._mm, off)[0]
+
+    fcntl.flock(writer._fd, fcntl.LOCK_EX)
+    SEQ.pack_into(writer._mm, off, seq + 1)
+
+    def finish():
+        time.sleep(0.1)
+        SEQ.pack_into(writer._mm, off, seq + 2)
+        fcntl.flock(writer._fd, fcntl.LOCK_UN)
+
+    thread = threading.Thread(target=finish)
+    thread.start()
+    start = time.monotonic()
+    assert LatestStore.open(path).get('node1')['pm2_5'] == 2
+    assert time.monotonic() - start >= 0.09
+    thread.join()
+
+
+def test_version_change_recreates_file_and_reader_follows(path, monkeypatch, reset_reader):
+    LatestStore(path, slots=16, create=True).update('node1', 100.0, 1, 2, 3, 4)
+    old = latest_store.shared_reader(path=path)
+    old_mm = old._mm
+    assert old.get('node1') is not None
+
+    monkeypatch.setattr(latest_store, 'VERSION', latest_store.VERSION + 1)
+    writer = LatestStore(path, slots=16, create=True)
+    writer.update('node2', 100.0, 1, 7, 3, 4)
+    assert old_mm[:4] == latest_store.MAGIC       # File cũ vẫn đọc được (không bị truncate)
+
+    monkeypatch.setattr(latest_store, '_reader_validated', 0.0)
+    reader = latest_store.shared_reader(path=path)
+    assert reader is not old
+    assert reader.get('node1') is None
+    assert reader.get('node2')['pm2_5'] == 7
+
+
+def test_create_keeps_valid_file(path):
+    LatestStore(path, slots=16, create=True).update('node1', 100.0, 1, 2, 3, 4)
+    assert LatestStore(path, slots=16, create=True).get('node1')['pm2_5'] == 2
@@ -0,0 +1,33 @@
+import os
+import pickle
+
+from model_registry import save_node, load_node, node_path
+
+
+def model(version=1):
+    return {'node_id': 'node/1', 'version': version, 'history': [1.0, 2.0], 'anomaly': None}
+
+
+def test_save_and_load(tmp_path):
+    directory = str(tmp_path / 'nodes')
+    old = os.umask(0o002)
+    try:
+        save_node(directory, model())
+    finally:
+        os.umask(old)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    assert load_node(directory, 'node/1')['version'] == 1
+    assert load_node(directory, 'node2') is None
+
+
+def test_refuses_untrusted_file(tmp_path):
+    directory = str(tmp_path / 'nodes')
+    save_node(directory, model())
+    path = node_path(directory, 'node/1')
+    with open(path, 'wb') as f:
+        pickle.dump(model(2), f)
+    os.chmod(path, 0o666)
+    assert load_node(directory, 'node/1') is None
+
+    save_node(directory, model(3))
+    assert load_node(directory, 'node/1')['version'] == 3
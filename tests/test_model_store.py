@@ -0,0 +1,53 @@
+import os
+import pickle
+
+import pytest
+
+from model_store import ModelStore, private_dir, write_atomic
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    directory = tmp_path / 'store'
+    return str(private_dir(str(directory)))
+
+
+def test_publish_and_load(store_dir):
+    writer = ModelStore(os.path.join(store_dir, 'models'), check_interval=0)
+    reader = ModelStore(os.path.join(store_dir, 'models'), check_interval=0)
+    assert reader.load() is None
+    assert writer.publish({'nodes': {'node1': 1}}) == 1
+    assert writer.publish({'nodes': {'node1': 2}}) == 2
+    assert reader.load()['nodes'] == {'node1': 2}
+
+
+def test_private_dir_created_0700(store_dir):
+    assert os.stat(store_dir).st_mode & 0o777 == 0o700
+
+
+def test_refuses_group_writable_directory(tmp_path):
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    os.chmod(directory, 0o777)
+    with pytest.raises(PermissionError):
+        ModelStore(str(directory / 'models'))
+
+
+def test_refuses_untrusted_file(store_dir):
+    path = os.path.join(store_dir, 'models')
+    store = ModelStore(path, check_interval=0)
+    with open(path, 'wb') as f:
+        pickle.dump({'version': 1, 'trained_at': 0}, f)
+    os.chmod(path, 0o666)
+    assert store.load() is None
+
+    write_atomic(path, {'version': 2, 'trained_at': 0})
+    assert store.load()['version'] == 2
+
+
+def test_lease_is_exclusive(store_dir):
+    path = os.path.join(store_dir, 'models')
+    first, second = ModelStore(path), ModelStore(path)
+    assert first.acquire_lease()
+    assert not second.acquire_lease()
+    assert os.stat(path + '.lock').st_mode & 0o777 == 0o600
@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+import pytest
+
+from model_store import ModelStore, private_dir
+from model_trainer import ModelTrainer
+
+
+@pytest.fixture
+def permissive_umask():
+    old = os.umask(0o002)
+    yield
+    os.umask(old)
+
+
+def test_trainer_publishes_under_permissive_umask(tmp_path, permissive_umask):
+    store = ModelStore(os.path.join(private_dir(str(tmp_path / 'shm')), 'models'), check_interval=0)
+    model_path = str(tmp_path / 'ml')
+
+    def fetch(since, until):
+        return {'node1': np.linspace(10, 40, 100)}
+
+    trainer = ModelTrainer(store, fetch, model_path=model_path, min_points=50)
+    assert trainer.run_once(now=1_700_000_000) == 'full'
+    assert store.load()['nodes'] == {'node1': 1}
+    assert os.stat(model_path).st_mode & 0o777 == 0o700
+
+    # Khởi động lại: model store trống => nạp lại từ ML_MODEL_PATH
+    os.unlink(store.path)
+    fresh = ModelStore(os.path.join(str(tmp_path / 'shm2'), 'models'), check_interval=0)
+    restored = ModelTrainer(fresh, fetch, model_path=model_path, min_points=50)
+    assert restored._restore()['nodes'] == {'node1': 1}
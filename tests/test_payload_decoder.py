@@ -0,0 +1,51 @@
+import json
+import time
+
+import pytest
+
+from payload_decoder import PayloadDecoder, InvalidPayload, encode_binary, encode_binary_batch
+
+
+def test_json_batch_skips_invalid_readings():
+    decoder = PayloadDecoder()
+    ts = int(time.time()) - 60
+    raw = json.dumps({'node_id': 'node1', 'readings': [
+        {'ts': ts, 'pm1_0': 5, 'pm2_5': 10, 'pm10': 15},
+        {'ts': ts + 30, 'pm1_0': 5, 'pm2_5': -1, 'pm10': 15},
+    ]}).encode()
+    readings = decoder.decode(raw)
+    assert [r.pm2_5 for r in readings] == [10.0]
+    assert readings[0].ts_ns == ts * 1_000_000_000
+    assert decoder.stats['out_of_range'] == 1
+
+
+def test_json_batch_all_invalid_raises():
+    decoder = PayloadDecoder()
+    raw = json.dumps({'node_id': 'node1', 'readings': [
+        {'pm1_0': 5, 'pm2_5': -1, 'pm10': 15},
+        {'pm1_0': 5, 'pm2_5': 10, 'pm10': 1e9},
+    ]}).encode()
+    with pytest.raises(InvalidPayload) as info:
+        decoder.decode(raw)
+    assert info.value.reason == 'out_of_range'
+    assert decoder.stats['out_of_range'] == 2
+    assert decoder.stats['decoded'] == 0
+
+
+def test_binary_batch_all_invalid_raises():
+    decoder = PayloadDecoder()
+    ts = int(time.time())
+    raw = encode_binary_batch('node1', [(ts, 5, 6000, 15, None), (ts + 30, 5, 6000, 15, None)])
+    with pytest.raises(InvalidPayload):
+        decoder.decode(raw)
+
+
+def test_binary_single_reading():
+    reading, = PayloadDecoder().decode(encode_binary('node1', 1.5, 12.3, 20.0))
+    assert (reading.node_id, reading.pm2_5, reading.aqi) == ('node1', 12.3, None)
+
+
+def test_malformed_json():
+    with pytest.raises(InvalidPayload) as info:
+        PayloadDecoder().decode(b'{"node_id": ')
+    assert info.value.reason == 'malformed'
@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from result_arrays import (from_buckets, from_resultset, round1, stats, zscores, to_list,
+                           iso_times, hour_labels)
+
+FIELDS = ['pm1_0', 'pm2_5', 'pm10', 'aqi']
+T0 = 1_700_000_000 - 1_700_000_000 % 300
+VN = timezone(timedelta(hours=7))
+
+# Kết quả bucket cache tự dựng: có bucket null (None) và field thiếu
+PAIRS = [
+    (T0, {'pm1_0': 5.04, 'pm2_5': 12.25, 'pm10': 20.0, 'aqi': 51.7}),
+    (T0 + 300, {'pm1_0': None, 'pm2_5': None, 'pm10': None, 'aqi': None}),
+    (T0 + 600, {'pm1_0': 6.0, 'pm2_5': 0.0, 'pm10': 31.449, 'aqi': 0.0}),
+    (T0 + 900, {'pm2_5': 40.06, 'pm10': 55.55, 'aqi': 112.0}),
+]
+
+
+class ResultSet:
+    """Như influxdb.resultset.ResultSet: chỉ dùng .raw"""
+    def __init__(self, raw):
+        self.raw = raw
+
+
+# ---------- Cách cũ (vòng lặp Python theo điểm) ----------
+def baseline_points(pairs):
+    return [(ts, row) for ts, row in pairs if row.get('pm2_5') is not None]
+
+
+def baseline_rows(points):
+    return [{
+        'time': datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'time_label': datetime.fromtimestamp(ts, VN).strftime('%H:%M'),
+        'pm1_0': round(row.get('pm1_0', 0) or 0, 1),
+        'pm2_5': round(row.get('pm2_5', 0) or 0, 1),
+        'pm10': round(row.get('pm10', 0) or 0, 1),
+        'aqi': int(row.get('aqi', 0) or 0)
+    } for ts, row in points]
+
+
+def baseline_columns(points, fields):
+    columns = {'time': [ts for ts, _ in points]}
+    for f in fields:
+        columns[f] = [None if row.get(f) is None else round(row[f], 1) for _, row in points]
+    return columns
+
+
+def baseline_stats(points):
+    values = [row['pm2_5'] for _, row in points if row['pm2_5']]
+    return (min(values), max(values), sum(values) / len(values)) if values else None
+
+
+# ---------- So sánh ----------
+def rows(series):
+    """Như api_server.to_rows"""
+    columns = {'time': iso_times(series.times), 'time_label': hour_labels(series.times, 7 * 3600)}
+    for f in FIELDS:
+        values = np.nan_to_num(series[f])
+        columns[f] = values.astype(np.int64).tolist() if f == 'aqi' else round1(values).tolist()
+    keys = list(columns)
+    return [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+
+def columns(series):
+    return {'time': series.times.tolist(), **{f: to_list(round1(series[f])) for f in FIELDS}}
+
+
+def test_buckets_match_baseline_rows_and_columns():
+    series = from_buckets(PAIRS, FIELDS).present('pm2_5')
+    points = baseline_points(PAIRS)
+    assert rows(series) == baseline_rows(points)
+    assert columns(series) == baseline_columns(points, FIELDS)
+
+
+def test_stats_match_baseline():
+    series = from_buckets(PAIRS, FIELDS).present('pm2_5')
+    expected = baseline_stats(baseline_points(PAIRS))
+    assert np.allclose(stats(series['pm2_5']), expected)
+    # Chỉ có null / 0 => không có thống kê
+    assert stats(np.array([np.nan, 0.0])) is None
+    assert stats(np.empty(0)) is None
+
+
+def test_empty_inputs():
+    series = from_buckets([], FIELDS)
+    assert len(series) == 0
+    assert rows(series) == [] and columns(series) == baseline_columns([], FIELDS)
+    assert from_resultset(ResultSet({}), ['pm2_5']) == {}
+
+    grouped = from_resultset(ResultSet({'series': [
+        {'name': 'air_quality', 'tags': {'node_id': 'node1'}, 'columns': ['time', 'pm2_5'], 'values': []}
+    ]}), ['pm2_5'], group_by='node_id')
+    assert list(grouped) == ['node1'] and len(grouped['node1']) == 0
+
+
+def test_resultset_groups_and_nulls():
+    raw = {'series': [
+        {'name': 'air_quality', 'tags': {'node_id': 'node1'}, 'columns': ['time', 'pm2_5', 'pm10'],
+         'values': [[T0, 10.0, None], [T0 + 60, None, 20.0]]},
+        {'name': 'air_quality', 'tags': {'node_id': 'node2'}, 'columns': ['time', 'pm10', 'pm2_5'],
+         'values': [[T0, 5.0, 7.5]]},
+    ]}
+    out = from_resultset(ResultSet(raw), ['pm2_5', 'pm10'], group_by='node_id')
+    assert out['node1'].times.tolist() == [T0, T0 + 60]
+    assert to_list(out['node1']['pm2_5']) == [10.0, None]
+    assert to_list(out['node1']['pm10']) == [None, 20.0]
+    assert to_list(out['node2']['pm2_5']) == [7.5]      # Thứ tự cột theo 'columns'
+    assert out['node1'].present('pm2_5').times.tolist() == [T0]
+
+
+def test_zscores_match_baseline():
+    values = np.array([10.0, 20.0, 35.0])
+    mean, std = 20.0, 5.0
+    assert zscores(values, mean, std).tolist() == [abs(v - mean) / std for v in values.tolist()]
+    assert zscores(values, mean, 0).tolist() == [0.0, 0.0, 0.0]
+
+
+def test_time_labels_cross_midnight():
+    times = np.array([T0 + h * 3600 for h in range(24)], dtype=np.int64)
+    assert hour_labels(times, 7 * 3600) == [
+        datetime.fromtimestamp(int(t), VN).strftime('%H:%M') for t in times]
+
+
+def test_round1_matches_python_round():
+    values = [55.55, 0.05, 0.15, 0.25, 2.675, 12.25, -3.45, 1e6 + 0.05, 7.0]
+    assert round1(np.array(values)).tolist() == [round(v, 1) for v in values]
+    assert to_list(round1(np.array([np.nan, 0.35]))) == [None, round(0.35, 1)]
@@ -0,0 +1,69 @@
+import pytest
+
+from rolling_aqi import RollingAqi, nowcast, HOUR, MINUTE
+
+T0 = 1_700_000_000 // HOUR * HOUR
+
+
+# ---------- NowCast: ví dụ tính tay theo công thức EPA (giờ mới nhất trước) ----------
+def test_nowcast_stable_hours_equal_mean():
+    assert nowcast([12.0] * 12) == pytest.approx(12.0)
+
+
+def test_nowcast_weight_from_min_over_max():
+    # w = 16 / 20 = 0.8 => (20 + 0.8 * 16) / (1 + 0.8)
+    assert nowcast([20.0, 16.0]) == pytest.approx(32.8 / 1.8)
+
+
+def test_nowcast_weight_floor_is_half():
+    # min / max = 0.1 < 0.5 => w = 0.5: (100 + 0.5 * 10) / 1.5
+    assert nowcast([100.0, 10.0]) == pytest.approx(70.0)
+
+
+def test_nowcast_skips_missing_hours_but_keeps_position():
+    # Giờ 1 thiếu; w = 20 / 30: (w * 30 + w^2 * 20) / (w + w^2) = 26
+    assert nowcast([None, 30.0, 20.0]) == pytest.approx(26.0)
+
+
+def test_nowcast_needs_two_of_last_three_hours():
+    assert nowcast([None, None, 30.0, 30.0]) is None
+    assert nowcast([30.0, None, None, 30.0]) is None
+
+
+def test_nowcast_all_zero():
+    assert nowcast([0.0, 0.0, 0.0]) == 0.0
+
+
+# ---------- Trung bình trượt ----------
+def test_hourly_average_drops_expired_minutes():
+    rolling = RollingAqi()
+    rolling.add('node1', T0, 100.0, 50.0)
+    rolling.add('node1', T0 + 30 * MINUTE, 20.0, 10.0)
+    assert rolling.averages('node1', T0 + 30 * MINUTE)['pm2_5_1h'] == pytest.approx(60.0)
+    # Mẫu đầu ra khỏi cửa sổ 60 phút, vẫn còn trong 24h
+    averages = rolling.averages('node1', T0 + 61 * MINUTE)
+    assert averages['pm2_5_1h'] == pytest.approx(20.0)
+    assert averages['pm2_5_24h'] == pytest.approx(60.0)
+    assert averages['pm10_24h'] == pytest.approx(30.0)
+    assert rolling.averages('node1', T0 + 25 * HOUR)['pm2_5_24h'] is None
+
+
+def test_nowcast_from_hourly_ring_and_seed():
+    rolling = RollingAqi()
+    # Rollup 1h: giờ trước TB 16 (4 mẫu), giờ hiện tại TB 20
+    rolling.seed('node1', T0, (64.0, 0.0), 4, minutes=False)
+    rolling.add('node1', T0 + HOUR + 10, 20.0, 0.0)
+    averages = rolling.averages('node1', T0 + HOUR + 20)
+    assert averages['pm2_5_nowcast'] == pytest.approx(32.8 / 1.8)
+    assert averages['aqi_nowcast'] is not None
+    assert averages['pm2_5_1h'] == pytest.approx(20.0)
+    assert rolling.averages('node2', T0) is None
+
+
+def test_weight_balances_seed_with_partial_stream():
+    # Shared mode 2 worker: lịch sử seed đầy đủ (TB 10, 4 mẫu), worker nhận 2 / 4 mẫu live (TB 40)
+    rolling = RollingAqi(weight=2)
+    rolling.seed('node1', T0, (40.0, 0.0), 4)
+    rolling.add('node1', T0 + 30 * MINUTE, 40.0, 0.0)
+    rolling.add('node1', T0 + 31 * MINUTE, 40.0, 0.0)
+    assert rolling.averages('node1', T0 + 32 * MINUTE)['pm2_5_1h'] == pytest.approx(25.0)
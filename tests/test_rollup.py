@@ -0,0 +1,105 @@
+import time
+
+from rollup import RollupEngine, backfill, backfill_query, measurement_for
+
+
+class FakeInflux:
+    """Điểm cùng measurement + tag + timestamp ghi đè nhau như InfluxDB"""
+
+    def __init__(self):
+        self.points = {}
+
+    def write(self, measurement, tags, fields, ts_ns):
+        self.points[(measurement, tuple(sorted(tags.items())), ts_ns)] = fields
+
+    def window(self, tier, start):
+        """sum(x_sum) / sum(count) trên mọi series của cửa sổ (như API)"""
+        rows = [f for (m, _, ts), f in self.points.items()
+                if m == measurement_for(tier) and ts == start * 1_000_000_000]
+        count = sum(f['count'] for f in rows)
+        return count, sum(f['pm2_5_sum'] for f in rows) / count
+
+
+def add_samples(engine, start, n, value):
+    for i in range(n):
+        engine.add('node1', (start + i) * 1_000_000_000, {'pm2_5': value, 'aqi': 10})
+
+
+def test_closed_window_written_once():
+    db = FakeInflux()
+    now = int(time.time())
+    start = now - now % 60 - 300
+    engine = RollupEngine(db.write, tiers={'1m': 60})
+    add_samples(engine, start, 30, 20.0)
+    assert engine.flush() == 1
+    assert engine.flush() == 0
+    assert db.window('1m', start) == (30, 20.0)
+
+
+def test_restart_keeps_both_parts_of_open_window():
+    db = FakeInflux()
+    now = int(time.time())
+    hour = now - now % 3600
+    tiers = {'1h': 3600}
+
+    first = RollupEngine(db.write, tiers=tiers)
+    add_samples(first, hour, 30, 100.0)
+    first.close()
+
+    second = RollupEngine(db.write, tiers=tiers)
+    add_samples(second, hour + 30, 30, 10.0)
+    second.close()
+
+    assert db.window('1h', hour) == (60, 55.0)
+
+
+def test_window_started_after_engine_is_untagged():
+    db = FakeInflux()
+    engine = RollupEngine(db.write, tiers={'1m': 60})
+    engine.started = 0
+    now = int(time.time())
+    add_samples(engine, now - now % 60, 5, 1.0)
+    engine.close()
+    (_, tags, _), = db.points
+    assert dict(tags) == {'node_id': 'node1'}
+
+
+def test_backfill_query_matches_engine_fields():
+    query = backfill_query('1h', 0, 3600)
+    assert 'INTO "air_quality_1h"' in query
+    assert 'sum("pm2_5") * 1.0 AS "pm2_5_sum"' in query
+    assert 'count("pm2_5") AS "count"' in query
+    assert 'GROUP BY time(1h), "node_id"' in query
+
+
+class FakeClient:
+    def __init__(self, first):
+        self.first = first
+        self.queries = []
+
+    def query(self, query, epoch=None, method='GET'):
+        measurement = query.split('FROM "')[1].split('"')[0]
+        if 'INTO' in query:
+            self.queries.append(query)
+            return FakeResult(None)
+        return FakeResult(self.first.get(measurement))
+
+
+class FakeResult:
+    def __init__(self, ts):
+        self.ts = ts
+
+    def get_points(self):
+        return [] if self.ts is None else [{'time': self.ts}]
+
+
+def test_backfill_covers_raw_before_first_rollup():
+    day = 86400
+    client = FakeClient({'air_quality': 10 * day + 100, measurement_for('1h'): 11 * day})
+    backfill(client, until=12 * day, tiers={'1h': 3600}, chunk=day // 2)
+    assert len(client.queries) == 2
+    assert f"time >= {10 * day}s AND time < {10 * day + day // 2}s" in client.queries[-1]
+
+    # Đã có rollup từ đầu dữ liệu raw => không làm gì
+    client = FakeClient({'air_quality': 10 * day + 100, measurement_for('1h'): 10 * day})
+    assert backfill(client, until=12 * day, tiers={'1h': 3600}) == 0
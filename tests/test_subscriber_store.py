@@ -0,0 +1,41 @@
+import pytest
+
+from subscriber_store import SubscriberStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SubscriberStore(str(tmp_path / 'subscribers.db'))
+
+
+def test_tokens_for_respects_node_and_threshold(store):
+    store.upsert('all-default')                                   # Mọi node, từ Kém
+    store.upsert('node1-moderate', node_ids=['node1'], min_level='moderate')
+    store.upsert('node2-bad', node_ids=['node2'], min_level='bad')
+
+    assert sorted(store.tokens_for('node1', 'moderate')) == ['node1-moderate']
+    assert sorted(store.tokens_for('node1', 'poor')) == ['all-default', 'node1-moderate']
+    assert store.tokens_for('node2', 'poor') == ['all-default']
+    assert sorted(store.tokens_for('node2', 'hazardous')) == ['all-default', 'node2-bad']
+
+
+def test_has_subscribers(store):
+    assert not store.has_subscribers('node1', 'hazardous')
+    store.upsert('t1')
+    assert not store.has_subscribers('node1', 'moderate')
+    assert store.has_subscribers('node1', 'poor')
+    store.upsert('t2', node_ids=['node3'], min_level='moderate')
+    assert store.has_subscribers('node3', 'moderate')
+    assert not store.has_subscribers('node1', 'moderate')
+
+
+def test_remove_cascades(store):
+    store.upsert('t1', node_ids=['node1', 'node2'])
+    store.remove(['t1'])
+    assert store.count() == 0
+    assert store.subscriptions('t1') == {}
+
+
+def test_good_is_not_a_valid_threshold(store):
+    with pytest.raises(ValueError):
+        store.upsert('t1', min_level='good')